@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+# Run from the backend folder: python -m benchmarks.concurrent_chats --concurrency 8
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+
+from benchmarks import stubs
+
+
+async def run_chat(client, message):
+    response = await client.post("/api/chat", json={"message": message})
+    response.raise_for_status()
+    return response.text
+
+
+async def timed_batch(app, concurrency, message):
+    # Start cold every time, otherwise the caches answer the second batch and we measure nothing
+    from plan_cache import plan_cache
+    from result_cache import result_cache
+    from chart_cache import chart_cache
+    from governor import governor
+    plan_cache.clear(include_pinned=True)
+    result_cache.clear()
+    chart_cache.clear()
+    governor.budget.clear()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        bodies = await asyncio.gather(*(run_chat(client, message) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    for body in bodies:
+        if 'event: error' in body:
+            raise RuntimeError(f"Chat failed: {body}")
+    return elapsed
+
+
+async def main(args):
+    # Every chat asks the same thing, coalesced they'd all be one chat and this would measure nothing. The stage
+    # limits are off too, this is about the event loop, not about how many LLM calls we allow at once.
+    os.environ["COALESCE_ENABLED"] = "false"
+    os.environ["SCHEDULER_ENABLED"] = "false"
+    stubs.install(llm_latency=args.llm_latency, query_latency=args.query_latency)
+    from main import app
+    from sandbox import sandbox
+
+    # The server forks the chart workers at startup (see main.py), ASGITransport doesn't run the lifespan
+    await sandbox.start()
+    single = await timed_batch(app, 1, args.message)
+    many = await timed_batch(app, args.concurrency, args.message)
+    ratio = many / single
+    await sandbox.shutdown()
+
+    print(f"1 chat: {single:.2f}s")
+    print(f"{args.concurrency} concurrent chats: {many:.2f}s")
+    print(f"ratio: {ratio:.2f} (limit {args.max_ratio})")
+
+    # If the blocking calls were still on the event loop, N chats would take about N times as long
+    return 0 if ratio <= args.max_ratio else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that concurrent chats don't block each other")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--query-latency", type=float, default=1.0)
+    parser.add_argument("--max-ratio", type=float, default=1.5)
+    parser.add_argument("--message", default="Show me the top 10 most prescribed medications")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import time
+from pathlib import Path
+
+# Run from the backend folder: python -m benchmarks.load_test --concurrency 8 --requests 100 --output run.json
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks import stubs
+
+# Replays the questions in tests.txt against the real app (main:app, lifespan included) with the fake LLM and
+# BigQuery from stubs.py, and writes a JSON report: time to first event, latency percentiles, throughput, peak
+# RSS and SSE bytes per request. Requests go straight to the ASGI app, no sockets, so time to first event is
+# when the app handed over its first chunk. Pass --baseline with an earlier report to see what changed.
+
+TESTS_FILE = Path(__file__).resolve().parent.parent.parent / "tests.txt"
+
+# What --baseline compares, and which way is better
+COMPARED = (
+    ("throughput_rps", "higher"),
+    ("latency_ms.p50", "lower"),
+    ("latency_ms.p95", "lower"),
+    ("latency_ms.p99", "lower"),
+    ("time_to_first_event_ms.p95", "lower"),
+    ("sse_bytes.mean", "lower"),
+    ("peak_rss_bytes", "lower"),
+)
+
+
+def load_questions(path):
+    with open(path, encoding="utf-8") as f:
+        return re.findall(r'^Query:\s*"(.+)"\s*$', f.read(), re.MULTILINE)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def distribution(values, digits=1):
+    if not values:
+        return {}
+    summary = {"mean": sum(values) / len(values), "max": max(values)}
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99)):
+        summary[name] = percentile(values, fraction)
+    return {name: round(value, digits) if digits else int(round(value)) for name, value in summary.items()}
+
+
+def parse_events(body):
+    events = []
+    for block in body.split(b"\n\n"):
+        name, data = None, []
+        for line in block.split(b"\n"):
+            if line.startswith(b"event: "):
+                name = line[len(b"event: "):].decode()
+            elif line.startswith(b"data: "):
+                data.append(line[len(b"data: "):])
+        if data:
+            events.append((name, b"\n".join(data)))
+    return events
+
+
+async def chat_request(app, message):
+    """One POST /api/chat through the ASGI app, timing when the body chunks arrive"""
+    body = json.dumps({"message": message}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": "/api/chat", "raw_path": b"/api/chat", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"loadtest"), (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000), "server": ("loadtest", 80),
+    }
+    finished = asyncio.Event()
+    request_sent = False
+    chunks = []
+    sample = {"status": None, "first_event_ms": None}
+    start = time.perf_counter()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # The client stays connected until the whole stream has arrived
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            sample["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            if message.get("body"):
+                if sample["first_event_ms"] is None:
+                    sample["first_event_ms"] = (time.perf_counter() - start) * 1000
+                chunks.append(message["body"])
+            if not message.get("more_body"):
+                finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    sample["latency_ms"] = (time.perf_counter() - start) * 1000
+
+    stream = b"".join(chunks)
+    events = parse_events(stream)
+    sample["sse_bytes"] = len(stream)
+    sample["events"] = len(events)
+    sample["error"] = sample["status"] != 200 or any(name == "error" for name, _ in events)
+    timing = next((json.loads(data) for name, data in reversed(events) if name == "timing"), None)
+    sample["stages"] = {stage: value["ms"] for stage, value in (timing or {}).get("stages", {}).items()}
+    return sample
+
+
+async def run_load(app, questions, total, concurrency):
+    pending = asyncio.Queue()
+    for index in range(total):
+        pending.put_nowait(questions[index % len(questions)])
+    samples = []
+
+    async def worker():
+        while not pending.empty():
+            samples.append(await chat_request(app, pending.get_nowait()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - start
+
+
+def _peak_rss(pid="self"):
+    # VmHWM is the process's peak resident set size
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def build_report(args, questions, samples, duration, llm, sandbox_rss):
+    measured = [sample for sample in samples if not sample["error"]]
+    stage_names = sorted({stage for sample in measured for stage in sample["stages"]})
+    peak_rss = _peak_rss()
+    if peak_rss is None:
+        # ru_maxrss is kilobytes on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    sse_bytes = [sample["sse_bytes"] for sample in measured]
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "questions": len(questions),
+            "llm_latency": args.llm_latency,
+            "query_latency": args.query_latency,
+            "jitter": args.jitter,
+            "rows": args.rows,
+            "caches": args.caches,
+            "recordings": args.recordings,
+        },
+        "requests": len(samples),
+        "errors": len(samples) - len(measured),
+        "duration_seconds": round(duration, 3),
+        "throughput_rps": round(len(measured) / duration, 3) if duration else None,
+        "time_to_first_event_ms": distribution([sample["first_event_ms"] for sample in measured]),
+        "latency_ms": distribution([sample["latency_ms"] for sample in measured]),
+        "sse_bytes": {**distribution(sse_bytes, 0), "total": sum(sse_bytes)},
+        "events_per_request": round(sum(s["events"] for s in measured) / len(measured), 1) if measured else None,
+        # Mean time per request in each stage, from the 'timing' events (see metrics.py)
+        "stages_ms": {
+            stage: round(sum(sample["stages"].get(stage, 0) for sample in measured) / len(measured), 1)
+            for stage in stage_names
+        },
+        "llm_calls": llm.calls,
+        "peak_rss_bytes": peak_rss,
+        "sandbox_peak_rss_bytes": sandbox_rss,
+    }
+
+
+def _lookup(report, path):
+    value = report
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(report, baseline, max_regression):
+    """Print what changed since the baseline report, returns the metrics that got worse by more than allowed"""
+    regressions = []
+    for path, better in COMPARED:
+        new, old = _lookup(report, path), _lookup(baseline, path)
+        if not new or not old:
+            continue
+        change = (new - old) / old
+        worse = change < -max_regression if better == "higher" else change > max_regression
+        if worse:
+            regressions.append(path)
+        print(f"{'WORSE' if worse else '     '} {path:>30}: {old:>14,.1f} -> {new:>14,.1f} ({change:+.1%})",
+              file=sys.stderr)
+    return regressions
+
+
+async def main(args):
+    # Settings are read at import, so they go in the environment before the app is imported
+    os.environ.setdefault("LOG_LEVEL", args.log_level)
+    if args.caches == "off":
+        # Coalescing too, with one fake query for every question all concurrent chats would share a job
+        for name in ("RESULT_CACHE_ENABLED", "PLAN_CACHE_ENABLED", "CHART_CACHE_ENABLED", "COALESCE_ENABLED"):
+            os.environ[name] = "false"
+
+    recordings = stubs.load_recordings(args.recordings) if args.recordings else None
+    llm = stubs.install(llm_latency=args.llm_latency, query_latency=args.query_latency, num_rows=args.rows,
+                        jitter=args.jitter, recordings=recordings)
+    from main import app
+    from sandbox import sandbox
+
+    questions = load_questions(args.questions)
+    if not questions:
+        raise SystemExit(f"No questions found in {args.questions}")
+
+    async with app.router.lifespan_context(app):
+        if args.warmup:
+            await run_load(app, questions, args.warmup, min(args.concurrency, args.warmup))
+        llm.calls = 0
+        samples, duration = await run_load(app, questions, args.requests, args.concurrency)
+        worker_rss = [_peak_rss(pid) for pid in sandbox.worker_pids()]
+        sandbox_rss = sum(rss for rss in worker_rss if rss) or None
+
+    report = build_report(args, questions, samples, duration, llm, sandbox_rss)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    print(f"{report['requests']} requests ({report['errors']} errors) in {report['duration_seconds']:.2f}s, "
+          f"{report['throughput_rps']} req/s, p50 {report['latency_ms'].get('p50')} ms, "
+          f"p95 {report['latency_ms'].get('p95')} ms, first event p95 "
+          f"{report['time_to_first_event_ms'].get('p95')} ms", file=sys.stderr)
+
+    failed = report["errors"] > 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay tests.txt against the app with fake LLM and BigQuery")
+    parser.add_argument("--requests", type=int, default=50, help="Chats to send (questions are reused in order)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=2, help="Chats to send before measuring")
+    parser.add_argument("--questions", default=str(TESTS_FILE))
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--query-latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latencies vary by up to this fraction")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows every fake query returns")
+    parser.add_argument("--recordings", help="JSON file of recorded LLM replies (see stubs.load_recordings)")
+    parser.add_argument("--caches", choices=("on", "off"), default="off",
+                        help="The fake LLM writes the same SQL for every question, so caches (and request coalescing) "
+                             "would answer most of them")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="An earlier report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="With --baseline, fail when a metric is this much worse")
+    sys.exit(asyncio.run(main(parser.parse_args())))
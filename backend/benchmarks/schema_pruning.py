@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+# Run from the backend folder: python -m benchmarks.schema_pruning [--live]
+# Compares the answer_question prompt with the full schema against the pruned schema for every question in
+# tests.txt. Without --live the LLM is a stub whose latency grows with the prompt size, which is how prefill
+# behaves; with --live it calls Claude for real and measures actual time-to-SQL.
+BACKEND = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND))
+
+from benchmarks.stubs import ANSWER_REPLY
+from schema_catalog import catalog
+from schema_index import estimate_tokens, index
+from settings import DATASETS
+
+
+def load_questions():
+    text = (BACKEND.parent / "tests.txt").read_text(encoding="utf-8")
+    return re.findall(r'Query: "(.*)"', text)
+
+
+def build_prompt(question, schema_text):
+    # Same shape as the answer_question prompt, the instructions are a constant either way
+    return f"Question: {question}\n\n{schema_text}\n\nCan any of these databases answer the question?"
+
+
+async def time_to_sql(prompt, args):
+    start = time.perf_counter()
+    if args.live:
+        from llm import get_llm
+        response = await get_llm().ainvoke(prompt)
+        content = response.content
+    else:
+        await asyncio.sleep(args.base_latency + estimate_tokens(prompt) / 1000 * args.latency_per_1k_tokens)
+        content = ANSWER_REPLY
+    if not re.search(r"```(?:sql)?\s*(.*?)\s*```", content, re.DOTALL | re.IGNORECASE):
+        print("warning: no SQL in response", file=sys.stderr)
+    return time.perf_counter() - start
+
+
+async def main(args):
+    catalog.load()
+    full_text = catalog.prompt_text(DATASETS)
+    rows = []
+
+    for question in load_questions():
+        start = time.perf_counter()
+        selection = index.select(question, DATASETS)
+        select_ms = (time.perf_counter() - start) * 1000
+
+        before_prompt = build_prompt(question, full_text)
+        after_prompt = build_prompt(question, selection.prompt_text)
+        rows.append({
+            "question": question,
+            "pruned": selection.pruned,
+            "tables": [table for _, table in selection.tables],
+            "tokens_before": estimate_tokens(before_prompt),
+            "tokens_after": estimate_tokens(after_prompt),
+            "select_ms": round(select_ms, 3),
+            "time_to_sql_before": round(await time_to_sql(before_prompt, args), 3),
+            "time_to_sql_after": round(await time_to_sql(after_prompt, args), 3),
+        })
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print(f"{'tokens':>15} {'time-to-SQL (s)':>17} {'select':>8}  question")
+    for row in rows:
+        print(f"{row['tokens_before']:>6} -> {row['tokens_after']:<5} "
+              f"{row['time_to_sql_before']:>6.2f} -> {row['time_to_sql_after']:<6.2f} "
+              f"{row['select_ms']:>6.2f}ms  {row['question'][:60]}")
+    before = sum(row["tokens_before"] for row in rows)
+    after = sum(row["tokens_after"] for row in rows)
+    print(f"\nprompt tokens: {before} -> {after} ({100 * (1 - after / before):.0f}% smaller)")
+    print(f"time-to-SQL: {sum(r['time_to_sql_before'] for r in rows):.2f}s -> {sum(r['time_to_sql_after'] for r in rows):.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prompt size and time-to-SQL with and without schema pruning")
+    parser.add_argument("--live", action="store_true", help="call Claude instead of the latency model")
+    parser.add_argument("--base-latency", type=float, default=2.0, help="stub LLM fixed latency in seconds")
+    parser.add_argument("--latency-per-1k-tokens", type=float, default=0.25, help="stub LLM prefill cost")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,89 @@
+import argparse
+import datetime
+import json
+import sys
+import timeit
+from decimal import Decimal
+from pathlib import Path
+
+# Run from the backend folder: python -m benchmarks.sse_encoding
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+import sse
+from decimation import encode_array
+
+
+def old_encode(payload):
+    # What every yield site used to do. default=str is needed just to get through dates and Decimals at all.
+    return f"data: {json.dumps(payload, default=str)}\n\n".encode('utf-8')
+
+
+def payloads(points):
+    rng = np.random.default_rng(0)
+    start = datetime.datetime(2150, 1, 1)
+    return {
+        "message": sse.message("Running dynamically generated query"),
+        "progress": {'type': 'progress', 'stage': 'query', 'rows': 40000, 'total_rows': 100000, 'bytes': 3200000},
+        f"plotly, {points:,} floats": {
+            'type': 'graph', 'graphType': 'plotly',
+            'graphData': {'data': [{'type': 'scatter', 'x': list(range(points)),
+                                    'y': [float(v) for v in rng.normal(80, 10, points)]}], 'layout': {}},
+        },
+        "plotly, typed arrays": {
+            'type': 'graph', 'graphType': 'plotly',
+            'graphData': {'data': [{'type': 'scatter', 'x': encode_array(np.arange(5000)),
+                                    'y': encode_array(rng.normal(80, 10, 5000))}], 'layout': {}},
+        },
+        "5,000 rows (datetime, Decimal)": {
+            'type': 'rows',
+            'rows': [{'charttime': start + datetime.timedelta(minutes=i), 'valuenum': Decimal(f"{i % 200}.5"),
+                      'label': 'Heart Rate'} for i in range(5000)],
+        },
+    }
+
+
+def time_call(func, payload, repeat):
+    try:
+        func(payload)
+    except TypeError as e:
+        return None, str(e)
+    number = max(1, repeat)
+    best = min(timeit.repeat(lambda: func(payload), number=number, repeat=5)) / number
+    return best, len(func(payload))
+
+
+def main(args):
+    rows = []
+    for name, payload in payloads(args.points).items():
+        repeat = 20 if "rows" in name or "floats" in name else 2000
+        old_time, old_size = time_call(old_encode, payload, repeat)
+        new_time, new_size = time_call(sse.encode_event, payload, repeat)
+        rows.append({
+            "payload": name,
+            "json_dumps_us": round(old_time * 1e6, 1) if old_time else None,
+            "sse_us": round(new_time * 1e6, 1),
+            "speedup": round(old_time / new_time, 1) if old_time else None,
+            "json_dumps_bytes": old_size if old_time else None,
+            "sse_bytes": new_size,
+        })
+
+    if args.json:
+        print(json.dumps({"backend": "orjson" if sse.orjson else "json", "results": rows}, indent=2))
+        return 0
+    print(f"encoder backend: {'orjson' if sse.orjson else 'json (orjson not installed)'}")
+    print(f"{'payload':34} {'json.dumps':>12} {'sse':>10} {'speedup':>8} {'bytes before':>13} {'bytes after':>12}")
+    for row in rows:
+        old = f"{row['json_dumps_us']:.1f}us" if row['json_dumps_us'] else "fails"
+        speedup = f"{row['speedup']}x" if row['speedup'] else "-"
+        before = row['json_dumps_bytes'] if row['json_dumps_bytes'] else "-"
+        print(f"{row['payload']:34} {old:>12} {row['sse_us']:>8.1f}us {speedup:>8} {before:>13} {row['sse_bytes']:>12}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the SSE encoder with json.dumps + f-string framing")
+    parser.add_argument("--points", type=int, default=100000, help="Points in the big plotly payload")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    sys.exit(main(parser.parse_args()))
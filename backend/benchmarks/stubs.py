@@ -0,0 +1,245 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+import pyarrow as pa
+from google.api_core import exceptions as google_exceptions
+
+# Stand-ins for Claude and BigQuery so the pipeline can be exercised without spending real money.
+# Latencies are configurable so we can see where the time goes when the backends are slow.
+
+# Roughly what a token is, the fake LLM streams its replies in pieces this big
+STREAM_CHUNK_CHARS = 8
+
+CHART_REPLY = """LIBRARY: plotly
+CHART: bar chart"""
+
+ANSWER_REPLY = """ANSWER: YES
+
+DATABASE: physionet-data:mimiciv_3_1_hosp
+
+REASONING: The prescriptions table has a drug column we can count.
+
+REQUIRED_DATA: hosp.prescriptions.drug
+
+SQL QUERY:
+```sql
+SELECT drug, COUNT(*) AS prescription_count
+FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`
+GROUP BY drug
+ORDER BY prescription_count DESC
+LIMIT 10
+```
+
+The query counts prescriptions per drug and keeps the ten most common, so the ranking covers every admission in
+the hospital module rather than a single care unit.
+"""
+
+REWRITE_REPLY = """```sql
+SELECT drug, COUNT(*) AS prescription_count
+FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`
+GROUP BY drug
+ORDER BY prescription_count DESC
+LIMIT 10
+```"""
+
+# What the fake dry run says a query scans. SELECT * is the expensive mistake the governor is there to catch.
+SCAN_BYTES = 2 * 1024 ** 3
+SELECT_STAR_SCAN_BYTES = 400 * 1024 ** 3
+
+# SQL that passes the local checks but that the fake BigQuery rejects, like a function it doesn't have
+REJECTED_SQL_MARKER = "NOT_A_BIGQUERY_FUNCTION"
+
+CHART_CODE_REPLY = """```python
+labels = []
+values = []
+for row in data:
+    row_values = list(row.values())
+    labels.append(str(row_values[0]))
+    values.append(row_values[1])
+fig = go.Figure()
+fig.add_trace(go.Bar(x=labels, y=values))
+fig.update_layout(title=chart_title)
+plot_data = plotly_to_dict(fig)
+result = {"graphType": "plotly", "data": plot_data["data"], "layout": plot_data["layout"]}
+```"""
+
+
+def prompt_kind(prompt):
+    """Which of our prompts this is. These are also the keys of a recordings file (see load_recordings)."""
+    if "LIBRARY:" in prompt and "CHART:" in prompt:
+        return "chart"
+    if "ANSWER: [YES/NO]" in prompt:
+        return "answer"
+    if "scanning less data" in prompt:
+        return "rewrite"
+    if "Fix the query" in prompt:
+        return "repair"
+    return "chart_code"
+
+
+def fake_reply(prompt, recordings=None):
+    # Pick a canned answer based on which of our prompts this is
+    kind = prompt_kind(prompt)
+    if recordings and kind in recordings:
+        return random.choice(recordings[kind])
+    if kind == "chart":
+        return CHART_REPLY
+    if kind == "answer":
+        return ANSWER_REPLY
+    if kind in ("rewrite", "repair"):
+        return REWRITE_REPLY
+    return CHART_CODE_REPLY
+
+
+def load_recordings(path):
+    """Real LLM replies saved as {"chart": ..., "answer": ..., "chart_code": ...}, each a reply or a list of them"""
+    with open(path) as f:
+        recordings = json.load(f)
+    return {kind: replies if isinstance(replies, list) else [replies] for kind, replies in recordings.items()}
+
+
+def fake_response(prompt, recordings=None):
+    # Roughly four characters a token, close enough for the token histograms
+    content = fake_reply(prompt, recordings)
+    usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(content) // 4}
+    usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+    return SimpleNamespace(content=content, usage_metadata=usage)
+
+
+class FakeLLM:
+    def __init__(self, latency=1.0, jitter=0.0, recordings=None):
+        self.latency = latency
+        # Each call takes latency * (1 +/- jitter), real LLM calls are anything but constant
+        self.jitter = jitter
+        self.recordings = recordings
+        self.calls = 0
+        # Calls dropped halfway, like an HTTP request closed because the chat was cancelled
+        self.aborted = 0
+
+    def delay(self):
+        if not self.jitter:
+            return self.latency
+        return max(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter), 0)
+
+    def invoke(self, prompt, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay())
+        return fake_response(prompt, self.recordings)
+
+    async def ainvoke(self, prompt, **kwargs):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay())
+        except asyncio.CancelledError:
+            self.aborted += 1
+            raise
+        return fake_response(prompt, self.recordings)
+
+    async def astream(self, prompt, **kwargs):
+        # The reply a few characters at a time over the same total latency, usage comes with the last chunk
+        self.calls += 1
+        response = fake_response(prompt, self.recordings)
+        pieces = [response.content[i:i + STREAM_CHUNK_CHARS]
+                  for i in range(0, len(response.content), STREAM_CHUNK_CHARS)] or [""]
+        delay = self.delay() / len(pieces)
+        try:
+            for index, piece in enumerate(pieces):
+                await asyncio.sleep(delay)
+                last = index == len(pieces) - 1
+                yield SimpleNamespace(content=piece, usage_metadata=response.usage_metadata if last else None)
+        except asyncio.CancelledError:
+            self.aborted += 1
+            raise
+
+
+class FakeRowIterator:
+    def __init__(self, table, page_size):
+        self.table = table
+        self.page_size = page_size or 10000
+        self.total_rows = table.num_rows
+
+    def __iter__(self):
+        return iter(self.table.to_pylist())
+
+    def to_arrow_iterable(self, bqstorage_client=None, **kwargs):
+        yield from self.table.to_batches(max_chunksize=self.page_size)
+
+
+class FakeQueryJob:
+    # Every job started and cancelled so far, across all fake clients
+    started = 0
+    cancelled = 0
+
+    def __init__(self, table, latency):
+        FakeQueryJob.started += 1
+        self.table = table
+        self.latency = latency
+        self._cancel = threading.Event()
+
+    def result(self, page_size=None, **kwargs):
+        # Deliberately blocking, just like the real client
+        if self._cancel.wait(self.latency):
+            raise google_exceptions.BadRequest("Job execution was cancelled: User requested cancellation")
+        return FakeRowIterator(self.table, page_size)
+
+    def cancel(self):
+        FakeQueryJob.cancelled += 1
+        self._cancel.set()
+        return True
+
+
+class FakeDryRunJob:
+    def __init__(self, sql):
+        self.statement_type = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "SELECT"
+        if self.statement_type == "WITH":
+            self.statement_type = "SELECT"
+        self.total_bytes_processed = SELECT_STAR_SCAN_BYTES if re.search(r"select\s+\*", sql, re.I) else SCAN_BYTES
+
+
+class FakeBigQueryClient:
+    def __init__(self, project=None, latency=1.0, num_rows=10, jitter=0.0, **kwargs):
+        self.project = project
+        self.latency = latency
+        self.num_rows = num_rows
+        self.jitter = jitter
+        self._table = None
+
+    def table(self):
+        # Built once, so a big fake result costs the harness nothing per query
+        if self._table is None:
+            self._table = pa.table({
+                "drug": [f"Drug {i}" for i in range(self.num_rows)],
+                "prescription_count": [1000 - i for i in range(self.num_rows)],
+            })
+        return self._table
+
+    def query(self, sql, job_config=None, **kwargs):
+        if REJECTED_SQL_MARKER in sql:
+            raise google_exceptions.BadRequest(f"Function not found: {REJECTED_SQL_MARKER} at [1:8]")
+        if job_config is not None and job_config.dry_run:
+            return FakeDryRunJob(sql)
+        latency = self.latency * random.uniform(1 - self.jitter, 1 + self.jitter) if self.jitter else self.latency
+        return FakeQueryJob(self.table(), max(latency, 0))
+
+
+def install(llm_latency=1.0, query_latency=1.0, num_rows=10, jitter=0.0, recordings=None):
+    """Swap the real Claude and BigQuery clients for the fakes, returns the shared fake LLM"""
+    import chat
+    import engines
+    import governor
+    import sql_validator
+    import visualization
+
+    llm = FakeLLM(latency=llm_latency, jitter=jitter, recordings=recordings)
+    chat.get_llm = lambda **kwargs: llm
+    visualization.get_llm = lambda **kwargs: llm
+    governor.get_llm = lambda **kwargs: llm
+    sql_validator.get_llm = lambda **kwargs: llm
+    # Dry runs answer right away, like the real thing, only actual queries take query_latency
+    engines.get_engine('bigquery').reset(lambda: FakeBigQueryClient(
+        latency=query_latency, num_rows=num_rows, jitter=jitter))
+    return llm
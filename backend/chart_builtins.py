@@ -0,0 +1,102 @@
+import re
+import pyarrow as pa
+from chart_cache import normalize_chart_type
+
+# Most charts people ask for are one of five types over a very simple result: a label column and a count, a date
+# and a value, two numbers. Those don't need an LLM to write plotting code. This picks the columns for a built-in
+# renderer from the result's schema (the drawing itself happens in the sandbox, see chart_runtime.render_builtin).
+# Anything that doesn't fit cleanly returns None and goes through the generated code path instead.
+
+BUILTIN_TYPES = ('bar', 'line', 'scatter', 'pie', 'histogram')
+BUILTIN_LIBRARIES = ('plotly', 'matplotlib', 'seaborn')
+
+# More value columns than this and a simple chart stops being readable
+MAX_SERIES = 4
+
+# Value columns that are already counts, which means the rows are pre-binned and a histogram would be wrong
+COUNT_COLUMN = re.compile(r'(^|_)(count|cnt|n|num|freq|frequency|total)(_|$)')
+
+
+def _is_number(arrow_type):
+    return pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type)
+
+
+def _is_label(arrow_type):
+    return pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type) or pa.types.is_boolean(arrow_type)
+
+
+def _title(name):
+    return name.replace('_', ' ').strip().title()
+
+
+def plan_builtin(library, chart_type, query_result):
+    """A spec for chart_runtime.render_builtin, or None when this chart needs generated code"""
+    library = (library or '').lower()
+    kind = normalize_chart_type(chart_type)
+    if library not in BUILTIN_LIBRARIES or kind not in BUILTIN_TYPES:
+        return None
+    # Words like "stacked" or "horizontal" ask for something the built-ins don't do
+    if re.search(r'stack|horizontal|3d|heat|box|violin|bubble|area|facet', (chart_type or '').lower()):
+        return None
+
+    schema = query_result.table.schema
+    if query_result.num_rows == 0 or len(schema) == 0:
+        return None
+    if any(pa.types.is_nested(field.type) or pa.types.is_binary(field.type) for field in schema):
+        return None
+
+    numbers = [field.name for field in schema if _is_number(field.type)]
+    labels = [field.name for field in schema if _is_label(field.type)]
+    dates = [field.name for field in schema if pa.types.is_temporal(field.type)]
+
+    # Two label columns (gender, admission_type, count) is long format that needs pivoting, leave it to the LLM
+    if len(labels) > 1:
+        return None
+
+    spec = {'kind': kind, 'library': library, 'x': None, 'y': [], 'x_temporal': False}
+    if kind in ('bar', 'line'):
+        if kind == 'line' and dates:
+            x = dates[0]
+        elif labels:
+            x = labels[0]
+        elif dates:
+            x = dates[0]
+        elif len(numbers) > 1:
+            x = numbers[0]
+        else:
+            return None
+        if kind == 'line' and labels and x in dates:
+            # One series per label, also long format
+            return None
+        spec['x'] = x
+        spec['x_temporal'] = x in dates
+        # Dates and numbers get sorted for a line, labels keep the order the SQL put them in
+        spec['sort'] = kind == 'line' and x not in labels
+        spec['y'] = [name for name in numbers if name != x]
+    elif kind == 'scatter':
+        if len(numbers) < 2 or labels:
+            return None
+        spec['x'], spec['y'] = numbers[0], numbers[1:2]
+    elif kind == 'pie':
+        # No value column is fine, the renderer counts rows per label
+        if not labels or len(numbers) > 1:
+            return None
+        spec['x'], spec['y'] = labels[0], numbers[:1]
+    elif kind == 'histogram':
+        if len(numbers) != 1 or dates or COUNT_COLUMN.search(numbers[0].lower()):
+            return None
+        spec['x'] = numbers[0]
+
+    if kind in ('bar', 'line', 'scatter') and not 1 <= len(spec['y']) <= MAX_SERIES:
+        return None
+
+    if kind == 'histogram':
+        spec['title'] = f"Distribution of {_title(spec['x'])}"
+        spec['x_label'], spec['y_label'] = _title(spec['x']), 'Count'
+    elif kind == 'pie':
+        spec['title'] = f"{_title(spec['y'][0]) if spec['y'] else 'Rows'} by {_title(spec['x'])}"
+    else:
+        spec['title'] = f"{', '.join(_title(name) for name in spec['y'])} by {_title(spec['x'])}"
+        spec['x_label'] = _title(spec['x'])
+        spec['y_label'] = _title(spec['y'][0]) if len(spec['y']) == 1 else None
+    return spec
@@ -0,0 +1,152 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from fastapi import APIRouter, Depends
+from security import require_admin
+from settings import CHART_CACHE_ENABLED, CHART_CACHE_MAX_ENTRIES
+
+# Chart code only depends on the shape of the data, not the values: "a plotly bar chart over (drug string,
+# prescription_count int64)" is the same code whether it's the top 10 or the top 20. So code the LLM wrote
+# (and that actually produced a chart) gets saved under a signature of the library, the chart type and the
+# column names and types, and any later result with that signature reuses it. Words that change the code for
+# the same type ("horizontal", "stacked") go into the signature too, and the title is a variable the code is
+# given rather than text it has in it, or every reuse would carry the first question's title.
+
+router = APIRouter()
+
+# check_for_chart answers in free text ("Horizontal bar chart", "line graph", ...), these map it to a few types
+CHART_TYPE_WORDS = [
+    ('histogram', 'histogram'),
+    ('distribution', 'histogram'),
+    ('scatter', 'scatter'),
+    ('pie', 'pie'),
+    ('donut', 'pie'),
+    ('doughnut', 'pie'),
+    ('line', 'line'),
+    ('time series', 'line'),
+    ('trend', 'line'),
+    ('bar', 'bar'),
+    ('column', 'bar'),
+]
+
+
+# "Horizontal bar chart" and "stacked bar" aren't the code a plain bar chart is
+CHART_MODIFIERS = re.compile(
+    r'horizontal|stack|group|percent|\blog|3d|heat|box|violin|bubble|area|facet|donut|doughnut'
+)
+
+# What the generated code is told to title the chart with (see python_code_generation_prompt.txt)
+TITLE_VARIABLE = 'chart_title'
+MAX_TITLE_CHARS = 80
+
+
+def normalize_chart_type(chart_type):
+    """'Horizontal Bar Chart' -> 'bar'. Types we don't know just get tidied up."""
+    text = (chart_type or '').lower()
+    for word, normalized in CHART_TYPE_WORDS:
+        if word in text:
+            return normalized
+    text = re.sub(r'\b(chart|graph|plot|diagram)s?\b', ' ', text)
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip() or 'chart'
+
+
+def chart_modifiers(chart_type):
+    """'Horizontal Stacked Bar' -> 'horizontal,stack'"""
+    return ','.join(sorted(set(CHART_MODIFIERS.findall((chart_type or '').lower()))))
+
+
+def chart_signature(library, chart_type, query_result):
+    columns = [f"{field.name}:{field.type}" for field in query_result.table.schema]
+    text = "\n".join([library.lower(), normalize_chart_type(chart_type), chart_modifiers(chart_type)] + columns)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def chart_title(message):
+    # The question it answers, first line only and not too long
+    lines = (message or '').strip().splitlines()
+    title = lines[0].strip().rstrip('?.!') if lines else ''
+    if len(title) > MAX_TITLE_CHARS:
+        title = title[:MAX_TITLE_CHARS - 3].rstrip() + '...'
+    return title or 'Data Visualization'
+
+
+def with_title(code, title):
+    """The code with its title variable set, the way it's run (the cache keeps it without)"""
+    return f"{TITLE_VARIABLE} = {title!r}\n{code}"
+
+
+def reusable(code):
+    # Code that wrote its own title would put this question's title on every later chart
+    return re.search(rf'\b{TITLE_VARIABLE}\b', code) is not None
+
+
+class ChartCodeCache:
+    def __init__(self, max_entries=CHART_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0, "misses": 0, "stale": 0, "stores": 0, "evictions": 0,
+            "builtin_hits": 0, "builtin_failures": 0, "llm_calls": 0,
+        }
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, signature):
+        if not CHART_CACHE_ENABLED:
+            return None
+        with self._lock:
+            code = self._entries.get(signature)
+            if code is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(signature)
+            self._stats["hits"] += 1
+            return code
+
+    def put(self, signature, code):
+        if not CHART_CACHE_ENABLED:
+            return
+        with self._lock:
+            self._entries.pop(signature, None)
+            self._entries[signature] = code
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def discard(self, signature):
+        # Saved code that didn't produce a chart this time around goes, the LLM gets another go
+        with self._lock:
+            if self._entries.pop(signature, None) is not None:
+                self._stats["stale"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        charts = stats["hits"] + stats["builtin_hits"] + stats["llm_calls"]
+        stats["llm_free_rate"] = round((stats["hits"] + stats["builtin_hits"]) / charts, 3) if charts else 0.0
+        return stats
+
+
+chart_cache = ChartCodeCache()
+
+
+@router.get("/cache/charts")
+async def chart_cache_stats():
+    """Chart code cache hits and misses, built-in renderer hits, and how many charts still needed the LLM"""
+    return chart_cache.stats()
+
+
+@router.delete("/cache/charts")
+async def clear_chart_cache(admin: dict = Depends(require_admin)):
+    chart_cache.clear()
+    return chart_cache.stats()
@@ -0,0 +1,359 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import seaborn as sns
+import base64
+import contextlib
+import io
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from decimation import reduce_figure
+import logs
+
+# Import plotly
+import plotly.graph_objects as go
+import plotly.express as px
+
+# Everything the generated chart code needs, and nothing else. The sandbox workers import this module (and not
+# visualization.py, which pulls in the LLM stack) so a fresh worker only pays for the plotting libraries.
+
+# Built-in renderers (see chart_builtins.py for how a result gets matched to one)
+PIE_MAX_SLICES = 12
+
+log = logs.get_logger('chart')
+
+# How images get saved for the current job, see rendering and chart_store.chart_output
+_output = None
+
+IMAGE_MIMES = {'png': 'image/png', 'webp': 'image/webp', 'svg': 'image/svg+xml'}
+
+
+class Rendering:
+    """One chart job's output settings. mime is what in-memory saves were actually written as (None if there were
+    none), which is what the image gets labelled with instead of the format the code asked for."""
+
+    def __init__(self, output):
+        self.output = output
+        self.mime = None
+
+
+@contextlib.contextmanager
+def rendering(output):
+    """Render one job at the request's size and format.
+
+    Generated code always does savefig(BytesIO, format='png', dpi=300). While the job runs, in-memory saves get the
+    format and DPI from the request instead: just enough pixels for the width the chart is shown at. savefig is only
+    replaced for the length of the job, anything else in the process that saves a figure gets what it asks for.
+    """
+    global _output
+    job = Rendering(output)
+    figure_savefig = matplotlib.figure.Figure.savefig
+
+    def savefig(fig, fname, *args, **kwargs):
+        if output and not isinstance(fname, (str, bytes)) and not hasattr(fname, '__fspath__'):
+            kwargs['format'] = output['format']
+            if output['format'] == 'svg':
+                kwargs.pop('dpi', None)
+            else:
+                dpi = output['pixels'] / max(fig.get_figwidth(), 1)
+                kwargs['dpi'] = min(max(dpi, output['min_dpi']), output['max_dpi'])
+            if output['format'] == 'webp':
+                # Lossless keeps text and thin lines crisp and is still well under the PNG size
+                kwargs.setdefault('pil_kwargs', {'lossless': True, 'method': 4})
+            job.mime = IMAGE_MIMES[output['format']]
+        return figure_savefig(fig, fname, *args, **kwargs)
+
+    _output = output
+    matplotlib.figure.Figure.savefig = savefig
+    try:
+        yield job
+    finally:
+        matplotlib.figure.Figure.savefig = figure_savefig
+        _output = None
+
+
+def _finish(result):
+    # Big plotly traces get cut down to the point budget before they're serialized (see decimation.py)
+    if _output and isinstance(result, dict) and result.get('graphType') == 'plotly' and 'data' in result:
+        reduce_figure(result, _output['point_budget'], _output['max_bins'], _output['typed_arrays'])
+    return result
+
+
+def plotly_to_dict(fig):
+    # this Convert plotly figure to JSON-serializable format
+    # If I directly dumped a plotly figure, it would not be JSON serializable and fail. I had to convert them first. 
+    # I tried using plotly's fig.to_dict() but it did not always work (not sure why), so I added a fallback
+    try:
+        # Use plotly's built-in serialization (works most of the time)
+        fig_dict = fig.to_dict()
+        return {
+            "data": fig_dict.get("data", []),
+            "layout": fig_dict.get("layout", {})
+        }
+    except Exception as e:
+        log.warning("plotly to_dict failed, copying the traces instead: %s", e)
+        # Fallback method
+        return {
+            "data": [dict(trace) for trace in fig.data],
+            "layout": dict(fig.layout)
+        }
+
+
+def execute_chart_code(code, data):
+    # Now that we dynamically generated the code (that generates the chart), we need to execute it safely
+
+    # The generated code is written against a list of row dicts, so that's what it gets
+    if hasattr(data, 'to_pylist'):
+        data = data.to_pylist()
+
+    try:
+        # The shape of the data is what I need to debug the generated code. The rows themselves are patient data
+        # and stay out of the logs.
+        if log.isEnabledFor(logging.DEBUG):
+            keys = list(data[0].keys()) if data and isinstance(data[0], dict) else None
+            log.debug("Chart data: %s with %d items, keys %s", type(data).__name__, len(data or []), keys)
+        
+        # Create safe execution environment with required imports and data
+        safe_globals = {
+            # Core Python
+            '__builtins__': {
+                '__import__': __import__,
+                'len': len,
+                'range': range,
+                'enumerate': enumerate,
+                'zip': zip,
+                'list': list,
+                'dict': dict,
+                'str': str,
+                'int': int,
+                'float': float,
+                'min': min,
+                'max': max,
+                'sum': sum,
+                'sorted': sorted,
+                'abs': abs,
+                'round': round,
+                'tuple': tuple,
+                'print': print,  
+                'type': type,    
+                'isinstance': isinstance, 
+                'set': set,     
+            },
+            
+            # Data processing
+            'json': json,
+            'base64': base64,
+            'io': io,
+            'data': data, 
+            
+            # Visualization libraries
+            'matplotlib': matplotlib,
+            'plt': plt,
+            'seaborn': sns,
+            'sns': sns,
+            
+            # Data libraries
+            'numpy': np,
+            'np': np,
+            'pandas': pd,
+            'pd': pd,
+        }
+        
+        safe_globals.update({
+            'go': go,
+            'px': px,
+            'plotly_to_dict': plotly_to_dict
+        })
+        
+        # Execute the code. One namespace for globals and locals, with separate dicts the generated code's own
+        # functions and comprehensions couldn't see the variables it defined
+        exec(code, safe_globals)
+        
+        # Return the result
+        return _finish(safe_globals.get('result'))
+        
+    except MemoryError:
+        # Let the sandbox see this one, the worker gets replaced
+        raise
+    except Exception as e:
+        log.warning("Error executing chart code: %r", e)
+        return None
+
+def create_fallback_chart():
+    # this is more for debugging purposes, but if for some reason the code generation fails, we can still return a simple chart
+    try:
+        plt.figure(figsize=(10, 6))
+        plt.plot([1, 2, 3, 4], [1, 4, 2, 3], marker='o')
+        plt.title("Fallback Chart - Code Generation Error")
+        plt.xlabel("X Values")
+        plt.ylabel("Y Values")
+        plt.grid(True, alpha=0.3)
+        plt.tight_layout()
+
+        # Convert to base64
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format='png', bbox_inches='tight')
+        buffer.seek(0)
+        image_base64 = base64.b64encode(buffer.read()).decode()
+        plt.close()
+
+        fallback_data = {
+            'type': 'graph',
+            'graphType': 'image',
+            'description': 'Fallback chart due to code generation error',
+            'graphData': {
+                'src': f'data:image/png;base64,{image_base64}',
+                'alt': 'Fallback statistical plot'
+            }
+        }
+        
+        return fallback_data
+        
+    except Exception as e:
+        log.error("Error creating fallback chart: %s", e)
+        return {
+            'type': 'error',
+            'content': 'Failed to generate chart visualization'
+        }
+
+
+# Built-in renderers. These draw the common chart types straight from the Arrow columns, no generated code involved.
+
+
+def _values(table, name):
+    # Plain Python values that survive json.dumps: dates become ISO strings, decimals become floats
+    column = table.column(name)
+    if pa.types.is_temporal(column.type):
+        column = pc.cast(column, pa.string())
+    elif pa.types.is_decimal(column.type):
+        column = pc.cast(column, pa.float64())
+    return column.to_pylist()
+
+
+def _labels(table, name):
+    return ['None' if value is None else str(value) for value in _values(table, name)]
+
+
+def _numbers(table, name):
+    column = table.column(name)
+    if pa.types.is_decimal(column.type) or pa.types.is_integer(column.type):
+        column = pc.cast(column, pa.float64())
+    return column.to_numpy(zero_copy_only=False)
+
+
+def _pie_slices(table, spec):
+    if spec['y']:
+        labels, values = _labels(table, spec['x']), [float(v) for v in np.nan_to_num(_numbers(table, spec['y'][0]))]
+    else:
+        # No value column, count the rows per label
+        counts = pc.value_counts(table.column(spec['x'])).to_pylist()
+        labels = ['None' if item['values'] is None else str(item['values']) for item in counts]
+        values = [item['counts'] for item in counts]
+    slices = sorted(zip(values, labels), reverse=True)
+    if len(slices) > PIE_MAX_SLICES:
+        other = sum(value for value, _ in slices[PIE_MAX_SLICES - 1:])
+        slices = slices[:PIE_MAX_SLICES - 1] + [(other, 'Other')]
+    return [label for _, label in slices], [value for value, _ in slices]
+
+
+def _render_plotly(table, spec):
+    kind = spec['kind']
+    fig = go.Figure()
+    if kind == 'pie':
+        labels, values = _pie_slices(table, spec)
+        fig.add_trace(go.Pie(labels=labels, values=values))
+    elif kind == 'histogram':
+        fig.add_trace(go.Histogram(x=_values(table, spec['x']), name=spec['x']))
+    else:
+        x = _labels(table, spec['x']) if kind == 'bar' else _values(table, spec['x'])
+        for name in spec['y']:
+            y = _values(table, name)
+            if kind == 'bar':
+                fig.add_trace(go.Bar(x=x, y=y, name=name))
+            elif kind == 'line':
+                fig.add_trace(go.Scatter(x=x, y=y, name=name, mode='lines+markers'))
+            else:
+                fig.add_trace(go.Scatter(x=x, y=y, name=name, mode='markers'))
+    fig.update_layout(
+        title=spec['title'], xaxis_title=spec.get('x_label'), yaxis_title=spec.get('y_label'),
+        barmode='group', showlegend=kind == 'pie' or len(spec['y']) > 1,
+    )
+    plot_data = plotly_to_dict(fig)
+    return {"graphType": "plotly", "data": plot_data["data"], "layout": plot_data["layout"]}
+
+
+def _render_matplotlib(table, spec):
+    kind = spec['kind']
+    style = sns.axes_style('whitegrid') if spec['library'] == 'seaborn' else plt.rc_context()
+    with style:
+        fig, ax = plt.subplots(figsize=(12, 8))
+        try:
+            if kind == 'pie':
+                labels, values = _pie_slices(table, spec)
+                ax.pie(values, labels=labels, autopct='%1.1f%%', colors=sns.color_palette(n_colors=len(values)))
+                ax.axis('equal')
+            elif kind == 'histogram':
+                values = _numbers(table, spec['x'])
+                ax.hist(values[~np.isnan(values)], bins='auto')
+            elif kind == 'bar':
+                labels = _labels(table, spec['x'])
+                positions = np.arange(len(labels))
+                width = 0.8 / len(spec['y'])
+                for i, name in enumerate(spec['y']):
+                    ax.bar(positions + i * width - 0.4 + width / 2, _numbers(table, name), width, label=name)
+                ax.set_xticks(positions)
+                ax.set_xticklabels(labels, rotation=45, ha='right')
+            else:
+                x = _values(table, spec['x'])
+                if spec.get('x_temporal'):
+                    x = pd.to_datetime(x)
+                for name in spec['y']:
+                    if kind == 'line':
+                        ax.plot(x, _numbers(table, name), marker='o', label=name)
+                    else:
+                        ax.scatter(x, _numbers(table, name), alpha=0.7, label=name)
+            ax.set_title(spec['title'])
+            if kind != 'pie':
+                ax.set_xlabel(spec.get('x_label') or '')
+                ax.set_ylabel(spec.get('y_label') or '')
+            if len(spec['y']) > 1:
+                ax.legend()
+            fig.tight_layout()
+
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format='png', bbox_inches='tight')
+        finally:
+            plt.close(fig)
+    image_base64 = base64.b64encode(buffer.getvalue()).decode()
+    return {"graphType": "image", "src": f"data:image/png;base64,{image_base64}", "alt": spec['title']}
+
+
+def render_builtin(spec, table):
+    """Draw one of the built-in chart types described by a chart_builtins spec from an Arrow table"""
+    if spec.get('sort'):
+        table = table.sort_by([(spec['x'], 'ascending')])
+    try:
+        if spec['library'] == 'plotly':
+            return _finish(_render_plotly(table, spec))
+        return _render_matplotlib(table, spec)
+    except MemoryError:
+        raise
+    except Exception as e:
+        log.warning("Error in built-in %s renderer: %r", spec['kind'], e)
+        return None
+
+
+def warm_up():
+    # The first figure in a process pays for font cache loading, backend setup and plotly's validators.
+    # Workers do it once at startup so the first real job doesn't.
+    fig, ax = plt.subplots(figsize=(2, 2))
+    ax.plot([0, 1], [0, 1])
+    fig.savefig(io.BytesIO(), format='png', dpi=50)
+    fig.savefig(io.BytesIO(), format='webp', dpi=50)
+    plt.close(fig)
+    px.bar(pd.DataFrame({'x': ['a'], 'y': [1]}), x='x', y='y').to_dict()
+    sns.color_palette()
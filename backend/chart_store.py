@@ -0,0 +1,236 @@
+import base64
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from fastapi import APIRouter, Header, HTTPException, Response
+from executors import run_blocking
+import logs
+from settings import (
+    CHART_IMAGE_FORMAT,
+    CHART_DISPLAY_WIDTH,
+    CHART_PIXEL_RATIO,
+    CHART_MIN_DPI,
+    CHART_MAX_DPI,
+    CHART_STORE_MAX_BYTES,
+    CHART_STORE_DIR,
+    CHART_STORE_DISK_MAX_BYTES,
+    CHART_POINT_BUDGET,
+    CHART_HISTOGRAM_MAX_BINS,
+    CHART_TYPED_ARRAYS,
+)
+
+# Image charts used to be 300 DPI PNGs, base64 encoded into a single SSE line (several MB for one event). Now they're
+# rendered at the size they'll be displayed, in a smaller format, and kept here under the hash of their bytes. The
+# stream only carries the hash, and the browser fetches /api/charts/<hash> like any other image. Same bytes, same
+# URL, so it can be cached forever.
+
+router = APIRouter()
+
+log = logs.get_logger('chart')
+
+IMAGE_FORMATS = {'png': 'image/png', 'webp': 'image/webp', 'svg': 'image/svg+xml'}
+
+CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+# File extensions for the disk tier, which is how a file's MIME type survives without anything else stored with it
+EXTENSIONS = {'image/png': 'png', 'image/webp': 'webp', 'image/svg+xml': 'svg', 'image/jpeg': 'jpg'}
+MIME_TYPES = {extension: mime for mime, extension in EXTENSIONS.items()}
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+def chart_output(display_width=None, pixel_ratio=None, image_format=None):
+    """How the sandbox should output charts for this request (image size and format, plotly point budget)"""
+    image_format = (image_format or CHART_IMAGE_FORMAT).lower()
+    if image_format not in IMAGE_FORMATS:
+        image_format = CHART_IMAGE_FORMAT if CHART_IMAGE_FORMAT in IMAGE_FORMATS else 'png'
+    width = min(max(int(display_width or CHART_DISPLAY_WIDTH), 200), 4000)
+    ratio = min(max(float(pixel_ratio or CHART_PIXEL_RATIO), 1.0), 4.0)
+    return {
+        'format': image_format,
+        'pixels': int(width * ratio),
+        'min_dpi': CHART_MIN_DPI,
+        'max_dpi': CHART_MAX_DPI,
+        'point_budget': CHART_POINT_BUDGET,
+        'max_bins': CHART_HISTOGRAM_MAX_BINS,
+        'typed_arrays': CHART_TYPED_ARRAYS,
+    }
+
+
+def sniff_mime(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if b'<svg' in data[:1024]:
+        return 'image/svg+xml'
+    return None
+
+
+class ChartStore:
+    def __init__(self, max_bytes=CHART_STORE_MAX_BYTES, disk_dir=CHART_STORE_DIR,
+                 disk_max_bytes=CHART_STORE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"stored": 0, "duplicates": 0, "served": 0, "not_modified": 0, "evictions": 0, "disk_hits": 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def put(self, data, mime):
+        """Keep the image, returns its digest. Blocking when there's a disk tier."""
+        digest = hashlib.sha256(data).hexdigest()
+        if self._put_memory(digest, data, mime):
+            self._put_disk(digest, data, mime)
+        return digest
+
+    def _put_memory(self, digest, data, mime):
+        # False if it was already here
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                self._stats["duplicates"] += 1
+                return False
+            self._entries[digest] = (data, mime)
+            self._bytes += len(data)
+            self._stats["stored"] += 1
+            # Oldest charts go first, the browser has most likely cached them by now
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats["evictions"] += 1
+        return True
+
+    def get(self, digest):
+        """(data, mime) from memory, None if this process doesn't have it (see get_disk)"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+            return entry
+
+    # Disk tier (blocking, call through run_blocking). Shared by every worker process that points at the same folder.
+
+    def _disk_path(self, digest, mime):
+        return os.path.join(self.disk_dir, f"{digest}.{EXTENSIONS.get(mime, 'bin')}")
+
+    def _put_disk(self, digest, data, mime):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(digest, mime)
+        if os.path.exists(path):
+            return
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            # The memory tier still has it, this process can serve it
+            log.warning("Error writing chart %s: %s", path, e)
+            self._remove_file(temp_path)
+            return
+        self._trim_disk()
+
+    def get_disk(self, digest):
+        if not self.disk_dir or not _DIGEST.fullmatch(digest):
+            return None
+        for extension, mime in list(MIME_TYPES.items()) + [('bin', 'application/octet-stream')]:
+            try:
+                with open(os.path.join(self.disk_dir, f"{digest}.{extension}"), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            self.count("disk_hits")
+            self._put_memory(digest, data, mime)
+            return data, mime
+        return None
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.tmp'):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_file(path)
+            total -= size
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def reference(self, target, data, mime=None):
+        """Store image bytes and point a chart's graphData at them instead of inlining them"""
+        mime = mime or sniff_mime(data) or 'application/octet-stream'
+        digest = self.put(data, mime)
+        target['src'] = f"/api/charts/{digest}"
+        target['chartId'] = digest
+        target['mimeType'] = mime
+        target['bytes'] = len(data)
+        return target
+
+    def externalize(self, result, mime=None):
+        # Charts that still come back with a data: URI (older generated code, the thread fallback) get moved here too.
+        # mime is what the image was actually saved as, when that's known.
+        if not isinstance(result, dict):
+            return result
+        target = result.get('graphData') if isinstance(result.get('graphData'), dict) else result
+        src = target.get('src')
+        if isinstance(src, str) and src.startswith('data:image/') and ';base64,' in src:
+            header, encoded = src.split(',', 1)
+            data = base64.b64decode(encoded)
+            if data:
+                self.reference(target, data, mime or header[len('data:'):].split(';')[0])
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        stats["max_bytes"] = self.max_bytes
+        stats["disk_dir"] = self.disk_dir or None
+        return stats
+
+
+chart_store = ChartStore()
+
+
+@router.get("/charts/{digest}")
+async def get_chart(digest: str, if_none_match: str = Header(None)):
+    """A rendered chart image. The URL is the hash of the bytes, so it never changes."""
+    etag = f'"{digest}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        chart_store.count("not_modified")
+        return Response(status_code=304, headers={"ETag": etag, **CACHE_HEADERS})
+    entry = chart_store.get(digest)
+    if entry is None and chart_store.disk_dir:
+        # Rendered by another worker process, or before a restart
+        entry = await run_blocking(chart_store.get_disk, digest)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Chart not found")
+    data, mime = entry
+    chart_store.count("served")
+    return Response(content=data, media_type=mime, headers={"ETag": etag, **CACHE_HEADERS})
@@ -1,113 +1,318 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from typing import Optional
 import asyncio
-import json
+import hashlib
 import random
-import os
-from langchain_anthropic import ChatAnthropic
-from google.cloud import bigquery
+import time
 from visualization import generate_chart_data
-
-# I can add any dataset names to this list and the tool will automatically analyze them to see if they can be used to answer questions
-DATASETS = 'physionet-data:mimiciv_3_1_icu','physionet-data:mimiciv_3_1_hosp'
-
-# Since this is my personal anthropic api key, I don't want to share it... I may add some logic to test and see if the key is not null 
-# before starting. This will ensure someone does not accidently run it without a key. 
-ANTHROPIC_API_KEY = "Add your own key here"
+from llm import get_llm, connection_stats
+from schema_catalog import catalog, ensure_loaded
+from schema_index import select_schema
+from result_cache import result_cache, cache_key
+from plan_cache import plan_cache, normalize_question
+from chart_store import chart_output
+import sse
+import logs
+import metrics
+from ingestion import stream_query
+from governor import governor, GovernedQuery, format_bytes
+from security import user_from_token
+from sql_validator import validate_sql, repair_sql
+from engines import QueryError
+from query_result import QueryResult
+from single_flight import SingleFlight
+from scheduler import scheduler, retry_rate_limited, set_user, Saturated
+from plan_stream import PlanParser, add_usage, chunk_text, split_plan
+from sessions import session_store, new_turn, Turn
+from settings import (
+    AI_MODEL, ANTHROPIC_API_KEY, DATASETS, SQL_VALIDATION_ENABLED, SQL_REPAIR_ATTEMPTS, SSE_HEARTBEAT_SECONDS,
+    COALESCE_ENABLED,
+)
 
 # Extra charting tools can be added here
 CHART_LIBRARIES = ['plotly', 'chartjs', 'matplotlib', 'seaborn']
-os.environ["ANTHROPIC_API_KEY"] = ANTHROPIC_API_KEY
 
-AI_MODEL = "claude-3-7-sonnet-20250219"
+# The prompts live up here so the plan cache can tell when one of them changes
+CHART_PROMPT_TEMPLATE = """
+    Analyze the following user message to determine if they are requesting any kind of chart, graph, or visualization.
+
+    User Message: "{message}"
+
+    Available chart libraries: {chart_libraries}
+
+    Instructions:
+    1. If the user is requesting a chart, graph, plot, or any visualization, choose the most appropriate library from the available options
+    2. Also specify what type of chart would be best (e.g., "bar chart", "line graph", "scatter plot", "pie chart", etc.)
+    3. If no visualization is requested, return "NONE" for both library and chart
+    4. If a visualization is requested but none of the available libraries are suitable, return "NONE" for library and "No good options" for chart
+
+    Respond in this exact format:
+    LIBRARY: [library name or NONE]
+    CHART: [chart type or NONE or "No good options"]
+    """
+
+ANSWER_PROMPT_TEMPLATE = """
+        You are a data analyst examining which BigQuery database (if any) can best answer a specific question.
+
+        Question: {question}
+
+        {schemas}
+
+        Based on the available tables and columns across all databases, can any of these databases answer the question?
+
+        Respond with:
+        1. YES or NO
+        2. Explanation of your reasoning
+        3. If YES, which database and tables/columns would be needed
+        4. If NO, what data is missing
+        5. If able, build a SQL query that can be used in bigquery to answer the question.
+
+        Format your response as:
+        
+        ANSWER: [YES/NO]
+        
+        DATABASE: [Which database from the available ones]
+        
+        REASONING: [Your explanation]
+        
+        REQUIRED_DATA: [Tables and columns needed, or what's missing]
+
+        SQL QUERY:
+
+        """
+
+# Saved plans are only good for the exact prompts and model that produced them
+PROMPT_FINGERPRINT = hashlib.sha256(
+    "\n".join([AI_MODEL, ', '.join(CHART_LIBRARIES), CHART_PROMPT_TEMPLATE, ANSWER_PROMPT_TEMPLATE]).encode('utf-8')
+).hexdigest()[:16]
 
 # Create router for chat endpoints
 router = APIRouter()
 
+log = logs.get_logger('chat')
+
+# Identical chats and identical queries that are running at the same time are only run once (see single_flight.py)
+chat_flights = SingleFlight('chat')
+query_flights = SingleFlight('query')
+
 # Pydantic models
 class ChatMessage(BaseModel):
     message: str
+    # Where the chart will be shown, so images are rendered at the size they're displayed (see chart_store.py)
+    chart_width: Optional[int] = None
+    pixel_ratio: Optional[float] = None
+    image_format: Optional[str] = None
 
 class ChatResponse(BaseModel):
     response: str
 
 
 @router.post("/chat")
-async def chat_message(chat_message: ChatMessage):
+async def chat_message(chat_message: ChatMessage, authorization: Optional[str] = Header(None)):
     """Send a chat message and receive a streaming response"""
+    # Scan budgets are per user (see governor.py). Chat still works without logging in, those share one budget.
+    token = authorization[len("Bearer "):] if authorization and authorization.startswith("Bearer ") else None
+    user = user_from_token(token)
+    username = user["username"] if user else None
+
+    # Every log line for this chat carries this id (see logs.py), it's also sent back in X-Request-ID
+    request_id = logs.new_request()
+    # Every stage below is timed into this (see metrics.py), it goes out as the last event
+    trace = metrics.start_trace()
+
+    # LLM, query and chart slots are shared out per user (see scheduler.py). A chat that would only wait in an
+    # overflowing line is turned away now, with a real 429 instead of an error event halfway through the stream.
+    set_user(username)
+    try:
+        end_chat = scheduler.admit(username)
+    except Saturated as e:
+        log.warning("Turned a chat away: %s", e)
+        metrics.finish_trace(trace, 'rejected')
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    # A follow-up to the last answer in this login's session ("now as a pie chart", "only 2150-2160") can often be
+    # answered from the rows we already have, see sessions.py. None for a new question.
+    followup = session_store.followup(token, chat_message.message)
+    # Charts of the old rows and local filters skip the LLM plan and the query entirely
+    local = followup is not None and followup.kind in ('visualize', 'filter')
+    # Anything else about the last answer goes to the LLM with that answer's question and SQL as context
+    question = followup.contextual_question(chat_message.message) if followup and not local else chat_message.message
 
     async def generate_chat_stream():
         """Generator function to stream chat responses"""
+        # Everything the client sees goes through here, answer_question and generate_plan yield plain event dicts
+        events = sse.EventStream()
+        chart_task = None
+        outcome = 'disconnected'
         try:
              # Update 1: Send working message (one of a few random messages just to keep it interesting)
-            validation_message = working_message(chat_message.message)
-            yield f"data: {json.dumps({'type': 'message', 'content': validation_message})}\n\n"
-            
+            with metrics.span('working_message'):
+                validation_message = working_message(chat_message.message)
+            yield events.encode(sse.message(validation_message))
             
-            # Determine if the message needs a chart and if so, which kind
-            yield f"data: {json.dumps({'type': 'message', 'content': 'Checking for visualization options...'})}\n\n"
-            chart_analysis = check_for_chart(chat_message.message)
             
-            # Now we know what kind of chart to use (if any)
-            if chart_analysis["library"] != "NONE":
-                if chart_analysis["chart"] == "No good options":
-                    yield f"data: {json.dumps({'type': 'message', 'content': 'Visualization requested but no suitable options available.'})}\n\n"
-                else:
-                    viz_message = f'I picked a chart type: {chart_analysis["chart"]} using {chart_analysis["library"]}'
-                    yield f"data: {json.dumps({'type': 'message', 'content': viz_message})}\n\n"
+            # If we've answered this question before (against the same schema and prompts), reuse the plan and
+            # skip both LLM calls
+            plan = None
+            if not local:
+                with metrics.span('plan_cache'):
+                    await ensure_loaded(DATASETS)
+                    plan_version = current_plan_version()
+                    plan = plan_cache.get(question, plan_version)
+            if plan:
+                yield events.encode(sse.message('I have answered this question before, reusing that plan.'))
+                chart_task = asyncio.get_running_loop().create_future()
+                chart_task.set_result(plan.chart_analysis)
+            elif followup is not None and not followup.mentions_chart:
+                # "only 2150-2160" wants the same chart as before, of fewer rows
+                chart_task = asyncio.get_running_loop().create_future()
+                chart_task.set_result(followup.turn.chart_analysis)
             else:
-                yield f"data: {json.dumps({'type': 'message', 'content': 'No visualization requested.'})}\n\n"
-
+                # Determine if the message needs a chart and if so, which kind. The chart check and the schema/SQL
+                # analysis don't depend on each other, so the chart check runs as its own task alongside answer_question
+                yield events.encode(sse.message('Checking for visualization options...'))
+                chart_task = asyncio.create_task(check_for_chart(chat_message.message))
+            chart_reported = False
             
             # Process the question and stream status updates
             query_results = None
             sql_query = None
             response_content = None
             
-            async for message_or_result in answer_question(chat_message.message, ANTHROPIC_API_KEY):
+            if local:
+                answer = reuse_result(followup)
+            else:
+                answer = answer_question(question, ANTHROPIC_API_KEY, plan, username)
+            async for message_or_result in answer:
                 # Check if this is the final return value (tuple with FINAL_RESULT marker) or a streaming message
                 if isinstance(message_or_result, tuple) and message_or_result[0] == 'FINAL_RESULT':
                     _, response_content, sql_query, query_results = message_or_result
                     break
                 else:
-                    yield message_or_result
+                    yield events.encode(message_or_result)
+                
+                # If the chart check finished while we were working, let the user know which chart we picked
+                if not chart_reported and chart_task.done():
+                    chart_reported = True
+                    yield events.encode(sse.message(chart_choice_message(chart_task.result())))
             # At this point, we now know if we can answer the question, but we still have raw query results to process
             # Now the hard part, we need to convert the data to the right "format" for the charting library
 
+            # This is the first point where we actually need the chart analysis
+            chart_analysis = await chart_task
+            if not chart_reported:
+                yield events.encode(sse.message(chart_choice_message(chart_analysis)))
+
+            # The query ran, so this plan is worth keeping for next time
+            if not plan and not local and sql_query and query_results is not None:
+                plan_cache.put(question, response_content, sql_query, chart_analysis, plan_version)
+
             # Generate chart if we have query results
-            yield f"data: {json.dumps({'type': 'message', 'content': 'Converting the data and building the chart....'})}\n\n"
+            yield events.encode(sse.message('Converting the data and building the chart....'))
 
             #Note: generate_chart_data is a function that takes the query results and the chart analysis to create the chart data
             # It's found int he visualization.py module. 
-            chart_data = generate_chart_data(query_results, chart_analysis, chat_message.message)  
-            yield f"data: {json.dumps(chart_data)}\n\n"
+            output = chart_output(chat_message.chart_width, chat_message.pixel_ratio, chat_message.image_format)
+            chart_slot = scheduler.chart.slot()
+            async for event in chart_slot.wait():
+                yield events.encode(event)
+            try:
+                chart_data = await generate_chart_data(query_results, chart_analysis, chat_message.message, output)
+            finally:
+                chart_slot.release()
+            with metrics.span('serialize'):
+                chart_event = events.encode(chart_data)
+            yield chart_event
             
             # Final completion signal
-            await asyncio.sleep(1)
-            yield f"data: {json.dumps({'type': 'message', 'content': 'Processing complete!'})}\n\n"
+            yield events.encode(sse.message('Processing complete!'))
+            outcome = 'ok'
+
+            # Not an event: session_chat_stream keeps it in the session for the next follow-up
+            if query_results is not None:
+                session_question = followup.question(chat_message.message) if followup else chat_message.message
+                yield new_turn(session_question, response_content, sql_query, query_results, chart_analysis)
 
         except Exception as e:
             # Send error in stream format
-            print(f"Error during chat processing: {str(e)}")
+            log.exception("Error during chat processing")
             error_data = {
                 'type': 'error',
-                'message': f"Error: {str(e)}"
+                'message': f"Error: {str(e)}",
+                # So a user's report can be matched to the server logs
+                'request_id': request_id
             }
-            yield f"data: {json.dumps(error_data)}\n\n"
+            outcome = 'error'
+            yield events.encode(error_data)
+        finally:
+            # Don't leave the chart check running if the answer failed or the client went away
+            if chart_task is not None and not chart_task.done():
+                chart_task.cancel()
+            metrics.finish_trace(trace, outcome)
+
+        # Headers are long gone by now, so the breakdown that would have gone in Server-Timing comes as an event
+        yield events.encode(trace.event())
+
+    async def session_chat_stream():
+        # Someone asking the same thing right now gets to watch our answer being made, and we get theirs. Whoever
+        # started it owns the events (request id, timing), this request's trace only records that it joined.
+        # Everyone watching keeps the answer in their own session.
+        if COALESCE_ENABLED:
+            chunks = chat_flights.run(chat_flight_key(chat_message, followup), generate_chat_stream)
+        else:
+            chunks = generate_chat_stream()
+        outcome = 'disconnected'
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, Turn):
+                    session_store.remember(token, chunk)
+                    continue
+                yield chunk
+            outcome = 'coalesced'
+        finally:
+            # The chat counts against the user's limit until its stream is over, however it ends
+            end_chat()
+            # A no-op when this request ran the pipeline itself, that already finished the trace
+            metrics.finish_trace(trace, outcome)
 
     # I need to stream otherwise the "chain of though" messages will all appear at once. I want the tool to 
     # keep the user up to speed on what is going on behind the scenes. 
+    # Starlette cancels the response when the client disconnects. keep_alive passes that on to the pipeline,
+    # and sends comments while a slow stage has nothing to say so proxies don't close the connection on us.
     return StreamingResponse(
-        generate_chat_stream(),
-        media_type="text/plain",
+        sse.keep_alive(session_chat_stream(), SSE_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
+            "X-Request-ID": request_id,
             "Connection": "keep-alive",
-            "Content-Type": "text/event-stream"
+            # Don't let nginx hold events back to fill its buffer
+            "X-Accel-Buffering": "no"
         }
     )
 
+@router.get("/llm/connections")
+async def llm_connections():
+    """Connection reuse counters for the shared LLM client pool"""
+    return connection_stats()
+
+@router.get("/chat/in-flight")
+async def in_flight():
+    """How many chats and queries are running, and how many requests joined one instead of starting their own"""
+    return {'chats': chat_flights.stats(), 'queries': query_flights.stats()}
+
+def chat_flight_key(chat_message, followup=None):
+    # Same question (as the plan cache sees it) and the same chart output, or the answers would differ. A follow-up
+    # only means the same thing to the same earlier answer.
+    return (normalize_question(chat_message.message), chat_message.chart_width, chat_message.pixel_ratio,
+            chat_message.image_format, followup.key if followup else None)
+
+def current_plan_version():
+    # Saved plans go stale when the schema catalog reloads or a prompt changes
+    return f"{catalog.version}:{PROMPT_FINGERPRINT}"
+
 # Helper functions that simulate real processing steps
 def working_message(message: str) -> str:
     # Send one of several possible responses that tells the user that the message is being processed
@@ -128,39 +333,31 @@ def working_message(message: str) -> str:
     
     return random.choice(messages)
 
-def check_for_chart(message: str):
+def chart_choice_message(chart_analysis):
+    # Now we know what kind of chart to use (if any)
+    if chart_analysis["library"] != "NONE":
+        if chart_analysis["chart"] == "No good options":
+            return 'Visualization requested but no suitable options available.'
+        return f'I picked a chart type: {chart_analysis["chart"]} using {chart_analysis["library"]}'
+    return 'No visualization requested.'
+
+async def check_for_chart(message: str):
     #Analyze the message to determine if a chart/visualization is requested
     
     # Set up the prompt for chart analysis
-    prompt = f"""
-    Analyze the following user message to determine if they are requesting any kind of chart, graph, or visualization.
-
-    User Message: "{message}"
-
-    Available chart libraries: {', '.join(CHART_LIBRARIES)}
-
-    Instructions:
-    1. If the user is requesting a chart, graph, plot, or any visualization, choose the most appropriate library from the available options
-    2. Also specify what type of chart would be best (e.g., "bar chart", "line graph", "scatter plot", "pie chart", etc.)
-    3. If no visualization is requested, return "NONE" for both library and chart
-    4. If a visualization is requested but none of the available libraries are suitable, return "NONE" for library and "No good options" for chart
-
-    Respond in this exact format:
-    LIBRARY: [library name or NONE]
-    CHART: [chart type or NONE or "No good options"]
-    """
+    prompt = CHART_PROMPT_TEMPLATE.format(message=message, chart_libraries=', '.join(CHART_LIBRARIES))
     
     try:
-        # Initialize Claude LLM
-        llm = ChatAnthropic(
-            model=AI_MODEL,
-            temperature=0
-        )
+        # Shared Claude model (pooled connections, see llm.py)
+        llm = get_llm()
         
-        # Get response from LLM
-        response = llm.invoke(prompt)
+        # Get response from LLM (ainvoke so we don't block the event loop while Claude thinks)
+        async with scheduler.llm.hold():
+            with metrics.span('chart_check'):
+                response = await retry_rate_limited(llm.ainvoke, prompt)
+        metrics.record_llm('chart_check', response)
         response_content = response.content
-        print(f"LLM Response: {response_content}")
+        logs.debug_dump(log, "Chart check response", str, response_content)
 
         library = "NONE"
         chart = "NONE"
@@ -177,185 +374,274 @@ def check_for_chart(message: str):
         return {"library": library, "chart": chart}
         
     except Exception as e:
-        print(f"Error in check_for_chart: {e}")
+        log.warning("Error in check_for_chart: %s", e)
         return {"library": "NONE", "chart": "NONE"}
 
-def format_schema_for_prompt(schema_info):
-        #Format schema information for the LLM prompt, this just makes it easier for the LLM to read and understand
-        schema_text = "Available BigQuery tables and columns:\n\n"
-        
-        for table_name, table_info in schema_info.items():
-            schema_text += f"Table: {table_name}\n"
-            schema_text += f"Description: {table_info['description']}\n"
-            schema_text += f"Rows: {table_info['num_rows']:,}\n"
-            schema_text += "Columns:\n"
-            
-            for col in table_info['columns']:
-                schema_text += f"  - {col['name']} ({col['type']}): {col['description']}\n"
-            
-            schema_text += "\n"
-        
-        return schema_text
-
-def get_schema(project_id, dataset_id):
-    """Get schema information from BigQuery dataset (non-streaming version)"""
+async def generate_plan(question):
+    # Ask the LLM whether the question can be answered and for the SQL to do it. Yields status messages,
+    # then finishes with a (response_content, sql_query) tuple.
     
-    # First, check if a local schema file exists
-    schema_filename = f'{dataset_id}_schema.json'
-    if os.path.exists(schema_filename):
-        try:
-            with open(schema_filename, 'r') as f:
-                schema_info = json.load(f)
-            return schema_info
-        except Exception as e:
-            print(f"Error reading local schema file: {e}")
-            print("Falling back to BigQuery API...")
+    yield sse.message(f'Analyzing schemas to determine best dataset...')
+        
+    # Get schemas for all datasets. The catalog already has the prompt text built, so this is just a lookup.
+    # Right now I'm just supporting bigQuery, but in the future, adding additional technologies should be easy
+    with metrics.span('schema'):
+        await ensure_loaded(DATASETS)
+        # Only send the tables this question actually needs (falls back to everything when the index isn't sure)
+        schema_selection = select_schema(question, DATASETS)
+    all_schemas_text = schema_selection.prompt_text
+    if schema_selection.pruned:
+        table_list = ', '.join(table for _, table in schema_selection.tables)
+        yield sse.message(f'Focusing on tables: {table_list}')
     
-    # If no local file exists or there was an error, query BigQuery
-    try:
-        # Use the client without specifying credentials - it will use the environment variable
-        client = bigquery.Client(project=project_id)
-        print(f"Successfully connected to BigQuery project: {client.project}")
-    except Exception as e:
-        print(f"Failed to create BigQuery client: {e}")
-        raise
-    dataset_ref = client.dataset(dataset_id)
+   
+    # Create prompt to analyze the question and compare to schemas. This will tell us if the LLM can 
+    # build SQL to answer the question. 
+    prompt = ANSWER_PROMPT_TEMPLATE.format(question=question, schemas=all_schemas_text)
     
-    schema_info = {}
-    tables = client.list_tables(dataset_ref)
+    # Shared Claude model (pooled connections, see llm.py)
+    llm = get_llm()
     
-    for table in tables:
-        table_ref = dataset_ref.table(table.table_id)
-        table_obj = client.get_table(table_ref)
-        
-        # Get column information
-        columns = []
-        for field in table_obj.schema:
-            columns.append({
-                'name': field.name,
-                'type': field.field_type,
-                'description': field.description or 'No description'
-            })
-        
-        schema_info[table.table_id] = {
-            'columns': columns,
-            'description': table_obj.description or 'No description',
-            'num_rows': table_obj.num_rows
-        }
+    # Our turn with the LLM, with the place in line meanwhile if it's busy (see scheduler.py)
+    slot = scheduler.llm.slot()
+    async for event in slot.wait():
+        yield event
+    handed_over = False
+    try:
+        # Stream the answer so the reasoning shows up while it's being written, and the query can start as soon as
+        # the SQL block closes instead of after the LLM's closing remarks (see plan_stream.py)
+        parser = PlanParser()
+        usage = {}
+        started = time.perf_counter()
+        stream = await retry_rate_limited(_open_stream, llm, prompt)
+        async for chunk in stream:
+            add_usage(usage, chunk)
+            update = parser.feed(chunk_text(chunk))
+            if update.reasoning:
+                yield sse.reasoning(update.reasoning)
+            if update.verdict:
+                log.debug("Plan verdict %s after %.2fs", update.verdict, time.perf_counter() - started)
+            if update.sql:
+                metrics.observe('sql_generation', time.perf_counter() - started)
+                handed_over = True
+                yield PendingPlan(parser, stream, usage, slot)
+                return
+    finally:
+        if not handed_over:
+            slot.release()
+    metrics.observe('sql_generation', time.perf_counter() - started)
+    metrics.record_tokens('sql_generation', usage.get('input_tokens', 0), usage.get('output_tokens', 0))
+    response_content, sql_query = parser.finish()
+    logs.debug_dump(log, "Plan response", str, parser.text)
     
-    # Save schema_info to a file, this will allow us to use the schema in the future without having to query BigQuery again
-    with open(f'{dataset_id}_schema.json', 'w') as f:
-        json.dump(schema_info, f, indent=2)
-    print(f"Schema information saved to {dataset_id}_schema.json, will be used for future queries.")
+    yield (response_content, sql_query)
 
-    return schema_info
+async def _open_stream(llm, prompt):
+    # A rate limit shows up on the first chunk, so that's the part worth retrying. Returns the whole stream.
+    stream = llm.astream(prompt).__aiter__()
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def chunks():
+        if first is not None:
+            yield first
+        async for chunk in stream:
+            yield chunk
+    return chunks()
+
+class PendingPlan:
+    """A plan whose SQL is in while the LLM is still writing the rest. The rest is read in the background."""
+
+    def __init__(self, parser, stream, usage, slot):
+        self.sql_query = parser.sql
+        # What the user sees now, the rest of the text follows once it's there
+        self.head = split_plan(parser.text[:parser.sql_end])[0]
+        self._task = asyncio.create_task(self._read_rest(parser, stream, usage))
+        # The LLM slot is ours until the stream is done, however that happens
+        self._task.add_done_callback(lambda _: slot.release())
+
+    @staticmethod
+    async def _read_rest(parser, stream, usage):
+        async for chunk in stream:
+            add_usage(usage, chunk)
+            parser.feed(chunk_text(chunk))
+        metrics.record_tokens('sql_generation', usage.get('input_tokens', 0), usage.get('output_tokens', 0))
+        logs.debug_dump(log, "Plan response", str, parser.text)
+        return parser.finish()[0]
+
+    async def response_content(self):
+        """The whole response minus the SQL, or what we had when the SQL came in if the stream broke after it"""
+        try:
+            return await self._task
+        except Exception as e:
+            log.warning("Lost the end of the plan response: %s", e)
+            return self.head
 
+    def cancel(self):
+        self._task.cancel()
 
-async def answer_question(question, anthropic_api_key):
+async def answer_question(question, anthropic_api_key, plan=None, user=None):
     #Determine if BigQuery databases can answer the given question (streaming version)
     
     # Set Anthropic API key
     #os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
     
-    # Get schemas for all datasets 
-    all_schemas_text = "Database Schemas:\n\n"
-
-    yield f"data: {json.dumps({'type': 'message', 'content': f'Analyzing schemas to determine best dataset...'})}\n\n"
-        
-    # Right now I'm just supporting bigQuery, but in the future, adding additional technologies should be easy
-    for dataset_full_name in DATASETS:
-        project_id, dataset_id = dataset_full_name.split(':')
-        
-        schema_info = get_schema(project_id, dataset_id)
-        schema_text = format_schema_for_prompt(schema_info)
-        
-        all_schemas_text += f"=== {dataset_full_name} ===\n"
-        all_schemas_text += schema_text
-        all_schemas_text += "\n"
-    
-   
-    # Create prompt to analyze the question and compare to schemas. This will tell us if the LLM can 
-    # build SQL to answer the question. 
-    prompt = f"""
-        You are a data analyst examining which BigQuery database (if any) can best answer a specific question.
-
-        Question: {question}
-
-        {all_schemas_text}
-
-        Based on the available tables and columns across all databases, can any of these databases answer the question?
-
-        Respond with:
-        1. YES or NO
-        2. Explanation of your reasoning
-        3. If YES, which database and tables/columns would be needed
-        4. If NO, what data is missing
-        5. If able, build a SQL query that can be used in bigquery to answer the question.
-
-        Format your response as:
-        
-        ANSWER: [YES/NO]
-        
-        DATABASE: [Which database from the available ones]
-        
-        REASONING: [Your explanation]
-        
-        REQUIRED_DATA: [Tables and columns needed, or what's missing]
-
-        SQL QUERY:
-
-        """
-    
-    # Initialize Claude LLM
-    llm = ChatAnthropic(
-        model=AI_MODEL,
-        #model="claude-sonnet-4-20250514",
-        temperature=0
-    )
-    
-    # Create and run the prompt
-    response = llm.invoke(prompt)
-    
-    # Extract SQL if the answer is YES
-    sql_query = None
-    response_content = response.content
-    
-    if "ANSWER: YES" in response_content:
-        # Look for SQL statement between triple quotes
-        import re
-        sql_pattern = r"```(?:sql)?\s*(.*?)\s*```"
-        sql_match = re.search(sql_pattern, response_content, re.DOTALL | re.IGNORECASE)
-        if sql_match:
-            sql_query = sql_match.group(1).strip()
-            # Remove the SQL block from the response
-            response_content = re.sub(sql_pattern, "", response_content, flags=re.DOTALL | re.IGNORECASE).strip()
-        
-        # Also remove the "SQL QUERY:" section header if it exists
-        response_content = re.sub(r"SQL QUERY:\s*", "", response_content, flags=re.IGNORECASE).strip()
-    
-    # Send the result minus the SQL query
-    yield f"data: {json.dumps({'type': 'message', 'content': response_content})}\n\n"
+    # Set when the SQL arrived before the LLM finished talking
+    pending = None
+    if plan:
+        # A saved plan already has the LLM's answer and SQL, go straight to the query
+        sql_query = plan.sql_query
+        response_content = plan.response_content
+    else:
+        response_content, sql_query = None, None
+        async for message_or_plan in generate_plan(question):
+            if isinstance(message_or_plan, tuple):
+                response_content, sql_query = message_or_plan
+            elif isinstance(message_or_plan, PendingPlan):
+                pending = message_or_plan
+                response_content, sql_query = pending.head, pending.sql_query
+            else:
+                yield message_or_plan
     
-    # If there's a SQL query, try to execute it. 
-    if sql_query:
-        yield f"data: {json.dumps({'type': 'message', 'content': f'Running dynamically generated query'})}\n\n"
-        # Execute the SQL query against BigQuery
-        client = bigquery.Client(project="mimiciii-eric")
-        query_job = client.query(sql_query)
-        results = query_job.result()
-        
-        # Collect results for return
-        query_results = []
-        for row in results:
-            row_dict = dict(row)
-            query_results.append(row_dict)
-            #yield f"data: {json.dumps({'type': 'message', 'content': f'Result: {row_dict}'})}\n\n"
+    try:
+        # Send the result minus the SQL query
+        yield sse.message(response_content)
         
-        # Yield the final results with a special marker
-        yield ('FINAL_RESULT', response_content, sql_query, query_results)
+        # If there's a SQL query, try to execute it. 
+        if sql_query:
+            query_results = None
+            async for event_or_result in run_query(question, sql_query, user):
+                if isinstance(event_or_result, tuple):
+                    sql_query, query_results = event_or_result
+                else:
+                    yield event_or_result
+
+            if pending:
+                # Whatever the LLM said after the SQL, by now it's usually long done
+                full_content = await pending.response_content()
+                if full_content.startswith(response_content) and full_content != response_content:
+                    yield sse.message(full_content[len(response_content):].strip())
+                response_content = full_content
+
+            if query_results is not None and query_results.truncated:
+                # With the LIMIT the governor adds, BigQuery stops counting one row past what we keep
+                returned = f'{query_results.total_rows:,}' if query_results.total_rows > query_results.num_rows + 1 else f'more than {query_results.num_rows:,}'
+                truncated_message = f'The query returned {returned} rows, only the first {query_results.num_rows:,} are used.'
+                yield sse.message(truncated_message)
+            
+            # Yield the final results with a special marker
+            yield ('FINAL_RESULT', response_content, sql_query, query_results)
+        else:
+            # Yield final results with None for sql_query and results if no query was executed
+            yield ('FINAL_RESULT', response_content, sql_query, None)
+    finally:
+        # Don't keep reading the LLM's answer for a chat that's over
+        if pending:
+            pending.cancel()
+
+async def reuse_result(followup):
+    # answer_question for a follow-up the last answer's rows are enough for (see sessions.py): no plan, no query
+    turn = followup.turn
+    if followup.kind == 'filter':
+        with metrics.span('session'):
+            query_results = followup.narrow()
+        response_content = (f'Narrowing the previous answer to {followup.describe()} without running a new query, '
+                            f'{query_results.num_rows:,} of {turn.result.num_rows:,} rows left.')
     else:
-        # Yield final results with None for sql_query and results if no query was executed
-        #Note: To add, every once in a while, the LLM generates an error in the querry. I can capture
-        # the error and send it back for corrections and re-execute the "fixed" query. I have not added 
-        # this yet, but it's certainly possible. 
-        yield ('FINAL_RESULT', response_content, sql_query, None)
+        query_results = turn.result
+        response_content = f'Reusing the results for "{turn.question}" without running a new query.'
+    yield sse.message(response_content)
+    yield ('FINAL_RESULT', response_content, turn.sql_query, query_results)
+
+async def run_query(question, sql_query, user=None):
+    # Every once in a while the LLM writes SQL that doesn't work. The SQL is checked locally first (see
+    # sql_validator.py), and local problems or BigQuery's errors go back to the LLM for a fix, SQL_REPAIR_ATTEMPTS
+    # times at most. Yields status messages, then finishes with a (sql_query, query_results) tuple. The results are
+    # None if we never got a working query.
+
+    attempts = 0
+    while True:
+        # MIMIC doesn't change, so if we've run this exact query before we already have the answer. Results are kept
+        # under the SQL that ran, which has the LIMIT the governor adds.
+        cached_query = governor.cache_sql(sql_query)
+        query_results = await result_cache.get(cached_query)
+        if query_results is not None:
+            yield sse.message('Using cached results for this query')
+            yield (cached_query, query_results)
+            return
+
+        errors, tables = (), ()
+        if SQL_VALIDATION_ENABLED:
+            with metrics.span('sql_validation'):
+                errors, tables = validate_sql(sql_query)
+        # Out of repairs and still failing locally, BigQuery gets the last word (a bad query fails in the free dry run)
+        if not errors or attempts >= SQL_REPAIR_ATTEMPTS:
+            try:
+                async for event_or_result in execute_query(question, sql_query, user):
+                    yield event_or_result
+                return
+            except QueryError as e:
+                errors = (str(e),)
+                log.info("The query engine rejected the query: %s", errors[0])
+
+        if attempts >= SQL_REPAIR_ATTEMPTS:
+            yield sse.message(f"I couldn't get a working query: {errors[0]}")
+            yield (sql_query, None)
+            return
+        attempts += 1
+        yield sse.message(f'The query has a problem ({errors[0]}), asking for a fix...')
+        with metrics.span('sql_repair'):
+            fixed_query = await repair_sql(question, sql_query, errors, tables)
+        if fixed_query:
+            sql_query = fixed_query
+
+async def execute_query(question, sql_query, user=None):
+    # Dry run first, a query that would scan too much gets rewritten or refused before it costs anything
+    governed = None
+    async for event_or_query in governor.govern(sql_query, question, user):
+        if isinstance(event_or_query, GovernedQuery):
+            governed = event_or_query
+        else:
+            yield event_or_query
+    if governed.bytes_processed:
+        yield sse.message(f'This query will scan about {format_bytes(governed.bytes_processed)}')
+    if governed.rewritten:
+        yield sse.message('Using a cheaper version of the query')
+    sql_query = governed.sql
+
+    # run_query already looked for the SQL as it came in, a rewrite is a query of its own
+    query_results = await result_cache.get(sql_query) if governed.rewritten else None
+    if query_results is None:
+        yield sse.message(f'Running dynamically generated query')
+        # Results come back a page at a time as Arrow batches, with progress updates while they arrive. Another chat
+        # running the same SQL right now shares its job with us.
+        if COALESCE_ENABLED:
+            progress_and_result = query_flights.run(cache_key(sql_query), lambda: run_and_cache(governed, user))
+        else:
+            progress_and_result = run_and_cache(governed, user)
+        async for progress_or_result in progress_and_result:
+            if isinstance(progress_or_result, QueryResult):
+                query_results = progress_or_result
+            else:
+                yield progress_or_result
+    yield (sql_query, query_results)
+
+async def run_and_cache(governed, user=None):
+    # One of the limited query slots for as long as the job runs, the place in line goes out like progress does
+    sql_query = governed.sql
+    slot = scheduler.query.slot()
+    async for event in slot.wait():
+        yield event
+    try:
+        # Only the job that actually runs is charged, not the chats that got its result from the cache or shared it
+        governor.charge(governed, user)
+        query_results = None
+        async for progress_or_result in stream_query(sql_query):
+            if isinstance(progress_or_result, QueryResult):
+                query_results = progress_or_result
+            yield progress_or_result
+    finally:
+        slot.release()
+    await result_cache.put(sql_query, query_results)
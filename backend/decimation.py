@@ -0,0 +1,249 @@
+import base64
+import numpy as np
+import logs
+
+# A plotly line over a day of chartevents vitals is a few hundred thousand points, every one of them written out
+# as a JSON float, and the browser grinds to a halt drawing it. Nobody can see more points than the chart has
+# pixels anyway. So before a figure leaves the sandbox its big traces are cut down to a point budget (LTTB for
+# lines, min/max per bucket for markers, pre-computed bins for histograms) and the numeric arrays that remain
+# are sent as plotly's typed arrays ({"dtype": "f8", "bdata": <base64>}) instead of JSON numbers.
+
+# Traces smaller than this are left alone
+MIN_POINTS_TO_REDUCE = 1000
+
+# Arrays shorter than this stay plain lists, base64 isn't worth it and small figures stay readable
+MIN_TYPED_ARRAY_LENGTH = 32
+
+# Anything else in a trace that runs along the points gets reduced with them
+PER_POINT_KEYS = ('text', 'hovertext', 'customdata', 'ids')
+PER_POINT_MARKER_KEYS = ('color', 'size', 'symbol', 'opacity')
+# Error bars are dicts ({"type": "data", "array": [...], "arrayminus": [...]}), it's their arrays that run along
+ERROR_BAR_KEYS = ('error_x', 'error_y')
+ERROR_BAR_ARRAYS = ('array', 'arrayminus')
+
+log = logs.get_logger('chart')
+
+INT_DTYPES = [('i1', np.int8), ('u1', np.uint8), ('i2', np.int16), ('u2', np.uint16), ('i4', np.int32),
+              ('u4', np.uint32)]
+
+
+def decode_array(value):
+    """A trace array as a numpy array (plotly 6+ already emits typed arrays for numpy input), or None"""
+    if isinstance(value, dict) and 'bdata' in value and 'dtype' in value:
+        if 'shape' in value:
+            return None
+        return np.frombuffer(base64.b64decode(value['bdata']), dtype=np.dtype(value['dtype']))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return np.asarray(value, dtype=object) if not isinstance(value, np.ndarray) else value
+    return None
+
+
+def as_numbers(values):
+    """float64 version of the values, or None if they aren't numbers (dates as ISO strings count as numbers)"""
+    if values is None:
+        return None
+    if values.dtype.kind in 'iuf':
+        return values.astype(np.float64)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    try:
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return np.array(values, dtype='datetime64[ns]').astype(np.int64).astype(np.float64)
+    except (TypeError, ValueError):
+        return None
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets, indices of the points to keep (x sorted ascending)"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < threshold - 1:
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        # The point in this bucket that makes the biggest triangle with the last kept point and the next bucket's average
+        area = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(area)) if end > start else start
+        keep[i + 1] = previous
+    return np.unique(keep)
+
+
+def min_max(x, y, buckets):
+    """The lowest and highest point of each bucket along x, keeps spikes and outliers that sampling would lose"""
+    n = len(x)
+    if buckets * 2 >= n:
+        return np.arange(n)
+    order = np.argsort(x, kind='stable')
+    bucket = (np.arange(n) * buckets) // n
+    by_bucket = order[np.lexsort((y[order], bucket))]
+    starts = np.searchsorted(bucket, np.arange(buckets), side='left')
+    ends = np.searchsorted(bucket, np.arange(buckets), side='right') - 1
+    return np.unique(np.concatenate([by_bucket[starts], by_bucket[ends]]))
+
+
+def _take(value, indices, n):
+    if isinstance(value, dict) and 'bdata' in value:
+        array = decode_array(value)
+        return array[indices] if array is not None and len(array) == n else value
+    if isinstance(value, (list, tuple, np.ndarray)) and len(value) == n:
+        return [value[i] for i in indices] if not isinstance(value, np.ndarray) else value[indices]
+    return value
+
+
+def _reduce_points(trace, budget):
+    x_values, y_values = decode_array(trace.get('x')), decode_array(trace.get('y'))
+    if y_values is None or len(y_values) < max(MIN_POINTS_TO_REDUCE, budget + 1):
+        return False
+    n = len(y_values)
+    y = as_numbers(y_values)
+    if y is None:
+        return False
+    if x_values is not None and len(x_values) == n:
+        x = as_numbers(x_values)
+        if x is None:
+            # Categories, keep their order
+            x = np.arange(n, dtype=np.float64)
+    else:
+        x = np.arange(n, dtype=np.float64)
+
+    valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    lines = 'lines' in (trace.get('mode') or 'lines')
+    if lines:
+        if np.any(np.diff(x[valid]) < 0):
+            valid = valid[np.argsort(x[valid], kind='stable')]
+        chosen = valid[lttb(x[valid], y[valid], budget)]
+    else:
+        chosen = valid[min_max(x[valid], y[valid], max(budget // 2, 1))]
+    if lines:
+        chosen = chosen[np.argsort(x[chosen], kind='stable')]
+
+    for key in ('x', 'y') + PER_POINT_KEYS:
+        if key in trace:
+            trace[key] = _take(trace[key], chosen, n)
+    marker = trace.get('marker')
+    if isinstance(marker, dict):
+        for key in PER_POINT_MARKER_KEYS:
+            if key in marker:
+                marker[key] = _take(marker[key], chosen, n)
+    for error_bars in _error_bars(trace):
+        for key in ERROR_BAR_ARRAYS:
+            if key in error_bars:
+                error_bars[key] = _take(error_bars[key], chosen, n)
+    return True
+
+
+def _error_bars(trace):
+    return [trace[key] for key in ERROR_BAR_KEYS if isinstance(trace.get(key), dict)]
+
+
+def auto_bins(values, max_bins):
+    # Freedman-Diaconis, falling back to Sturges when the data is too concentrated for it
+    q25, q75 = np.percentile(values, [25, 75])
+    width = 2 * (q75 - q25) / len(values) ** (1 / 3)
+    span = values.max() - values.min()
+    if width > 0 and span > 0:
+        bins = int(np.ceil(span / width))
+    else:
+        bins = int(np.ceil(np.log2(len(values)))) + 1
+    return min(max(bins, 1), max_bins)
+
+
+def _bin_histogram(trace, max_bins):
+    # A histogram with raw values becomes a bar trace of the counts, which is what plotly.js would draw anyway
+    orientation = 'y' if trace.get('x') is None and trace.get('y') is not None else 'x'
+    raw = decode_array(trace.get(orientation))
+    if raw is None or len(raw) < MIN_POINTS_TO_REDUCE:
+        return False
+    # Only numbers get binned here, plotly.js does fine with dates and categories on its own
+    if raw.dtype.kind == 'O' and not all(isinstance(item, (int, float)) or item is None for item in raw[:100]):
+        return False
+    if raw.dtype.kind not in 'iufO':
+        return False
+    values = as_numbers(raw)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return False
+    requested = trace.get('nbinsx' if orientation == 'x' else 'nbinsy')
+    bins = min(int(requested), max_bins) if requested else auto_bins(values, max_bins)
+    counts, edges = np.histogram(values, bins=max(bins, 1))
+    centers = (edges[:-1] + edges[1:]) / 2
+    binned = {
+        'type': 'bar',
+        orientation: centers,
+        'y' if orientation == 'x' else 'x': counts,
+        'width': float(edges[1] - edges[0]),
+        'orientation': 'v' if orientation == 'x' else 'h',
+    }
+    for key in ('name', 'marker', 'opacity', 'showlegend', 'legendgroup', 'xaxis', 'yaxis'):
+        if key in trace:
+            binned[key] = trace[key]
+    trace.clear()
+    trace.update(binned)
+    return True
+
+
+def encode_array(value):
+    """Numbers as a plotly typed array, anything else is returned unchanged"""
+    if isinstance(value, dict) or not isinstance(value, (list, tuple, np.ndarray)):
+        return value
+    if len(value) < MIN_TYPED_ARRAY_LENGTH:
+        return value.tolist() if isinstance(value, np.ndarray) else value
+    array = np.asarray(value)
+    if array.dtype.kind == 'O':
+        if any(item is None or isinstance(item, bool) or not isinstance(item, (int, float)) for item in array):
+            return list(value)
+        array = array.astype(np.float64)
+    if array.dtype.kind == 'b':
+        return array.tolist()
+    if array.dtype.kind in 'iu':
+        low, high = array.min(), array.max()
+        for name, dtype in INT_DTYPES:
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return {'dtype': name, 'bdata': base64.b64encode(array.astype(dtype).tobytes()).decode()}
+        array = array.astype(np.float64)
+    if array.dtype.kind == 'f':
+        return {'dtype': 'f8', 'bdata': base64.b64encode(array.astype('<f8').tobytes()).decode()}
+    return array.tolist()
+
+
+def reduce_figure(figure, point_budget, max_bins=200, typed_arrays=True):
+    """Cut a plotly figure dict ({"data": [...], "layout": {...}}) down to the point budget, in place"""
+    traces = [trace for trace in figure.get('data') or [] if isinstance(trace, dict)]
+    if not traces:
+        return figure
+    per_trace = max(point_budget // len(traces), 100)
+    reduced = 0
+    for trace in traces:
+        kind = trace.get('type', 'scatter')
+        if kind == 'histogram':
+            reduced += _bin_histogram(trace, max_bins)
+        elif kind in ('scatter', 'scattergl'):
+            reduced += _reduce_points(trace, per_trace)
+        arrays = [(trace, key) for key in ('x', 'y', 'z')]
+        arrays += [(error_bars, key) for error_bars in _error_bars(trace) for key in ERROR_BAR_ARRAYS]
+        for owner, key in arrays:
+            if key not in owner:
+                continue
+            if typed_arrays:
+                owner[key] = encode_array(owner[key])
+            elif isinstance(owner[key], np.ndarray):
+                owner[key] = owner[key].tolist()
+    if reduced:
+        log.info("Reduced %d plotly trace(s) to a %d point budget", reduced, point_budget)
+    return figure
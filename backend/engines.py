@@ -0,0 +1,430 @@
+import functools
+import os
+import threading
+from typing import NamedTuple
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+import pyarrow.parquet as pq
+from google.api_core import exceptions as google_exceptions
+from google.cloud import bigquery
+import logs
+from settings import (
+    BIGQUERY_PROJECT,
+    DATASETS,
+    QUERY_PAGE_SIZE,
+    QUERY_USE_STORAGE_API,
+    QUERY_ENGINE,
+    QUERY_ENGINE_ROUTES,
+    DUCKDB_PARQUET_DIR,
+    DUCKDB_THREADS,
+    DUCKDB_MEMORY_LIMIT,
+)
+
+# The pipeline was wired straight to google.cloud.bigquery: the catalog listed tables with it, the governor dry ran
+# with it and ingestion ran queries with it. Now all three go through a QueryEngine (schema discovery, dry run,
+# submit/wait/read Arrow batches, cancel) and every dataset is routed to one. BigQuery is the default. The DuckDB
+# engine runs the same BigQuery SQL (translated by sqlglot) against local Parquet extracts of MIMIC-IV, which gives
+# sub-second answers on the on-prem extracts and a backend for tests and benchmarks that needs no network.
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+log = logs.get_logger('query')
+
+
+class QueryError(Exception):
+    """The engine rejected the SQL (syntax, unknown name, bad types). Worth sending back to the LLM for a fix."""
+
+
+class DryRun(NamedTuple):
+    bytes_processed: int
+    statement_type: str
+    # False for engines that cost nothing per query, the governor doesn't hold those to a scan budget
+    billed: bool
+
+
+class QueryHandle:
+    """A submitted query: wait() for it, then read batches(). cancel() can be called from any thread."""
+
+    total_rows = None
+
+    def wait(self):
+        raise NotImplementedError
+
+    def batches(self):
+        raise NotImplementedError
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueryEngine:
+    name = "engine"
+    # Whether the catalog should keep the schema in a <dataset>_schema.json file instead of asking every time
+    caches_schema = False
+
+    def fetch_schema(self, full_name):
+        """{table: {'columns': [{'name', 'type', 'description'}], 'description', 'num_rows'}} (blocking)"""
+        raise NotImplementedError
+
+    def dry_run(self, sql):
+        """Check the SQL without running it, returns a DryRun (blocking)"""
+        raise NotImplementedError
+
+    def submit(self, sql, max_bytes_billed=None):
+        """Start the query, returns a QueryHandle (blocking)"""
+        raise NotImplementedError
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# BigQuery
+
+
+class BigQueryHandle(QueryHandle):
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+        self.rows = None
+        self._batches = None
+
+    def wait(self):
+        try:
+            self.rows = self.job.result(page_size=QUERY_PAGE_SIZE)
+        except (google_exceptions.BadRequest, google_exceptions.NotFound) as e:
+            raise QueryError(getattr(e, 'message', None) or str(e)) from e
+        self.total_rows = getattr(self.rows, 'total_rows', None)
+
+    def batches(self):
+        # May open a Storage API read session
+        self._batches = iter(self.rows.to_arrow_iterable(bqstorage_client=self.engine.storage_client()))
+        return self._batches
+
+    def cancel(self):
+        try:
+            self.job.cancel()
+        except Exception as e:
+            log.warning("Couldn't cancel BigQuery job: %s", e)
+
+    def close(self):
+        # Don't leave a Storage API read session streaming pages we're never going to look at
+        close = getattr(self._batches, 'close', None)
+        if close:
+            close()
+
+
+def _bigquery_client():
+    return bigquery.Client(project=BIGQUERY_PROJECT)
+
+
+class BigQueryEngine(QueryEngine):
+    name = "bigquery"
+    # Listing a dataset through the API is slow, so the catalog keeps what it finds in a file
+    caches_schema = True
+
+    def __init__(self, client_factory=_bigquery_client):
+        # client_factory is how benchmarks/stubs.py swaps in a fake client
+        self.client_factory = client_factory
+        self._client = None
+        self._storage_client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self.client_factory()
+            return self._client
+
+    def reset(self, client_factory=None):
+        with self._lock:
+            if client_factory is not None:
+                self.client_factory = client_factory
+            self._client = None
+
+    def storage_client(self):
+        # The Storage Read API is much faster than paging over REST, but it's an optional package and needs an
+        # extra permission, so fall back to REST pages when we can't use it
+        if not QUERY_USE_STORAGE_API or bigquery_storage is None:
+            return None
+        with self._lock:
+            if self._storage_client is None:
+                try:
+                    self._storage_client = bigquery_storage.BigQueryReadClient()
+                except Exception as e:
+                    log.warning("BigQuery Storage API unavailable, using REST pages: %s", e)
+                    return None
+            return self._storage_client
+
+    def fetch_schema(self, full_name):
+        project_id, dataset_id = full_name.split(':')
+        client = self.client()
+        dataset_ref = bigquery.DatasetReference(project_id, dataset_id)
+        schema_info = {}
+        for table in client.list_tables(dataset_ref):
+            table_obj = client.get_table(dataset_ref.table(table.table_id))
+            schema_info[table.table_id] = {
+                'columns': [
+                    {'name': field.name, 'type': field.field_type, 'description': field.description or 'No description'}
+                    for field in table_obj.schema
+                ],
+                'description': table_obj.description or 'No description',
+                'num_rows': table_obj.num_rows,
+            }
+        return schema_info
+
+    def dry_run(self, sql):
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        try:
+            job = self.client().query(sql, job_config=job_config)
+        except (google_exceptions.BadRequest, google_exceptions.NotFound) as e:
+            raise QueryError(getattr(e, 'message', None) or str(e)) from e
+        return DryRun(int(job.total_bytes_processed or 0), (job.statement_type or 'SELECT').upper(), True)
+
+    def submit(self, sql, max_bytes_billed=None):
+        job_config = bigquery.QueryJobConfig(maximum_bytes_billed=max_bytes_billed)
+        try:
+            job = self.client().query(sql, job_config=job_config)
+        except (google_exceptions.BadRequest, google_exceptions.NotFound) as e:
+            raise QueryError(getattr(e, 'message', None) or str(e)) from e
+        return BigQueryHandle(self, job)
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# DuckDB over local Parquet
+
+
+# Arrow types as the BigQuery type names the prompts and the SQL validator expect
+def _bigquery_type(arrow_type):
+    import pyarrow as pa
+    if pa.types.is_boolean(arrow_type):
+        return 'BOOLEAN'
+    if pa.types.is_integer(arrow_type):
+        return 'INTEGER'
+    if pa.types.is_floating(arrow_type):
+        return 'FLOAT'
+    if pa.types.is_decimal(arrow_type):
+        return 'NUMERIC'
+    if pa.types.is_timestamp(arrow_type):
+        return 'TIMESTAMP' if arrow_type.tz else 'DATETIME'
+    if pa.types.is_date(arrow_type):
+        return 'DATE'
+    if pa.types.is_time(arrow_type):
+        return 'TIME'
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return 'BYTES'
+    return 'STRING'
+
+
+class DuckDBHandle(QueryHandle):
+    def __init__(self, cursor, sql):
+        self.cursor = cursor
+        self.sql = sql
+        self._reader = None
+
+    def wait(self):
+        try:
+            self.cursor.execute(self.sql)
+        except duckdb.Error as e:
+            raise QueryError(str(e)) from e
+
+    def batches(self):
+        self._reader = self.cursor.fetch_record_batch(QUERY_PAGE_SIZE)
+        return iter(self._reader)
+
+    def cancel(self):
+        self.cursor.interrupt()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+        self.cursor.close()
+
+
+class DuckDBEngine(QueryEngine):
+    name = "duckdb"
+
+    def __init__(self, parquet_dir=DUCKDB_PARQUET_DIR):
+        self.parquet_dir = parquet_dir
+        self._connection = None
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if duckdb is None:
+            raise RuntimeError("A dataset is routed to DuckDB but the duckdb package isn't installed")
+        with self._lock:
+            if self._connection is None:
+                self._connection = duckdb.connect(config={'threads': DUCKDB_THREADS, 'memory_limit': DUCKDB_MEMORY_LIMIT})
+            return self._connection
+
+    def _table_paths(self, dataset_id):
+        # <dir>/<dataset>/<table>.parquet, or a <table>/ folder of parquet files (how most exports come out)
+        folder = os.path.join(self.parquet_dir, dataset_id)
+        paths = {}
+        if not os.path.isdir(folder):
+            return paths
+        for entry in sorted(os.listdir(folder)):
+            path = os.path.join(folder, entry)
+            if entry.endswith('.parquet') and os.path.isfile(path):
+                paths[entry[:-len('.parquet')]] = [path]
+            elif os.path.isdir(path):
+                files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.parquet'))
+                if files:
+                    paths[entry] = files
+        return paths
+
+    def _create_views(self, full_name):
+        # Each dataset is a DuckDB schema of views over its Parquet files, so `project.dataset.table` only needs
+        # its project dropped to work here
+        dataset_id = full_name.split(':')[1]
+        paths = self._table_paths(dataset_id)
+        connection = self._connect()
+        with self._lock:
+            connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset_id}"')
+            for table, files in paths.items():
+                file_list = ", ".join("'" + file.replace("'", "''") + "'" for file in files)
+                connection.execute(
+                    f'CREATE OR REPLACE VIEW "{dataset_id}"."{table}" AS SELECT * FROM read_parquet([{file_list}])'
+                )
+            self._views[full_name] = paths
+        return paths
+
+    def _ensure_views(self, datasets):
+        for full_name in datasets:
+            if full_name not in self._views:
+                self._create_views(full_name)
+
+    def fetch_schema(self, full_name):
+        schema_info = {}
+        for table, files in self._create_views(full_name).items():
+            schema = pq.read_schema(files[0])
+            schema_info[table] = {
+                'columns': [
+                    {'name': field.name, 'type': _bigquery_type(field.type), 'description': 'No description'}
+                    for field in schema
+                ],
+                'description': 'No description',
+                'num_rows': sum(pq.read_metadata(file).num_rows for file in files),
+            }
+        return schema_info
+
+    def translate(self, sql):
+        """BigQuery SQL as DuckDB SQL"""
+        return _translate(sql)
+
+    def dry_run(self, sql):
+        datasets, statement = datasets_in_sql(sql)
+        self._ensure_views(datasets)
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute(f"EXPLAIN {self.translate(sql)}")
+        except duckdb.Error as e:
+            raise QueryError(str(e)) from e
+        finally:
+            cursor.close()
+        # Nothing is billed, but what the query could read is still a useful number to show
+        scanned = 0
+        for full_name in datasets:
+            for table, files in self._views.get(full_name, {}).items():
+                if (full_name, table) in _tables_in_sql(sql):
+                    scanned += sum(os.path.getsize(file) for file in files)
+        return DryRun(scanned, statement, False)
+
+    def submit(self, sql, max_bytes_billed=None):
+        datasets, _ = datasets_in_sql(sql)
+        self._ensure_views(datasets)
+        return DuckDBHandle(self._connect().cursor(), self.translate(sql))
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Routing
+
+
+@functools.lru_cache(maxsize=256)
+def _parse(sql):
+    try:
+        return sqlglot.parse_one(sql, read='bigquery')
+    except ParseError as e:
+        raise QueryError(str(e)) from e
+
+
+@functools.lru_cache(maxsize=256)
+def _tables_in_sql(sql):
+    tables = set()
+    for table in _parse(sql).find_all(exp.Table):
+        if table.catalog and table.db:
+            tables.add((f"{table.catalog}:{table.db}", table.name))
+    return frozenset(tables)
+
+
+def datasets_in_sql(sql):
+    """The datasets a query reads from and its statement type"""
+    tree = _parse(sql)
+    datasets = sorted({full_name for full_name, _ in _tables_in_sql(sql)})
+    statement = 'SELECT' if isinstance(tree, exp.Query) else tree.key.upper()
+    return datasets, statement
+
+
+@functools.lru_cache(maxsize=256)
+def _translate(sql):
+    tree = _parse(sql).copy()
+    for table in tree.find_all(exp.Table):
+        if table.catalog:
+            table.set('catalog', None)
+    return tree.sql(dialect='duckdb')
+
+
+ENGINE_TYPES = {'bigquery': BigQueryEngine, 'duckdb': DuckDBEngine}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name):
+    with _engines_lock:
+        if name not in _engines:
+            if name not in ENGINE_TYPES:
+                raise ValueError(f"Unknown query engine {name}, expected one of {', '.join(ENGINE_TYPES)}")
+            _engines[name] = ENGINE_TYPES[name]()
+        return _engines[name]
+
+
+def _routes():
+    # "physionet-data:mimiciv_3_1_hosp=duckdb,physionet-data:mimiciv_3_1_icu=duckdb"
+    routes = {full_name: QUERY_ENGINE for full_name in DATASETS}
+    for item in QUERY_ENGINE_ROUTES.split(','):
+        if '=' in item:
+            full_name, name = item.rsplit('=', 1)
+            routes[full_name.strip()] = name.strip().lower()
+    return routes
+
+
+ROUTES = _routes()
+
+
+def engine_for_dataset(full_name):
+    return get_engine(ROUTES.get(full_name, QUERY_ENGINE))
+
+
+def engine_for_sql(sql):
+    """The engine that runs this query. Every dataset it touches has to live on that engine."""
+    datasets, _ = datasets_in_sql(sql)
+    names = {ROUTES.get(full_name, QUERY_ENGINE) for full_name in datasets}
+    if len(names) > 1:
+        raise QueryError(f"The query joins datasets that live on different engines ({', '.join(sorted(names))})")
+    return get_engine(names.pop() if names else QUERY_ENGINE)
+
+
+def routing_key():
+    """Changes whenever datasets move between engines, so cached results don't cross over"""
+    return ",".join(f"{full_name}={name}" for full_name, name in sorted(ROUTES.items()))
@@ -0,0 +1,47 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# The chat pipeline is async, but the BigQuery client, the schema files and matplotlib are not.
+# Anything that blocks goes through one of these pools so one slow query doesn't freeze every other
+# stream (and /api/login) on the same uvicorn worker.
+BLOCKING_WORKERS = 16
+CHART_WORKERS = 1
+
+io_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking-io")
+
+# pyplot keeps global figure state, so chart rendering gets its own pool. One thread keeps the
+# generated code from stepping on another request's figure. Charts normally render in the sandbox
+# processes (sandbox.py), this is what's left when SANDBOX_ENABLED is off.
+chart_executor = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix="chart-render")
+
+
+async def _run_in(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Copy the context so anything stored in context variables follows the work into the thread
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor, call)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call (BigQuery, file I/O) off the event loop"""
+    return await _run_in(io_executor, func, *args, **kwargs)
+
+
+async def run_chart(func, *args, **kwargs):
+    """Run chart rendering off the event loop, one render at a time"""
+    return await _run_in(chart_executor, func, *args, **kwargs)
+
+
+def run_detached(func, *args, **kwargs):
+    """Start a blocking call without waiting for it. For cleanup in a request that's being cancelled, where
+    every await would just be cancelled again."""
+    context = contextvars.copy_context()
+    return io_executor.submit(context.run, func, *args, **kwargs)
+
+
+def shutdown_executors():
+    io_executor.shutdown(wait=False, cancel_futures=True)
+    chart_executor.shutdown(wait=False, cancel_futures=True)
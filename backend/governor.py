@@ -0,0 +1,316 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+from fastapi import APIRouter, Depends
+from engines import engine_for_sql, QueryError
+from executors import run_blocking
+from llm import get_llm
+import logs
+import metrics
+from scheduler import scheduler, retry_rate_limited
+from result_cache import normalize_sql
+from security import get_current_user
+from sql_validator import validate_sql
+from settings import (
+    GOVERNOR_ENABLED,
+    QUERY_SCAN_MAX_BYTES,
+    QUERY_USER_SCAN_BUDGET_BYTES,
+    QUERY_GLOBAL_SCAN_BUDGET_BYTES,
+    QUERY_BUDGET_WINDOW_SECONDS,
+    QUERY_REWRITE_ATTEMPTS,
+    QUERY_ADD_LIMIT,
+    QUERY_MAX_ROWS,
+    QUERY_PRICE_PER_TB,
+    SQL_VALIDATION_ENABLED,
+)
+
+# answer_question used to hand whatever SQL the LLM wrote straight to client.query. A careless SELECT over
+# icu.chartevents or hosp.labevents scans hundreds of GB and holds the request for minutes. Every query now gets
+# a BigQuery dry run first (free, and it's the same number we'd be billed for). Queries that would go over the
+# per-query cap, or over what's left of the user's or everybody's budget, go back to the LLM for a cheaper version
+# and are refused if it can't find one. Queries without a LIMIT get one, ingestion would throw the extra rows away
+# anyway. A LIMIT doesn't make BigQuery scan less though, which is why over budget means a rewrite and not a LIMIT.
+# Datasets routed to a local engine (see engines.py) still get the dry run, but nothing is billed so no budget applies.
+
+router = APIRouter()
+
+log = logs.get_logger('query')
+
+# Dry run estimates kept per normalized SQL. MIMIC doesn't change, so neither does the estimate.
+ESTIMATE_CACHE_ENTRIES = 1000
+
+# Only plain reads get through, the LLM has no business writing to anything
+ALLOWED_STATEMENTS = ('SELECT',)
+
+REWRITE_PROMPT_TEMPLATE = """
+    The following BigQuery SQL was written to answer a question, but it would scan {estimate} and the limit for
+    this query is {allowed}.
+
+    Question: "{question}"
+
+    SQL:
+    ```sql
+    {sql}
+    ```
+
+    Rewrite the query so it answers the same question while scanning less data. BigQuery bills for every column of
+    every table a query reads, so:
+    - Select only the columns that are needed, never SELECT *
+    - Filter as early as possible, and prefer the smaller tables (d_items, d_labitems, admissions, patients) for lookups
+    - Aggregate in the query instead of returning raw rows
+    - A LIMIT does not reduce the bytes scanned, don't rely on it
+
+    Respond with the rewritten query only, in a ```sql block.
+    """
+
+_SQL_BLOCK = re.compile(r"```(?:sql)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+# A LIMIT at the very end of the statement (comments and string literals are gone after normalize_sql)
+_TRAILING_LIMIT = re.compile(r"\bLIMIT\s+\d+(?:\s+OFFSET\s+\d+)?\s*$", re.IGNORECASE)
+
+
+class QueryRefused(Exception):
+    """The query would scan more than the user is allowed to, even after trying to make it cheaper"""
+
+
+class GovernedQuery(NamedTuple):
+    sql: str
+    bytes_processed: int
+    rewritten: bool
+    limit_added: bool
+    # Whether the scan counts against the budgets (see charge)
+    billed: bool
+
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == 'B' else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def estimate_cost(num_bytes):
+    return num_bytes / 1024 ** 4 * QUERY_PRICE_PER_TB
+
+
+def add_limit(sql, limit):
+    """Put a LIMIT on the outermost query if it doesn't have one. Returns (sql, added)."""
+    if _TRAILING_LIMIT.search(normalize_sql(sql)):
+        return sql, False
+    # Trailing comments would swallow the LIMIT, so it goes on its own line
+    return f"{sql.rstrip().rstrip(';').rstrip()}\nLIMIT {limit}", True
+
+
+class ScanBudget:
+    """Bytes scanned per user and in total over a sliding window"""
+
+    def __init__(self, user_bytes=QUERY_USER_SCAN_BUDGET_BYTES, global_bytes=QUERY_GLOBAL_SCAN_BUDGET_BYTES,
+                 window_seconds=QUERY_BUDGET_WINDOW_SECONDS):
+        self.user_bytes = user_bytes
+        self.global_bytes = global_bytes
+        self.window_seconds = window_seconds
+        self._charges = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._charges and now - self._charges[0][0] > self.window_seconds:
+            self._charges.popleft()
+
+    def _spent(self, user=None):
+        self._expire(time.time())
+        if user is None:
+            return sum(size for _, _, size in self._charges)
+        return sum(size for _, who, size in self._charges if who == user)
+
+    def spent(self, user=None):
+        with self._lock:
+            return self._spent(user)
+
+    def _allowance(self, user):
+        return max(min(
+            QUERY_SCAN_MAX_BYTES,
+            self.user_bytes - self._spent(user),
+            self.global_bytes - self._spent(),
+        ), 0)
+
+    def allowance(self, user):
+        """The most one query from this user may scan right now"""
+        with self._lock:
+            return self._allowance(user)
+
+    def try_charge(self, user, num_bytes):
+        """Charge the scan if it still fits. Checked and charged together so two requests can't both squeeze in."""
+        with self._lock:
+            if num_bytes > self._allowance(user):
+                return False
+            self._charges.append((time.time(), user, num_bytes))
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._charges.clear()
+
+    def usage(self, user):
+        return {
+            "user_spent_bytes": self.spent(user),
+            "user_budget_bytes": self.user_bytes,
+            "global_spent_bytes": self.spent(),
+            "global_budget_bytes": self.global_bytes,
+            "query_max_bytes": QUERY_SCAN_MAX_BYTES,
+            "window_seconds": self.window_seconds,
+        }
+
+
+class QueryGovernor:
+    def __init__(self, budget=None):
+        self.budget = budget or ScanBudget()
+        self._estimates = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"dry_runs": 0, "estimate_hits": 0, "rewrites": 0, "limits_added": 0, "refused": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def dry_run(self, sql):
+        """The engine's DryRun for the query: bytes scanned, statement type, billed (blocking, call through run_blocking)"""
+        key = normalize_sql(sql)
+        with self._lock:
+            if key in self._estimates:
+                self._estimates.move_to_end(key)
+                self._stats["estimate_hits"] += 1
+                return self._estimates[key]
+        estimate = engine_for_sql(sql).dry_run(sql)
+        with self._lock:
+            self._stats["dry_runs"] += 1
+            self._estimates[key] = estimate
+            while len(self._estimates) > ESTIMATE_CACHE_ENTRIES:
+                self._estimates.popitem(last=False)
+        return estimate
+
+    async def rewrite(self, question, sql, num_bytes, allowed):
+        self._count("rewrites")
+        prompt = REWRITE_PROMPT_TEMPLATE.format(
+            question=question, sql=sql, estimate=format_bytes(num_bytes), allowed=format_bytes(allowed),
+        )
+        async with scheduler.llm.hold():
+            with metrics.span('query_rewrite'):
+                response = await retry_rate_limited(get_llm().ainvoke, prompt)
+        metrics.record_llm('query_rewrite', response)
+        match = _SQL_BLOCK.search(response.content)
+        return match.group(1).strip() if match else None
+
+    async def check_rewrite(self, sql):
+        """What's wrong with a rewritten query, checked like run_query checks the LLM's SQL. An error from a rewrite
+        must not reach run_query, it would send the original SQL off to be repaired."""
+        if SQL_VALIDATION_ENABLED:
+            errors, _ = validate_sql(sql)
+            if errors:
+                return errors
+        try:
+            # The estimate is cached, the next time round the loop gets it for free
+            with metrics.span('dry_run'):
+                await run_blocking(self.dry_run, sql)
+        except QueryError as e:
+            return (str(e),)
+        return ()
+
+    async def govern(self, sql, question, user=None):
+        """Dry run the query and keep it within budget
+
+        Yields SSE event dicts (the estimate, rewrite notices), then finishes with a GovernedQuery.
+        Raises QueryRefused when no affordable version of the query could be found.
+        """
+        user = user or "anonymous"
+        if not GOVERNOR_ENABLED:
+            yield GovernedQuery(sql, 0, False, False, False)
+            return
+
+        rewritten = False
+        attempts = 0
+        while True:
+            with metrics.span('dry_run'):
+                num_bytes, statement, billed = await run_blocking(self.dry_run, sql)
+            if statement not in ALLOWED_STATEMENTS:
+                self._count("refused")
+                raise QueryRefused(f"Only SELECT queries can be run, this one is a {statement}")
+            if not billed:
+                yield {'type': 'estimate', 'bytes': num_bytes, 'cost_usd': 0, 'allowed_bytes': None,
+                       'within_budget': True}
+                break
+            allowed = self.budget.allowance(user)
+            yield {
+                'type': 'estimate',
+                'bytes': num_bytes,
+                'cost_usd': round(estimate_cost(num_bytes), 4),
+                'allowed_bytes': allowed,
+                'within_budget': num_bytes <= allowed,
+            }
+            # Only checked here, the scan is charged when a job actually runs it (a cached or shared result is free)
+            if num_bytes <= allowed:
+                break
+            if attempts >= QUERY_REWRITE_ATTEMPTS:
+                self._count("refused")
+                log.warning("Refused a query scanning %d bytes (allowed %d) for %s", num_bytes, allowed, user)
+                raise QueryRefused(
+                    f"This query would scan {format_bytes(num_bytes)}, more than the {format_bytes(allowed)} "
+                    f"you can use right now. Try narrowing the question (a time range, fewer patients or items)."
+                )
+            attempts += 1
+            yield {'type': 'message', 'content': (
+                f'That query would scan {format_bytes(num_bytes)} (limit {format_bytes(allowed)}), '
+                f'asking for a cheaper version...'
+            )}
+            cheaper = await self.rewrite(question, sql, num_bytes, allowed)
+            errors = await self.check_rewrite(cheaper) if cheaper else ()
+            if errors:
+                log.info("Dropped a rewrite that doesn't work: %s", errors[0])
+            elif cheaper:
+                sql, rewritten = cheaper, True
+
+        limit_added = False
+        if QUERY_ADD_LIMIT:
+            # One more row than ingestion keeps, so it can still tell the result was cut off
+            sql, limit_added = add_limit(sql, QUERY_MAX_ROWS + 1)
+            if limit_added:
+                self._count("limits_added")
+
+        log.info("Approved a query scanning %d bytes for %s", num_bytes, user)
+        yield GovernedQuery(sql, num_bytes, rewritten, limit_added, billed)
+
+    def charge(self, governed, user=None):
+        """Charge an approved query's scan to the user, right before its job starts. Raises QueryRefused when other
+        queries used up the budget in the meantime."""
+        user = user or "anonymous"
+        if governed.billed and not self.budget.try_charge(user, governed.bytes_processed):
+            self._count("refused")
+            raise QueryRefused(
+                f"This query would scan {format_bytes(governed.bytes_processed)}, more than you can use right now. "
+                f"Try again in a little while."
+            )
+        metrics.record_scan(engine_for_sql(governed.sql).name, governed.bytes_processed)
+
+    def cache_sql(self, sql):
+        """The SQL govern() approves when no rewrite is needed, which is what its results are cached under"""
+        if GOVERNOR_ENABLED and QUERY_ADD_LIMIT:
+            return add_limit(sql, QUERY_MAX_ROWS + 1)[0]
+        return sql
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_estimates"] = len(self._estimates)
+        return stats
+
+
+governor = QueryGovernor()
+
+
+@router.get("/query/budget")
+async def query_budget(user: dict = Depends(get_current_user)):
+    """How much of the scan budget the caller (and everyone together) has used in the current window"""
+    usage = governor.budget.usage(user["username"])
+    usage["stats"] = governor.stats()
+    return usage
@@ -0,0 +1,104 @@
+import time
+from engines import engine_for_sql
+from executors import run_blocking, run_detached
+import logs
+import metrics
+from query_result import QueryResult
+from scheduler import retry_rate_limited
+from settings import (
+    QUERY_MAX_ROWS,
+    QUERY_MAX_BYTES,
+    QUERY_PROGRESS_INTERVAL_SECONDS,
+    QUERY_SCAN_MAX_BYTES,
+)
+
+# Walking query_job.result() row by row and building a dict per row was slow, memory hungry and unbounded
+# (chartevents has 430M rows). Results now come back a page at a time as Arrow record batches (through the
+# BigQuery Storage Read API when it's installed), stop at a row/byte cap, and report progress as pages arrive.
+# Which engine runs the query (BigQuery or DuckDB over local Parquet) is up to engines.py. If the request is cancelled
+# (the user closed the tab) the job is cancelled too, instead of running to the end for nobody.
+
+log = logs.get_logger('query')
+
+
+def _abandon(handle, cancel):
+    if cancel:
+        handle.cancel()
+    try:
+        handle.close()
+    except Exception as e:
+        # The thread waiting on the job may still be holding the reader
+        log.debug("Couldn't close an abandoned query: %r", e)
+
+
+async def stream_query(sql_query, max_rows=QUERY_MAX_ROWS, max_bytes=QUERY_MAX_BYTES):
+    """Run a query and read its results page by page
+
+    Yields progress dicts while pages arrive, then finishes with a QueryResult.
+    """
+    engine = engine_for_sql(sql_query)
+    # The governor already checked the dry run (see governor.py), the byte cap is the backstop if the estimate was off
+    query_started = time.perf_counter()
+    # BigQuery's concurrent query quota answers with rate limit errors, those are worth another try
+    handle = await retry_rate_limited(run_blocking, engine.submit, sql_query, QUERY_SCAN_MAX_BYTES)
+    batches = []
+    schema = None
+    row_count = 0
+    byte_count = 0
+    truncated = False
+    total_rows = None
+    # Reading pages is spread over the loop (with progress events in between), so it's timed by hand
+    reading = 0.0
+    try:
+        await run_blocking(handle.wait)
+        metrics.observe('query', time.perf_counter() - query_started)
+        total_rows = handle.total_rows
+        started = time.perf_counter()
+        batches_iter = await run_blocking(handle.batches)
+        reading += time.perf_counter() - started
+        last_progress = time.monotonic()
+
+        while True:
+            started = time.perf_counter()
+            batch = await run_blocking(next, batches_iter, None)
+            reading += time.perf_counter() - started
+            if batch is None:
+                break
+            schema = batch.schema
+
+            # Stop at whichever cap comes first, keeping only the part of this page that fits
+            keep = batch.num_rows
+            if row_count + keep > max_rows:
+                keep = max_rows - row_count
+                truncated = True
+            if byte_count + batch.nbytes > max_bytes and batch.num_rows:
+                bytes_per_row = batch.nbytes / batch.num_rows
+                keep = min(keep, max(int((max_bytes - byte_count) / bytes_per_row), 0))
+                truncated = True
+            if keep < batch.num_rows:
+                batch = batch.slice(0, keep)
+
+            batches.append(batch)
+            row_count += batch.num_rows
+            byte_count += batch.nbytes
+            if truncated:
+                break
+
+            now = time.monotonic()
+            if now - last_progress >= QUERY_PROGRESS_INTERVAL_SECONDS:
+                last_progress = now
+                yield {'type': 'progress', 'stage': 'query', 'rows': row_count, 'total_rows': total_rows,
+                       'bytes': byte_count}
+    except BaseException as e:
+        # Nothing can be awaited in a cancelled request, so the cleanup goes to a thread. CancelledError and
+        # GeneratorExit mean nobody is waiting for the results any more, so the job itself is stopped too.
+        run_detached(_abandon, handle, not isinstance(e, Exception))
+        raise
+    # Don't leave a Storage API read session (or a DuckDB cursor) streaming pages we're never going to look at
+    await run_blocking(handle.close)
+
+    metrics.observe('materialize', reading)
+    metrics.record_query(engine.name, row_count, byte_count)
+    yield {'type': 'progress', 'stage': 'query', 'rows': row_count, 'total_rows': total_rows, 'bytes': byte_count,
+           'done': True}
+    yield QueryResult.from_batches(batches, schema, truncated, total_rows if total_rows is not None else row_count)
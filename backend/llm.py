@@ -0,0 +1,118 @@
+import threading
+import anthropic
+import httpx
+from langchain_anthropic import ChatAnthropic
+import settings
+
+# Every Claude call used to build its own ChatAnthropic, which meant a new HTTP client (and TLS handshake)
+# three times per question. Now there is one model per configuration and one pooled HTTP client per
+# process, and every call site asks this module for its model.
+
+_models = {}
+_models_lock = threading.Lock()
+_sync_http_client = None
+_async_http_client = None
+
+# Connection counters so we can confirm under load that connections are being reused
+_stats_lock = threading.Lock()
+_connection_stats = {"requests": 0, "new_connections": 0, "tls_handshakes": 0}
+
+
+def _record(event_name):
+    # httpcore reports every step of opening a connection. A request that doesn't trigger these reused one.
+    with _stats_lock:
+        if event_name == "connection.connect_tcp.complete":
+            _connection_stats["new_connections"] += 1
+        elif event_name == "connection.start_tls.complete":
+            _connection_stats["tls_handshakes"] += 1
+
+
+def _trace(event_name, info):
+    _record(event_name)
+
+
+async def _async_trace(event_name, info):
+    _record(event_name)
+
+
+def _on_request(request):
+    with _stats_lock:
+        _connection_stats["requests"] += 1
+    request.extensions["trace"] = _trace
+
+
+async def _on_async_request(request):
+    with _stats_lock:
+        _connection_stats["requests"] += 1
+    request.extensions["trace"] = _async_trace
+
+
+def _pool_limits():
+    return httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _get_http_clients():
+    global _sync_http_client, _async_http_client
+    if _sync_http_client is None:
+        _sync_http_client = httpx.Client(
+            limits=_pool_limits(),
+            timeout=settings.LLM_TIMEOUT,
+            event_hooks={"request": [_on_request]},
+        )
+    if _async_http_client is None:
+        _async_http_client = httpx.AsyncClient(
+            limits=_pool_limits(),
+            timeout=settings.LLM_TIMEOUT,
+            event_hooks={"request": [_on_async_request]},
+        )
+    return _sync_http_client, _async_http_client
+
+
+def get_llm(model=None, temperature=0, max_tokens=None):
+    """Return the shared ChatAnthropic for this configuration, creating it on first use"""
+    model = model or settings.AI_MODEL
+    key = (model, temperature, max_tokens)
+
+    with _models_lock:
+        llm = _models.get(key)
+        if llm is None:
+            # No retries in the SDK, scheduler.retry_rate_limited is the one retry policy (with both, each of
+            # our retries was up to three calls)
+            options = {"model": model, "temperature": temperature, "max_retries": 0}
+            if max_tokens:
+                options["max_tokens"] = max_tokens
+            llm = ChatAnthropic(**options)
+
+            # langchain_anthropic keeps its SDK clients on the model instance. Swap them for clients that sit
+            # on our pooled HTTP connections so every model shares the same keep-alive pool.
+            sync_http, async_http = _get_http_clients()
+            client_options = {"api_key": settings.ANTHROPIC_API_KEY, "max_retries": 0}
+            llm.__dict__["_client"] = anthropic.Client(http_client=sync_http, **client_options)
+            llm.__dict__["_async_client"] = anthropic.AsyncClient(http_client=async_http, **client_options)
+
+            _models[key] = llm
+    return llm
+
+
+def connection_stats():
+    """Request and connection counters for the shared LLM pool"""
+    with _stats_lock:
+        stats = dict(_connection_stats)
+    stats["reused_connections"] = max(stats["requests"] - stats["new_connections"], 0)
+    stats["models"] = len(_models)
+    return stats
+
+
+async def close_llm_clients():
+    global _sync_http_client, _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+    if _sync_http_client is not None:
+        _sync_http_client.close()
+    _sync_http_client = None
+    _async_http_client = None
+    _models.clear()
@@ -0,0 +1,164 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+from settings import LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_MAX_CHARS, LOG_DEBUG_SAMPLE_RATE, LOG_QUEUE_SIZE
+
+# The backend used to print everything: every raw LLM response, the generated code, the first rows of every result
+# and the whole chart (base64 image included). Under load that's a lot of synchronous stdout writes on the request
+# path, and MIMIC rows don't belong in logs anyway. Now every module logs through a "dataexplorer.<stage>" logger.
+# Records go onto a queue and a background thread does the writing, each stage can have its own level, every line
+# carries the id of the chat request it came from, and the big debug dumps cost nothing unless DEBUG is on.
+
+ROOT_LOGGER = "dataexplorer"
+STAGES = ('chat', 'llm', 'query', 'cache', 'chart', 'sandbox', 'schema')
+
+_request_id = contextvars.ContextVar('request_id', default='-')
+_debug_sampled = contextvars.ContextVar('debug_sampled', default=True)
+
+_handler = None
+_listener = None
+
+
+def get_logger(stage):
+    return logging.getLogger(f"{ROOT_LOGGER}.{stage}")
+
+
+def new_request(request_id=None):
+    """Give the current context (one chat request) a correlation id, and decide if its debug dumps are kept"""
+    request_id = request_id or uuid.uuid4().hex[:12]
+    _request_id.set(request_id)
+    _debug_sampled.set(LOG_DEBUG_SAMPLE_RATE >= 1 or random.random() < LOG_DEBUG_SAMPLE_RATE)
+    return request_id
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def truncate(text, limit=None):
+    limit = LOG_MAX_CHARS if limit is None else limit
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more chars]"
+
+
+class Lazy:
+    """A log argument that's only built (and truncated) when the record actually gets formatted"""
+
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return truncate(self.func(*self.args, **self.kwargs))
+
+    __repr__ = __str__
+
+
+def debug_dump(logger, label, func, *args, **kwargs):
+    """Log func(*args) at DEBUG, truncated. func isn't even called unless DEBUG is on and this request is sampled."""
+    if logger.isEnabledFor(logging.DEBUG) and _debug_sampled.get():
+        logger.debug("%s: %s", label, Lazy(func, *args, **kwargs))
+
+
+class _RequestIdFilter(logging.Filter):
+    # Runs in the thread that logged, which is the only place the request's context variables can be read
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    # If the writer thread can't keep up we'd rather lose log lines than make requests wait for it
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _formatter():
+    if LOG_FORMAT == 'json':
+        return JsonFormatter()
+    return logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+
+def _apply_levels():
+    logging.getLogger(ROOT_LOGGER).setLevel(LOG_LEVEL)
+    # "chart=DEBUG,query=WARNING"
+    for item in LOG_LEVELS.split(','):
+        if '=' in item:
+            stage, level = item.split('=', 1)
+            get_logger(stage.strip()).setLevel(level.strip().upper())
+
+
+def configure():
+    """Send the app's logs through a queue to a background writer thread (safe to call more than once)"""
+    global _handler, _listener
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(_formatter())
+    _handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(_RequestIdFilter())
+    _listener = logging.handlers.QueueListener(_handler.queue, stream, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.addHandler(_handler)
+    root.propagate = False
+    _apply_levels()
+    atexit.register(shutdown)
+
+
+def configure_worker():
+    """Logging for the chart sandbox processes, which are single threaded and off the request path"""
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers.clear()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(_formatter())
+    stream.addFilter(_RequestIdFilter())
+    root.addHandler(stream)
+    root.propagate = False
+    _apply_levels()
+
+
+def shutdown():
+    """Write out whatever is still queued and stop the writer thread"""
+    global _handler, _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger(ROOT_LOGGER).removeHandler(_handler)
+    if _handler.dropped:
+        print(f"{_handler.dropped} log records were dropped because the log queue was full", file=sys.stderr)
+    _handler, _listener = None, None
+
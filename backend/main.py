@@ -1,13 +1,46 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from security import router as security_router
 from chat import router as chat_router
+from schema_catalog import router as schema_router, catalog
+from result_cache import router as cache_router
+from plan_cache import router as plan_router
+from chart_cache import router as chart_cache_router
+from chart_store import router as chart_store_router
+from governor import router as governor_router
+from metrics import router as metrics_router, ServerTimingMiddleware
+from scheduler import router as scheduler_router
+from sessions import router as session_router
+from llm import close_llm_clients
+import logs
+from executors import run_blocking, shutdown_executors
+from sandbox import sandbox
+from settings import SANDBOX_ENABLED
+
+# Logging goes through a queue and a writer thread from here on (see logs.py)
+logs.configure()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup work goes before the yield, cleanup after
+    # Load and format every schema once so questions never have to touch the schema files
+    await run_blocking(catalog.load)
+    # Fork the chart workers now so the first chart doesn't wait for matplotlib to import
+    if SANDBOX_ENABLED:
+        await sandbox.start()
+    yield
+    await sandbox.shutdown()
+    await close_llm_clients()
+    shutdown_executors()
+    logs.shutdown()
 
 # I used FASTAPI for my api server, it's the easiest to use in my oppinion. 
 app = FastAPI(
     title="dataexplorer API",
     description="A simple API for authentication and chat functionality",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS (I always run into CORS issues when developing with React)
@@ -17,11 +50,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Server-Timing", "Retry-After"],
 )
 
+# Server-Timing on every response, so the browser's devtools show how long the backend took (see metrics.py)
+app.add_middleware(ServerTimingMiddleware)
+
 # I like to keep my routes organized, so I have separate routers for security and chat functionality
 app.include_router(security_router, prefix="/api", tags=["Authentication"])
 app.include_router(chat_router, prefix="/api", tags=["Chat"])
+app.include_router(schema_router, prefix="/api", tags=["Schema"])
+app.include_router(cache_router, prefix="/api", tags=["Cache"])
+app.include_router(plan_router, prefix="/api", tags=["Cache"])
+app.include_router(chart_cache_router, prefix="/api", tags=["Cache"])
+app.include_router(chart_store_router, prefix="/api", tags=["Charts"])
+app.include_router(governor_router, prefix="/api", tags=["Query"])
+app.include_router(metrics_router, prefix="/api", tags=["Metrics"])
+app.include_router(scheduler_router, prefix="/api", tags=["Chat"])
+app.include_router(session_router, prefix="/api", tags=["Chat"])
 
 
 
@@ -0,0 +1,221 @@
+import contextlib
+import contextvars
+import threading
+import time
+from fastapi import APIRouter, Response
+import logs
+
+# A chat takes anywhere from 20 to 60 seconds and nothing said where that time went. Every stage of the pipeline
+# is now timed with span() (or observe() for stages that are spread over a loop), LLM calls record their token
+# counts and queries their bytes and rows. It all goes two places: Prometheus histograms at /api/metrics for the
+# dashboards (p50/p95/p99 with histogram_quantile), and the request's Trace, which chat.py sends as the last SSE
+# event ('timing') so the UI can show where this particular answer spent its time.
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+router = APIRouter()
+
+log = logs.get_logger('chat')
+
+# The pipeline in order, so the breakdown reads top to bottom. Anything else shows up after these.
+STAGES = (
+    'working_message', 'plan_cache', 'session', 'chart_check', 'schema', 'sql_generation', 'sql_validation', 'sql_repair',
+    'dry_run', 'query_rewrite', 'query', 'materialize', 'chart_profile', 'chart_codegen', 'chart_execute', 'serialize',
+)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = tuple(1024 ** power * size for power in range(1, 5) for size in (1, 16, 128))
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+if prometheus_client is not None:
+    # Our own registry, so /api/metrics is only the app's numbers and importing this twice doesn't clash
+    REGISTRY = prometheus_client.CollectorRegistry()
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'dataexplorer_stage_seconds', 'Time spent in each stage of a chat request', ['stage'],
+        buckets=SECONDS_BUCKETS, registry=REGISTRY)
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'dataexplorer_request_seconds', 'Time from receiving a chat message to the end of its stream', ['outcome'],
+        buckets=SECONDS_BUCKETS, registry=REGISTRY)
+    LLM_TOKENS = prometheus_client.Histogram(
+        'dataexplorer_llm_tokens', 'Tokens per LLM call', ['call', 'direction'],
+        buckets=TOKEN_BUCKETS, registry=REGISTRY)
+    QUERY_ROWS = prometheus_client.Histogram(
+        'dataexplorer_query_rows', 'Rows read back per query', ['engine'], buckets=ROW_BUCKETS, registry=REGISTRY)
+    QUERY_BYTES = prometheus_client.Histogram(
+        'dataexplorer_query_bytes', 'Bytes per query, scanned (dry run) and read back (result)', ['engine', 'kind'],
+        buckets=BYTE_BUCKETS, registry=REGISTRY)
+
+
+class Trace:
+    """Where one chat request's time went. Shared by every task and thread working on the request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.query = {'queries': 0, 'scanned_bytes': 0, 'rows': 0, 'bytes': 0}
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    def add_tokens(self, call, input_tokens, output_tokens):
+        with self._lock:
+            counts = self.tokens.setdefault(call, {'calls': 0, 'input': 0, 'output': 0})
+            counts['calls'] += 1
+            counts['input'] += input_tokens
+            counts['output'] += output_tokens
+
+    def add_query(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.query[name] += amount
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def _ordered_stages(self):
+        order = {stage: index for index, stage in enumerate(STAGES)}
+        return sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order)))
+
+    def server_timing(self):
+        """The breakdown in Server-Timing header syntax"""
+        with self._lock:
+            parts = [f"{stage};dur={total * 1000:.1f}" for stage, (total, _) in self._ordered_stages()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def event(self):
+        """The 'timing' SSE event"""
+        with self._lock:
+            stages = {stage: {'ms': round(total * 1000, 1), 'count': count}
+                      for stage, (total, count) in self._ordered_stages()}
+            tokens = {call: dict(counts) for call, counts in self.tokens.items()}
+            query = dict(self.query)
+        return {
+            'type': 'timing',
+            'total_ms': round(self.elapsed() * 1000, 1),
+            'stages': stages,
+            'tokens': tokens,
+            'query': query,
+            'server_timing': self.server_timing(),
+        }
+
+
+def start_trace():
+    """Start timing a request in the current context (tasks and run_blocking calls made from it share the Trace)"""
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+def finish_trace(trace, outcome):
+    if trace.finished is not None:
+        return
+    trace.finished = time.perf_counter()
+    if prometheus_client is not None:
+        REQUEST_SECONDS.labels(outcome).observe(trace.elapsed())
+    log.info("Request %s in %.2fs: %s", outcome, trace.elapsed(), logs.Lazy(trace.server_timing))
+
+
+def observe(stage, seconds):
+    """Record time spent in a stage"""
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time the block as one stage. Don't put a yield inside it, the time the consumer takes would count too."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def record_llm(call, response):
+    """Token counts for one LLM call, from the usage langchain puts on the response"""
+    usage = getattr(response, 'usage_metadata', None) or {}
+    record_tokens(call, int(usage.get('input_tokens') or 0), int(usage.get('output_tokens') or 0))
+
+
+def record_tokens(call, input_tokens, output_tokens):
+    """Token counts for one LLM call (streamed calls add theirs up from the chunks)"""
+    if not input_tokens and not output_tokens:
+        return
+    if prometheus_client is not None:
+        LLM_TOKENS.labels(call, 'input').observe(input_tokens)
+        LLM_TOKENS.labels(call, 'output').observe(output_tokens)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_tokens(call, input_tokens, output_tokens)
+
+
+def record_scan(engine, num_bytes):
+    """What the dry run says a query is going to scan"""
+    if prometheus_client is not None:
+        QUERY_BYTES.labels(engine, 'scanned').observe(num_bytes)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_query(scanned_bytes=num_bytes)
+
+
+def record_query(engine, rows, num_bytes):
+    """What a query actually returned (after the row and byte caps)"""
+    if prometheus_client is not None:
+        QUERY_ROWS.labels(engine).observe(rows)
+        QUERY_BYTES.labels(engine, 'result').observe(num_bytes)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_query(queries=1, rows=rows, bytes=num_bytes)
+
+
+class ServerTimingMiddleware:
+    """Adds Server-Timing (time until the response headers) and Timing-Allow-Origin to every HTTP response
+
+    For the chat stream that's only the setup before the first event, its full breakdown is in the 'timing' event.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', f"app;dur={(time.perf_counter() - started) * 1000:.1f}".encode()))
+                headers.append((b'timing-allow-origin', b'*'))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    """Stage latency, token and query histograms in the Prometheus text format"""
+    if prometheus_client is None:
+        return Response("prometheus_client is not installed\n", status_code=503, media_type="text/plain")
+    return Response(prometheus_client.generate_latest(REGISTRY), media_type=prometheus_client.CONTENT_TYPE_LATEST)
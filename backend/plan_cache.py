@@ -0,0 +1,195 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from security import require_admin
+from settings import PLAN_CACHE_ENABLED, PLAN_CACHE_MAX_ENTRIES, PLAN_CACHE_TTL_SECONDS
+
+# People ask the same handful of questions over and over (tests.txt is basically the daily list). Each one used to
+# cost a chart check plus the big schema/SQL prompt. The plan cache remembers what the LLM decided for a question
+# (the SQL, the ANSWER/REASONING text and the chart choice) so a repeat can go straight to running the query.
+
+router = APIRouter()
+
+NUMBER_WORDS = {
+    'zero': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9,
+    'ten': 10, 'eleven': 11, 'twelve': 12, 'thirteen': 13, 'fourteen': 14, 'fifteen': 15, 'sixteen': 16,
+    'seventeen': 17, 'eighteen': 18, 'nineteen': 19, 'twenty': 20, 'thirty': 30, 'forty': 40, 'fifty': 50,
+    'sixty': 60, 'seventy': 70, 'eighty': 80, 'ninety': 90, 'hundred': 100,
+}
+
+# Politeness doesn't change the SQL
+FILLER_WORDS = {'please', 'pls', 'kindly', 'can', 'could', 'would', 'you', 'i', 'want'}
+
+
+class Plan(NamedTuple):
+    question: str
+    response_content: str
+    sql_query: str
+    chart_analysis: dict
+    version: str
+    created: float
+    pinned: bool
+    hits: int
+
+
+def _canonical_number(match):
+    number = float(match.group(0).replace(',', ''))
+    return str(int(number)) if number.is_integer() else str(number)
+
+
+def normalize_question(question):
+    """Lowercase, drop punctuation and filler, and spell every number the same way"""
+    text = question.lower()
+    # "1,000" and "10.0" become "1000" and "10" before punctuation goes away. Only thousands separators are dropped,
+    # the comma in "aged 18,30 and 40" separates two numbers.
+    text = re.sub(r'\d{1,3}(?:,\d{3})+(?:\.\d+)?(?!\d)|\d+(?:\.\d+)?', _canonical_number, text)
+    text = re.sub(r"[^\w\s.-]|(?<!\d)[.-]|[.-](?!\d)", ' ', text)
+    words = []
+    for word in text.split():
+        if word in FILLER_WORDS:
+            continue
+        words.append(str(NUMBER_WORDS[word]) if word in NUMBER_WORDS else word)
+    return ' '.join(words)
+
+
+class PlanCache:
+    def __init__(self, max_entries=PLAN_CACHE_MAX_ENTRIES, ttl_seconds=PLAN_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, question, version):
+        """The saved plan for this question, if it was made against the same schema and prompts"""
+        if not PLAN_CACHE_ENABLED:
+            return None
+        key = normalize_question(question)
+        with self._lock:
+            plan = self._entries.get(key)
+            if plan is None:
+                self._stats["misses"] += 1
+                return None
+            # A new schema or a changed prompt means the saved SQL may be wrong now, pinned or not
+            expired = not plan.pinned and time.time() - plan.created > self.ttl_seconds
+            if plan.version != version or expired:
+                del self._entries[key]
+                self._stats["invalidations"] += 1
+                self._stats["misses"] += 1
+                return None
+            plan = plan._replace(hits=plan.hits + 1)
+            self._entries[key] = plan
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return plan
+
+    def put(self, question, response_content, sql_query, chart_analysis, version):
+        if not PLAN_CACHE_ENABLED:
+            return
+        key = normalize_question(question)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self._entries[key] = Plan(
+                question, response_content, sql_query, dict(chart_analysis), version, time.time(),
+                old.pinned if old else False, 0,
+            )
+            self._evict()
+
+    def _evict(self):
+        # Least recently used goes first, pinned plans never do
+        while len(self._entries) > self.max_entries:
+            for key, plan in self._entries.items():
+                if not plan.pinned:
+                    del self._entries[key]
+                    self._stats["evictions"] += 1
+                    break
+            else:
+                return
+
+    def set_pinned(self, question, pinned):
+        key = normalize_question(question)
+        with self._lock:
+            plan = self._entries.get(key)
+            if plan is None:
+                return None
+            plan = plan._replace(pinned=pinned)
+            self._entries[key] = plan
+            return plan
+
+    def evict(self, question):
+        with self._lock:
+            return self._entries.pop(normalize_question(question), None) is not None
+
+    def clear(self, include_pinned=False):
+        with self._lock:
+            for key in list(self._entries):
+                if include_pinned or not self._entries[key].pinned:
+                    del self._entries[key]
+
+    def entries(self):
+        with self._lock:
+            return [
+                {
+                    "key": key,
+                    "question": plan.question,
+                    "sql_query": plan.sql_query,
+                    "chart_analysis": plan.chart_analysis,
+                    "pinned": plan.pinned,
+                    "hits": plan.hits,
+                    "age_seconds": round(time.time() - plan.created, 1),
+                }
+                for key, plan in reversed(self._entries.items())
+            ]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["pinned"] = sum(1 for plan in self._entries.values() if plan.pinned)
+        return stats
+
+
+plan_cache = PlanCache()
+
+
+class PlanRequest(BaseModel):
+    question: str
+
+
+@router.get("/cache/plans")
+async def list_plans(admin: dict = Depends(require_admin)):
+    """Every saved plan, most recently used first"""
+    return {"stats": plan_cache.stats(), "plans": plan_cache.entries()}
+
+
+@router.post("/cache/plans/pin")
+async def pin_plan(request: PlanRequest, admin: dict = Depends(require_admin)):
+    """Keep a plan around no matter how full the cache gets"""
+    if plan_cache.set_pinned(request.question, True) is None:
+        raise HTTPException(status_code=404, detail="No saved plan for that question")
+    return plan_cache.stats()
+
+
+@router.post("/cache/plans/unpin")
+async def unpin_plan(request: PlanRequest, admin: dict = Depends(require_admin)):
+    if plan_cache.set_pinned(request.question, False) is None:
+        raise HTTPException(status_code=404, detail="No saved plan for that question")
+    return plan_cache.stats()
+
+
+@router.post("/cache/plans/evict")
+async def evict_plan(request: PlanRequest, admin: dict = Depends(require_admin)):
+    """Forget a plan, the next time the question is asked it goes back through the LLM"""
+    if not plan_cache.evict(request.question):
+        raise HTTPException(status_code=404, detail="No saved plan for that question")
+    return plan_cache.stats()
+
+
+@router.delete("/cache/plans")
+async def clear_plans(include_pinned: bool = False, admin: dict = Depends(require_admin)):
+    plan_cache.clear(include_pinned)
+    return plan_cache.stats()
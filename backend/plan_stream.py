@@ -0,0 +1,118 @@
+import re
+from typing import NamedTuple
+
+# The plan (see ANSWER_PROMPT_TEMPLATE in chat.py) used to be parsed once the whole response had arrived, so the
+# user watched "Analyzing schemas..." for the entire generation and the query waited for the model's closing
+# remarks. PlanParser reads the response as it streams: REASONING text comes out as it's written, and the verdict
+# and the SQL are known the moment the ANSWER line ends and the ```sql block closes.
+
+SQL_PATTERN = re.compile(r"```(?:sql)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_SQL_HEADER = re.compile(r"SQL QUERY:\s*", re.IGNORECASE)
+# Wait for the character after YES/NO, so a verdict is never read off half a word
+_VERDICT = re.compile(r"ANSWER:\s*\[?(YES|NO)(?=\W)")
+
+REASONING_HEADER = "REASONING:"
+# Whatever comes first of these ends the reasoning
+REASONING_ENDS = ("\nREQUIRED_DATA:", "\nSQL QUERY:", "```")
+
+
+def split_plan(text):
+    """(response_content, sql_query) from a plan response: the SQL only when the answer is YES, and the text
+    without the SQL block and its header"""
+    sql_query = None
+    response_content = text
+    if "ANSWER: YES" in response_content:
+        sql_match = SQL_PATTERN.search(response_content)
+        if sql_match:
+            sql_query = sql_match.group(1).strip()
+            # Remove the SQL block from the response
+            response_content = SQL_PATTERN.sub("", response_content).strip()
+        # Also remove the "SQL QUERY:" section header if it exists
+        response_content = _SQL_HEADER.sub("", response_content).strip()
+    return response_content, sql_query
+
+
+def chunk_text(chunk):
+    # Streamed chunks carry a string, or a list of content blocks depending on the langchain version
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def add_usage(totals, chunk):
+    # Streamed calls report their usage in pieces, the input tokens up front and the output tokens at the end
+    usage = getattr(chunk, "usage_metadata", None) or {}
+    for name in ("input_tokens", "output_tokens"):
+        totals[name] = totals.get(name, 0) + int(usage.get(name) or 0)
+
+
+def _held_back(text, markers):
+    # How much of the end of text could be the start of a marker, that part waits for the next piece
+    longest = 0
+    for marker in markers:
+        for size in range(min(len(marker) - 1, len(text)), longest, -1):
+            if text.endswith(marker[:size]):
+                longest = size
+                break
+    return longest
+
+
+class Update(NamedTuple):
+    reasoning: str
+    verdict: str
+    sql: str
+
+
+class PlanParser:
+    def __init__(self):
+        self.text = ""
+        self.verdict = None
+        self.sql = None
+        # Where the SQL block ends, anything after it is the LLM's closing remarks
+        self.sql_end = None
+        self._reasoning_start = None
+        self._reasoning_sent = 0
+        self._reasoning_done = False
+
+    def feed(self, piece):
+        """Add the next piece of the response. Returns an Update with the new reasoning text, and the verdict
+        and SQL if they became known with this piece (None otherwise)."""
+        self.text += piece
+        verdict = sql = None
+        if self.verdict is None:
+            match = _VERDICT.search(self.text)
+            if match:
+                self.verdict = verdict = match.group(1)
+        reasoning = self._reasoning()
+        # Only a YES comes with SQL worth running, same as split_plan. Two fences means a block has closed.
+        if self.sql is None and self.verdict == "YES" and self.text.count("```") >= 2:
+            match = SQL_PATTERN.search(self.text)
+            if match:
+                self.sql = sql = match.group(1).strip()
+                self.sql_end = match.end()
+        return Update(reasoning, verdict, sql)
+
+    def _reasoning(self):
+        if self._reasoning_done:
+            return ""
+        if self._reasoning_start is None:
+            start = self.text.find(REASONING_HEADER)
+            if start == -1:
+                return ""
+            self._reasoning_start = start + len(REASONING_HEADER)
+        ends = [self.text.find(end, self._reasoning_start) for end in REASONING_ENDS]
+        ends = [end for end in ends if end != -1]
+        if ends:
+            body = self.text[self._reasoning_start:min(ends)].strip()
+            self._reasoning_done = True
+        else:
+            # Trailing whitespace waits too, it might be all that's left before the next header
+            body = self.text[self._reasoning_start:len(self.text) - _held_back(self.text, REASONING_ENDS)].strip()
+        delta = body[self._reasoning_sent:]
+        self._reasoning_sent = max(self._reasoning_sent, len(body))
+        return delta
+
+    def finish(self):
+        """(response_content, sql_query) for the complete response"""
+        return split_plan(self.text)
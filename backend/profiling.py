@@ -0,0 +1,123 @@
+import json
+import math
+import pyarrow as pa
+import pyarrow.compute as pc
+from settings import PROFILE_SAMPLE_ROWS, PROFILE_MAX_COLUMNS, PROFILE_MAX_VALUE_CHARS, PROFILE_TOP_VALUES
+
+# generate_chart_data used to paste the entire result into the prompt, so 10,000 rows meant a multi-megabyte
+# prompt. The LLM doesn't need every row to write plotting code, it needs to know the shape of the data. This
+# builds a profile (names, types, cardinality, ranges, nulls and a small stratified sample) that stays the same
+# size no matter how many rows came back. The generated code still runs against the full result.
+
+# A column with at most this many distinct values is treated as a category when picking the sample
+STRATA_MAX_VALUES = 20
+
+
+def _short(value):
+    # Keep individual values from blowing up the prompt (long text columns, blobs, ...)
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        if isinstance(value, str) and len(value) > PROFILE_MAX_VALUE_CHARS:
+            return value[:PROFILE_MAX_VALUE_CHARS] + "..."
+        return value
+    text = str(value)
+    return text[:PROFILE_MAX_VALUE_CHARS] + "..." if len(text) > PROFILE_MAX_VALUE_CHARS else text
+
+
+def _profile_column(name, column):
+    arrow_type = column.type
+    profile = {
+        "name": name,
+        "dtype": str(arrow_type),
+        "nulls": column.null_count,
+    }
+    if column.null_count == len(column):
+        profile["distinct"] = 0
+        return profile
+
+    try:
+        profile["distinct"] = pc.count_distinct(column).as_py()
+    except (pa.ArrowNotImplementedError, pa.ArrowInvalid):
+        # Nested types (arrays, structs) can't be counted, they still get a dtype and null count
+        return profile
+
+    is_orderable = (
+        pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type)
+        or pa.types.is_temporal(arrow_type)
+    )
+    if is_orderable:
+        min_max = pc.min_max(column).as_py()
+        profile["min"] = _short(min_max["min"])
+        profile["max"] = _short(min_max["max"])
+    elif pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type) or pa.types.is_boolean(arrow_type):
+        counts = pc.value_counts(column.drop_null()) if column.null_count else pc.value_counts(column)
+        counts = counts.to_pylist()
+        counts.sort(key=lambda item: item["counts"], reverse=True)
+        profile["top_values"] = [
+            {"value": _short(item["values"]), "count": item["counts"]}
+            for item in counts[:PROFILE_TOP_VALUES]
+        ]
+    return profile
+
+
+def _strata_column(table, columns):
+    # A low-cardinality text column makes a good stratum (admission_type, gender, ...)
+    for column in columns:
+        if "top_values" in column and 2 <= column.get("distinct", 0) <= STRATA_MAX_VALUES:
+            return column["name"]
+    return None
+
+
+def _sample_indices(table, strata, size):
+    num_rows = table.num_rows
+    if num_rows <= size:
+        return list(range(num_rows))
+
+    if strata:
+        # A few rows from every category, in their original order
+        values = table.column(strata)
+        categories = pc.unique(values).to_pylist()
+        per_category = max(size // max(len(categories), 1), 1)
+        indices = []
+        for category in categories:
+            mask = pc.is_null(values) if category is None else pc.equal(values, category)
+            matches = pc.indices_nonzero(pc.fill_null(mask, False)).to_pylist()
+            step = max(len(matches) // per_category, 1)
+            indices.extend(matches[::step][:per_category])
+        return sorted(indices)[:size]
+
+    # Otherwise spread the sample evenly over the result, always including the first and last row
+    step = (num_rows - 1) / (size - 1)
+    return sorted({round(i * step) for i in range(size)})
+
+
+def profile_result(query_result, sample_rows=PROFILE_SAMPLE_ROWS):
+    """A bounded description of a QueryResult for the chart code prompt (blocking, call through run_blocking)"""
+    table = query_result.table
+    names = table.column_names[:PROFILE_MAX_COLUMNS]
+    columns = [_profile_column(name, table.column(name)) for name in names]
+
+    strata = _strata_column(table, columns)
+    indices = _sample_indices(table, strata, sample_rows)
+    sample = table.select(names).take(pa.array(indices, type=pa.int64())).to_pylist() if indices else []
+    sample = [{key: _short(value) for key, value in row.items()} for row in sample]
+
+    profile = {
+        "row_count": table.num_rows,
+        "column_count": table.num_columns,
+        "columns": columns,
+        "sample": sample,
+        "sample_strategy": f"stratified by {strata}" if strata else "evenly spaced",
+    }
+    if table.num_columns > len(names):
+        profile["omitted_columns"] = table.num_columns - len(names)
+    if query_result.truncated:
+        profile["note"] = f"The query produced {query_result.total_rows} rows, data holds the first {table.num_rows}"
+    return profile
+
+
+def profile_to_prompt(profile):
+    return json.dumps(profile, indent=1, default=str)
@@ -0,0 +1,75 @@
+import pyarrow as pa
+
+# Query results used to be a Python list with a dict per row. Now they stay columnar (an Arrow table) from the
+# moment they come off the wire, and only get turned into rows at the edges that really want rows.
+
+TRUNCATED_KEY = b"dataexplorer.truncated"
+TOTAL_ROWS_KEY = b"dataexplorer.total_rows"
+
+
+class QueryResult:
+    def __init__(self, table, truncated=False, total_rows=None):
+        self.table = table
+        self.truncated = truncated
+        # How many rows the query produced, which can be more than we kept when the result was capped
+        self.total_rows = total_rows if total_rows is not None else table.num_rows
+
+    @classmethod
+    def from_batches(cls, batches, schema=None, truncated=False, total_rows=None):
+        if batches:
+            table = pa.Table.from_batches(batches)
+        else:
+            table = (schema or pa.schema([])).empty_table()
+        return cls(table, truncated, total_rows)
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls(pa.Table.from_pylist(list(rows)))
+
+    @classmethod
+    def from_arrow(cls, table):
+        # Undo to_arrow() (used by the Parquet cache tier)
+        metadata = table.schema.metadata or {}
+        truncated = metadata.get(TRUNCATED_KEY) == b"1"
+        total_rows = int(metadata[TOTAL_ROWS_KEY]) if TOTAL_ROWS_KEY in metadata else None
+        return cls(table.replace_schema_metadata(None), truncated, total_rows)
+
+    def to_arrow(self):
+        # The truncation details ride along in the schema metadata so they survive a round trip through Parquet
+        metadata = dict(self.table.schema.metadata or {})
+        metadata[TRUNCATED_KEY] = b"1" if self.truncated else b"0"
+        metadata[TOTAL_ROWS_KEY] = str(self.total_rows).encode()
+        return self.table.replace_schema_metadata(metadata)
+
+    @property
+    def num_rows(self):
+        return self.table.num_rows
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    @property
+    def column_names(self):
+        return list(self.table.column_names)
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def to_pylist(self):
+        return self.table.to_pylist()
+
+    def to_pandas(self):
+        return self.table.to_pandas()
+
+    def head(self, count):
+        return self.table.slice(0, count).to_pylist()
+
+    def summary(self):
+        return {
+            "rows": self.num_rows,
+            "total_rows": self.total_rows,
+            "columns": self.column_names,
+            "bytes": self.nbytes,
+            "truncated": self.truncated,
+        }
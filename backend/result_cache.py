@@ -0,0 +1,235 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from fastapi import APIRouter, Depends
+import pyarrow.parquet as pq
+from executors import run_blocking
+from engines import routing_key
+import logs
+from query_result import QueryResult
+from security import require_admin
+from settings import (
+    DATASET_VERSION,
+    RESULT_CACHE_ENABLED,
+    RESULT_CACHE_MAX_BYTES,
+    RESULT_CACHE_TTL_SECONDS,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_DISK_MAX_BYTES,
+)
+
+# MIMIC-IV is a static, versioned dataset, so the same SQL always returns the same rows. Rather than paying
+# BigQuery latency (and scan cost) every time the LLM writes a query we've already run, keep the results
+# around: an in-memory LRU bounded by bytes, plus an optional Parquet tier on disk that survives restarts.
+
+router = APIRouter()
+
+log = logs.get_logger('cache')
+
+# Pull out string literals, quoted identifiers and comments so normalizing never touches what's inside quotes
+_SQL_PARTS = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|--[^\n]*|/\*.*?\*/)", re.DOTALL)
+
+
+def normalize_sql(sql):
+    """Collapse whitespace and comments so trivially different SQL maps to the same cache entry"""
+    parts = []
+    for part in _SQL_PARTS.split(sql):
+        if not part:
+            continue
+        if part.startswith('--') or part.startswith('/*'):
+            parts.append(' ')
+        elif part[0] in "'\"`":
+            parts.append(part)
+        else:
+            # No lowercasing, BigQuery table names are case sensitive
+            parts.append(re.sub(r'\s+', ' ', part))
+    normalized = re.sub(r'\s+', ' ', ''.join(parts)).strip()
+    return normalized.rstrip(';').strip()
+
+
+def cache_key(sql, dataset_version=DATASET_VERSION):
+    # The routing goes in too, a local extract doesn't have to hold exactly the rows BigQuery has
+    digest = hashlib.sha256(f"{dataset_version}\n{routing_key()}\n{normalize_sql(sql)}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def estimate_size(result):
+    # Results are Arrow tables underneath, so they know their own size
+    return int(result.nbytes)
+
+
+class ResultCache:
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+                 disk_dir=RESULT_CACHE_DIR, disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "oversized": 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # Memory tier
+
+    def get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, size, result = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def put_memory(self, key, result, stored_at=None):
+        size = estimate_size(result)
+        with self._lock:
+            if size > self.max_bytes:
+                # One giant result would flush everything else, not worth it
+                self._stats["oversized"] += 1
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (stored_at or time.time(), size, result)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats["evictions"] += 1
+
+    # Disk tier (blocking, call through run_blocking)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.parquet")
+
+    def get_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            stored_at = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if time.time() - stored_at > self.ttl_seconds:
+            self._remove_file(path)
+            return None
+        try:
+            return QueryResult.from_arrow(pq.read_table(path)), stored_at
+        except Exception as e:
+            log.warning("Error reading cached result %s: %s", path, e)
+            self._remove_file(path)
+            return None
+
+    def put_disk(self, key, result):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            pq.write_table(result.to_arrow(), temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            # Some Arrow types don't map cleanly to Parquet, that's fine, the memory tier still has it
+            log.warning("Error writing cached result %s: %s", path, e)
+            self._remove_file(temp_path)
+            return
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.parquet'):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_file(path)
+            total -= size
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # What the pipeline calls
+
+    async def get(self, sql):
+        if not RESULT_CACHE_ENABLED:
+            return None
+        key = cache_key(sql)
+        result = self.get_memory(key)
+        if result is not None:
+            self._count("hits")
+            return result
+
+        disk_entry = await run_blocking(self.get_disk, key) if self.disk_dir else None
+        if disk_entry is not None:
+            result, stored_at = disk_entry
+            self._count("disk_hits")
+            # Promote it so the next hit doesn't touch the disk, but keep the original age for the TTL
+            self.put_memory(key, result, stored_at)
+            return result
+
+        self._count("misses")
+        return None
+
+    async def put(self, sql, result):
+        if not RESULT_CACHE_ENABLED or result is None:
+            return
+        key = cache_key(sql)
+        self.put_memory(key, result)
+        if self.disk_dir:
+            await run_blocking(self.put_disk, key, result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        stats["max_bytes"] = self.max_bytes
+        stats["disk_enabled"] = bool(self.disk_dir)
+        return stats
+
+
+result_cache = ResultCache()
+
+
+@router.get("/cache/results")
+async def result_cache_stats():
+    """Hit/miss counters and memory use for the query result cache"""
+    return result_cache.stats()
+
+
+@router.delete("/cache/results")
+async def clear_result_cache(admin: dict = Depends(require_admin)):
+    """Drop every cached result from memory (the disk tier expires on its own)"""
+    result_cache.clear()
+    return result_cache.stats()
@@ -0,0 +1,389 @@
+import asyncio
+import base64
+import multiprocessing
+import os
+import resource
+import time
+from multiprocessing.shared_memory import SharedMemory
+import pyarrow as pa
+from executors import run_blocking, run_chart
+import logs
+from chart_store import chart_store, chart_output
+from settings import (
+    SANDBOX_ENABLED,
+    SANDBOX_WORKERS,
+    SANDBOX_CPU_SECONDS,
+    SANDBOX_WALL_SECONDS,
+    SANDBOX_MEMORY_BYTES,
+)
+
+# The LLM-generated chart code used to run with exec() inside the API process, against pyplot's global state,
+# one render at a time. A runaway loop in that code froze the chart thread for everyone and a big allocation
+# could take the whole server down. Now it runs in a pool of worker processes that are forked with the plotting
+# libraries already imported and warmed up. Every job gets a CPU, wall clock and memory limit, the query result
+# goes in (and rendered images come back) through shared memory instead of being pickled through the pipe, and
+# a worker that dies or hangs is killed and replaced without the API noticing.
+
+# How long a new worker gets to import and warm up before we give up on it
+STARTUP_SECONDS = 60
+
+# Don't put more than this fraction of /dev/shm's free space into one block. tmpfs allocates lazily, so a block
+# bigger than what's left would crash whoever writes to it (SIGBUS) instead of raising.
+SHM_MAX_FRACTION = 0.5
+
+log = logs.get_logger('sandbox')
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Worker side
+
+
+def _limit_memory(max_bytes):
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_bytes = min(max_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+
+def _limit_cpu(seconds):
+    # RLIMIT_CPU counts the whole life of the process, so the limit for this job is what we've used so far plus
+    # its allowance. Going over sends SIGXCPU, which kills the worker and the parent replaces it.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + seconds + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _with_table(data, func):
+    """Call func with the job's Arrow table"""
+    kind, value, size = data
+    if kind == "inline":
+        return func(pa.ipc.open_stream(pa.py_buffer(value)).read_all())
+    block = SharedMemory(name=value)
+    buffer = table = None
+    try:
+        # No copy, the table's buffers point straight into the block
+        buffer = pa.py_buffer(block.buf[:size])
+        table = pa.ipc.open_stream(buffer).read_all()
+        return func(table)
+    finally:
+        # Everything pointing into the block has to go before it can be closed
+        del table, buffer
+        try:
+            block.close()
+        except BufferError:
+            # Something (a traceback) still holds a view, it gets unmapped when that's collected
+            pass
+
+
+def _export_image(result, mime=None):
+    # Rendered images come back as raw bytes in a shared memory block, the parent owns (and unlinks) it after.
+    # mime is what the job actually saved the image as (see chart_runtime.rendering), the data: URI says png anyway.
+    if not isinstance(result, dict):
+        return result
+    target = result.get("graphData") if isinstance(result.get("graphData"), dict) else result
+    src = target.get("src")
+    if not isinstance(src, str) or not src.startswith("data:image/") or ";base64," not in src:
+        return result
+    header, encoded = src.split(",", 1)
+    image = base64.b64decode(encoded)
+    block = SharedMemory(create=True, size=max(len(image), 1))
+    block.buf[:len(image)] = image
+    target["src"] = None
+    target["_image"] = (block.name, len(image), mime or header[len("data:"):].split(";")[0])
+    block.close()
+    return result
+
+
+def _worker_main(conn, memory_bytes):
+    import chart_runtime
+
+    logs.configure_worker()
+    _limit_memory(memory_bytes)
+    chart_runtime.warm_up()
+    conn.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        kind, args, cpu_seconds, output, request_id = job
+        logs.new_request(request_id)
+        _limit_cpu(cpu_seconds)
+        try:
+            with chart_runtime.rendering(output) as rendering:
+                if kind == "code":
+                    code, data = args
+                    result = _with_table(data, lambda table: chart_runtime.execute_chart_code(code, table.to_pylist()))
+                elif kind == "builtin":
+                    spec, data = args
+                    result = _with_table(data, lambda table: chart_runtime.render_builtin(spec, table))
+                elif kind == "fallback":
+                    result = chart_runtime.create_fallback_chart()
+                else:
+                    raise ValueError(f"Unknown sandbox job {kind}")
+            conn.send(("ok", _export_image(result, rendering.mime)))
+        except MemoryError:
+            # Whatever was half allocated is still around, start over with a fresh worker
+            conn.send(("retire", "Chart code went over the memory limit"))
+            return
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# API side
+
+
+def _shm_has_room(size):
+    try:
+        stats = os.statvfs("/dev/shm")
+    except OSError:
+        return False
+    return size <= stats.f_bavail * stats.f_frsize * SHM_MAX_FRACTION
+
+
+def _write_ipc(sink, table):
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _share_table(query_result):
+    """Put the result's Arrow table somewhere the worker can read it (blocking). Returns (block, message)."""
+    table = query_result.table
+    mock = pa.MockOutputStream()
+    _write_ipc(mock, table)
+    size = mock.size()
+
+    if not _shm_has_room(size):
+        # No room in /dev/shm (small container), the pipe still works, it's just a copy
+        sink = pa.BufferOutputStream()
+        _write_ipc(sink, table)
+        return None, ("inline", sink.getvalue().to_pybytes(), size)
+
+    block = SharedMemory(create=True, size=max(size, 1))
+    buffer = pa.py_buffer(block.buf)
+    _write_ipc(pa.FixedSizeBufferWriter(buffer), table)
+    del buffer
+    return block, ("shm", block.name, size)
+
+
+def _release(block):
+    if block is not None:
+        block.close()
+        block.unlink()
+
+
+def _import_image(result):
+    if not isinstance(result, dict):
+        return result
+    target = result.get("graphData") if isinstance(result.get("graphData"), dict) else result
+    image = target.pop("_image", None)
+    if image is None:
+        return result
+    name, size, mime = image
+    block = SharedMemory(name=name)
+    try:
+        data = bytes(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+    # Straight into the chart store, the stream only gets a reference (see chart_store.py)
+    chart_store.reference(target, data, mime)
+    return result
+
+
+def _run_inline(func, output, *args):
+    # SANDBOX_ENABLED off: same job on the chart thread in this process
+    import chart_runtime
+    with chart_runtime.rendering(output) as rendering:
+        result = func(*args)
+    return chart_store.externalize(result, rendering.mime)
+
+
+class Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.jobs = 0
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+
+class SandboxPool:
+    def __init__(self, size=SANDBOX_WORKERS):
+        self.size = size
+        self._context = None
+        self._idle = None
+        self._start_lock = None
+        self._workers = set()
+        self._stats = {"jobs": 0, "errors": 0, "timeouts": 0, "crashes": 0, "cancelled": 0, "restarts": 0,
+                       "busy_seconds": 0.0}
+
+    def _spawn(self):
+        """Start one worker and wait until it's warmed up (blocking)"""
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn, SANDBOX_MEMORY_BYTES), name="chart-sandbox", daemon=True
+        )
+        process.start()
+        # Only the worker holds its end now, so if it dies our recv() sees EOF instead of hanging
+        child_conn.close()
+        if not parent_conn.poll(STARTUP_SECONDS):
+            process.kill()
+            raise RuntimeError("Chart sandbox worker didn't start")
+        parent_conn.recv()
+        return Worker(process, parent_conn)
+
+    async def start(self):
+        if self._idle is not None:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._idle is not None:
+                return
+            # forkserver: one clean process imports the plotting libraries once and every worker is forked from
+            # it, so a replacement worker is ready in well under a second and never inherits the API's threads
+            methods = multiprocessing.get_all_start_methods()
+            self._context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if "forkserver" in methods:
+                self._context.set_forkserver_preload(["chart_runtime"])
+            workers = await asyncio.gather(*(run_blocking(self._spawn) for _ in range(self.size)))
+            idle = asyncio.Queue()
+            for worker in workers:
+                self._workers.add(worker)
+                idle.put_nowait(worker)
+            self._idle = idle
+            log.info("Chart sandbox started with %d workers", self.size)
+
+    async def shutdown(self):
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in list(self._workers):
+            await run_blocking(worker.process.join, 2)
+            worker.kill()
+        self._workers.clear()
+        self._idle = None
+
+    async def _replace(self, worker):
+        self._workers.discard(worker)
+        await run_blocking(worker.kill)
+        self._stats["restarts"] += 1
+        try:
+            fresh = await run_blocking(self._spawn)
+        except Exception as e:
+            log.error("Error restarting chart sandbox worker: %s", e)
+            # Keep the pool at size, the next attempt happens when someone needs a worker
+            self._idle.put_nowait(None)
+            return
+        self._workers.add(fresh)
+        self._idle.put_nowait(fresh)
+
+    async def _checkout(self):
+        worker = await self._idle.get()
+        if worker is None:
+            worker = await run_blocking(self._spawn)
+            self._workers.add(worker)
+        return worker
+
+    async def _run(self, kind, args, output):
+        await self.start()
+        worker = await self._checkout()
+        started = time.perf_counter()
+        healthy = False
+        try:
+            worker.conn.send((kind, args, SANDBOX_CPU_SECONDS, output, logs.current_request_id()))
+            status, value = await asyncio.wait_for(run_blocking(worker.conn.recv), SANDBOX_WALL_SECONDS)
+            healthy = status != "retire"
+            if status != "ok":
+                self._stats["errors"] += 1
+                log.warning("Chart sandbox job failed: %s", logs.truncate(value, 500))
+                return None
+            # The chart store may write the image to disk
+            return await run_blocking(_import_image, value)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            log.warning("Chart sandbox job went over %ss, killing the worker", SANDBOX_WALL_SECONDS)
+            return None
+        except asyncio.CancelledError:
+            # The request went away. Nobody wants this chart, so the worker is killed and replaced (below).
+            self._stats["cancelled"] += 1
+            raise
+        except (EOFError, OSError) as e:
+            # SIGXCPU, the OOM killer or a segfault in a C extension all end up here
+            self._stats["crashes"] += 1
+            await run_blocking(worker.process.join, 1)
+            log.warning("Chart sandbox worker died (exit code %s): %r", worker.process.exitcode, e)
+            return None
+        finally:
+            self._stats["jobs"] += 1
+            self._stats["busy_seconds"] += time.perf_counter() - started
+            worker.jobs += 1
+            if healthy:
+                self._idle.put_nowait(worker)
+            else:
+                # A replacement takes a moment, the caller already has its answer and shouldn't wait for it
+                asyncio.get_running_loop().create_task(self._replace(worker))
+
+    async def execute_chart_code(self, code, query_result, output=None):
+        """Run generated chart code against a QueryResult in a worker. None if it failed, hung or crashed."""
+        output = output or chart_output()
+        if not SANDBOX_ENABLED:
+            import chart_runtime
+            return await run_chart(_run_inline, chart_runtime.execute_chart_code, output, code, query_result)
+
+        block, data = await run_blocking(_share_table, query_result)
+        try:
+            return await self._run("code", (code, data), output)
+        finally:
+            _release(block)
+
+    async def render_builtin(self, spec, query_result, output=None):
+        """Draw a chart_builtins spec in a worker. None if it failed."""
+        output = output or chart_output()
+        if not SANDBOX_ENABLED:
+            import chart_runtime
+            return await run_chart(_run_inline, chart_runtime.render_builtin, output, spec, query_result.table)
+
+        block, data = await run_blocking(_share_table, query_result)
+        try:
+            return await self._run("builtin", (spec, data), output)
+        finally:
+            _release(block)
+
+    async def fallback_chart(self, output=None):
+        output = output or chart_output()
+        if not SANDBOX_ENABLED:
+            import chart_runtime
+            return await run_chart(_run_inline, chart_runtime.create_fallback_chart, output)
+        result = await self._run("fallback", None, output)
+        return result or {'type': 'error', 'content': 'Failed to generate chart visualization'}
+
+    def worker_pids(self):
+        return [worker.process.pid for worker in self._workers]
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["workers"] = len(self._workers)
+        stats["idle"] = self._idle.qsize() if self._idle is not None else 0
+        stats["busy_seconds"] = round(stats["busy_seconds"], 3)
+        return stats
+
+
+sandbox = SandboxPool()
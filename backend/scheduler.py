@@ -0,0 +1,313 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import random
+import time
+from fastapi import APIRouter
+import logs
+import metrics
+import sse
+from settings import (
+    SCHEDULER_ENABLED, CHAT_MAX_ACTIVE, CHAT_MAX_ACTIVE_PER_USER, LLM_CONCURRENCY, LLM_QUEUE_SIZE, QUERY_CONCURRENCY,
+    QUERY_QUEUE_SIZE, CHART_CONCURRENCY, CHART_QUEUE_SIZE, RATE_LIMIT_RETRIES, RATE_LIMIT_BACKOFF_SECONDS,
+    RATE_LIMIT_MAX_BACKOFF_SECONDS,
+)
+
+# /api/chat used to take every request it got, so at peak every chat hit Anthropic's rate limit and BigQuery's
+# concurrent query quota at once and they all failed together. Now each expensive stage (LLM calls, query execution,
+# chart rendering) has a fixed number of slots and a bounded line for them. Free slots go round-robin across users
+# (the usernames from security.py, anonymous chats share one place in the rotation) so one busy user can't starve
+# everyone else, and a chat that's waiting gets 'queue' events with its place in line. A chat that would only
+# end up in an overflowing line is turned away up front with a 429 and a Retry-After, and the 429s we get from
+# upstream anyway are retried with jittered backoff.
+
+router = APIRouter()
+
+log = logs.get_logger('chat')
+
+ANONYMOUS = None
+
+_user = contextvars.ContextVar('scheduler_user', default=ANONYMOUS)
+
+# How many recent hold times Retry-After is estimated from
+RECENT_DURATIONS = 50
+
+
+class Saturated(Exception):
+    """No room left in line. retry_after is a guess, in seconds, at when there will be."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def set_user(username):
+    """Whose turn the stages in this context (and the tasks started from it) are taking"""
+    _user.set(username)
+
+
+def current_user():
+    return _user.get()
+
+
+class Slot:
+    """One turn in a stage. wait() for it, then release() it."""
+
+    def __init__(self, stage, user):
+        self.stage = stage
+        self.user = user
+        self.granted_at = None
+        self._future = None
+
+    async def wait(self):
+        """Yields 'queue' events with the place in line until the slot is ours"""
+        stage = self.stage
+        if not SCHEDULER_ENABLED:
+            return
+        if stage.held < stage.slots and not stage.waiting:
+            stage._grant(self)
+            return
+        self._future = asyncio.get_running_loop().create_future()
+        stage._enqueue(self)
+        started = time.perf_counter()
+        try:
+            reported = None
+            while not self._future.done():
+                position = stage.position(self)
+                if position != reported:
+                    reported = position
+                    yield sse.queued(stage.name, position)
+                moved = stage.moved
+                await moved.wait()
+        except BaseException:
+            # Gone before our turn, or right as it came (nobody is going to release it then)
+            self.release()
+            raise
+        finally:
+            metrics.observe(f'queue_{stage.name}', time.perf_counter() - started)
+
+    def release(self):
+        if self.granted_at is not None:
+            self.stage._release(self)
+            self.granted_at = None
+        elif self._future is not None and not self._future.done():
+            self.stage._dequeue(self)
+
+
+class Stage:
+    """At most `slots` holders at once. Slots are handed out one user at a time in rotation, and in order of arrival
+    within a user. queue_size is enforced when chats are let in (see Scheduler.admit), a chat that's already running
+    always gets to finish, so the line can run a little past it."""
+
+    def __init__(self, name, slots, queue_size):
+        self.name = name
+        self.slots = max(slots, 1)
+        self.queue_size = queue_size
+        self.held = 0
+        self.waiting = 0
+        self.granted = 0
+        self.rejected = 0
+        self.moved = asyncio.Event()
+        # user -> their waiting slots, in the order the users get their next turn
+        self._lines = collections.OrderedDict()
+        self._durations = collections.deque(maxlen=RECENT_DURATIONS)
+
+    def slot(self, user=None):
+        return Slot(self, current_user() if user is None else user)
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        """Wait for a slot without reporting the place in line"""
+        slot = self.slot()
+        async for _ in slot.wait():
+            pass
+        try:
+            yield
+        finally:
+            slot.release()
+
+    def _notify(self):
+        moved, self.moved = self.moved, asyncio.Event()
+        moved.set()
+
+    def _grant(self, slot):
+        self.held += 1
+        self.granted += 1
+        slot.granted_at = time.perf_counter()
+        if slot._future is not None:
+            slot._future.set_result(None)
+
+    def _enqueue(self, slot):
+        self._lines.setdefault(slot.user, collections.deque()).append(slot)
+        self.waiting += 1
+
+    def _dequeue(self, slot):
+        line = self._lines.get(slot.user)
+        if line and slot in line:
+            line.remove(slot)
+            self.waiting -= 1
+            if not line:
+                del self._lines[slot.user]
+            self._notify()
+
+    def _release(self, slot):
+        self.held -= 1
+        self._durations.append(time.perf_counter() - slot.granted_at)
+        self._grant_next()
+
+    def _grant_next(self):
+        granted = False
+        while self.held < self.slots and self._lines:
+            user, line = next(iter(self._lines.items()))
+            slot = line.popleft()
+            self.waiting -= 1
+            # This user had their turn, the next one goes to someone else
+            if line:
+                self._lines.move_to_end(user)
+            else:
+                del self._lines[user]
+            self._grant(slot)
+            granted = True
+        if granted:
+            self._notify()
+
+    def position(self, slot):
+        """1 means next. Everyone with a line gets one turn per round, so it's the turns before ours."""
+        users = list(self._lines)
+        line = self._lines.get(slot.user, ())
+        rounds = list(line).index(slot) if slot in line else 0
+        ahead = 0
+        for user in users:
+            if user == slot.user:
+                ahead += rounds
+                continue
+            # Users ahead of ours in the rotation get a turn in the round we're served in, the rest don't
+            before = users.index(user) < users.index(slot.user)
+            ahead += min(len(self._lines[user]), rounds + (1 if before else 0))
+        return ahead + 1
+
+    def mean_duration(self):
+        return sum(self._durations) / len(self._durations) if self._durations else 1.0
+
+    def retry_after(self):
+        # Time for the line in front of a new arrival to clear
+        return max(1, round((self.waiting + 1) / self.slots * self.mean_duration()))
+
+    def stats(self):
+        return {
+            'slots': self.slots,
+            'held': self.held,
+            'waiting': self.waiting,
+            'queue_size': self.queue_size,
+            'granted': self.granted,
+            'rejected': self.rejected,
+            'mean_seconds': round(self.mean_duration(), 3),
+        }
+
+
+class Scheduler:
+    def __init__(self):
+        self.llm = Stage('llm', LLM_CONCURRENCY, LLM_QUEUE_SIZE)
+        self.query = Stage('query', QUERY_CONCURRENCY, QUERY_QUEUE_SIZE)
+        self.chart = Stage('chart', CHART_CONCURRENCY, CHART_QUEUE_SIZE)
+        self.stages = (self.llm, self.query, self.chart)
+        self.active = collections.Counter()
+        self.rejected = 0
+        self.rate_limited = 0
+        self._chat_durations = collections.deque(maxlen=RECENT_DURATIONS)
+
+    def admit(self, user):
+        """Let a chat in, or raise Saturated if it would only wait in an overflowing line. Returns a function
+        to call when the chat is over."""
+        if not SCHEDULER_ENABLED:
+            return lambda: None
+        chat_seconds = (sum(self._chat_durations) / len(self._chat_durations)) if self._chat_durations else 10.0
+        if sum(self.active.values()) >= CHAT_MAX_ACTIVE:
+            self.rejected += 1
+            raise Saturated("The server is busy, try again shortly", max(1, round(chat_seconds)))
+        # Anonymous chats could be anyone, only CHAT_MAX_ACTIVE holds them back
+        if user is not ANONYMOUS and self.active[user] >= CHAT_MAX_ACTIVE_PER_USER:
+            self.rejected += 1
+            raise Saturated(f"You already have {self.active[user]} questions running, wait for one to finish",
+                            max(1, round(chat_seconds)))
+        full = [stage for stage in self.stages if stage.waiting >= stage.queue_size]
+        if full:
+            self.rejected += 1
+            for stage in full:
+                stage.rejected += 1
+            raise Saturated(f"Too many requests waiting for {full[0].name}, try again shortly",
+                            max(stage.retry_after() for stage in full))
+        self.active[user] += 1
+        started = time.perf_counter()
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.active[user] -= 1
+            if not self.active[user]:
+                del self.active[user]
+            self._chat_durations.append(time.perf_counter() - started)
+
+        return release
+
+    def stats(self):
+        return {
+            'enabled': SCHEDULER_ENABLED,
+            'active_chats': sum(self.active.values()),
+            'active_users': len(self.active),
+            'rejected': self.rejected,
+            'rate_limited': self.rate_limited,
+            'stages': {stage.name: stage.stats() for stage in self.stages},
+        }
+
+
+scheduler = Scheduler()
+
+
+def is_rate_limited(error):
+    # Anthropic's errors have status_code, Google's have code. BigQuery reports some quotas as 403 rateLimitExceeded.
+    # Anthropic's 529 means it's overloaded, which backing off is just as much the answer to.
+    if getattr(error, 'status_code', None) in (429, 529) or getattr(error, 'code', None) == 429:
+        return True
+    return 'rateLimitExceeded' in str(error)
+
+
+def _retry_after_header(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    # Full jitter, anywhere up to the exponential cap, so everyone who got limited at once doesn't come back at once
+    delay = random.uniform(0, min(RATE_LIMIT_MAX_BACKOFF_SECONDS, RATE_LIMIT_BACKOFF_SECONDS * 2 ** attempt))
+    hinted = _retry_after_header(error) if error is not None else None
+    return max(delay, hinted) if hinted else delay
+
+
+async def retry_rate_limited(call, *args, **kwargs):
+    """await call(*args, **kwargs), again after a backoff while upstream says we're over its rate limit"""
+    attempt = 0
+    while True:
+        try:
+            return await call(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limited(e) or attempt >= RATE_LIMIT_RETRIES:
+                raise
+            delay = backoff_delay(attempt, e)
+            attempt += 1
+            scheduler.rate_limited += 1
+            log.warning("Rate limited (%s), retry %d of %d in %.1fs", e, attempt, RATE_LIMIT_RETRIES, delay)
+            await asyncio.sleep(delay)
+
+
+@router.get("/scheduler")
+async def scheduler_stats():
+    """Slots, lines and rejections for each stage"""
+    return scheduler.stats()
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import NamedTuple
+from fastapi import APIRouter, Depends
+from executors import run_blocking
+from engines import engine_for_dataset
+from security import require_admin
+import logs
+from settings import DATASETS, SCHEMA_DIR, SCHEMA_MTIME_CHECK_SECONDS
+
+# answer_question used to re-open and re-parse the schema files and rebuild the prompt text on every question.
+# The catalog loads everything once at startup, keeps it in read-only structures along with the finished prompt
+# text, and only goes back to disk when a file's mtime changes (or someone hits /api/schema/refresh).
+
+router = APIRouter()
+
+log = logs.get_logger('schema')
+
+
+class Column(NamedTuple):
+    name: str
+    type: str
+    description: str
+
+
+class Table(NamedTuple):
+    name: str
+    description: str
+    num_rows: int
+    columns: tuple
+
+
+class DatasetSchema(NamedTuple):
+    full_name: str
+    tables: MappingProxyType
+    table_texts: MappingProxyType
+    prompt_text: str
+    source: str
+    mtime: float
+
+
+SCHEMA_HEADER = "Available BigQuery tables and columns:\n\n"
+
+
+def format_schema_for_prompt(tables):
+    #Format schema information for the LLM prompt, this just makes it easier for the LLM to read and understand
+    parts = [SCHEMA_HEADER]
+    for table in tables:
+        parts.append(format_table_for_prompt(table))
+    return "".join(parts)
+
+
+def format_table_for_prompt(table):
+    lines = [
+        f"Table: {table.name}",
+        f"Description: {table.description}",
+        f"Rows: {table.num_rows or 0:,}",
+        "Columns:",
+    ]
+    lines.extend(f"  - {col.name} ({col.type}): {col.description}" for col in table.columns)
+    return "\n".join(lines) + "\n\n"
+
+
+def _build_tables(schema_info):
+    # Turn the raw JSON dict into read-only tuples so nothing downstream can mutate the shared copy
+    tables = {}
+    for table_name, table_info in schema_info.items():
+        columns = tuple(
+            Column(col['name'], col['type'], col.get('description') or 'No description')
+            for col in table_info['columns']
+        )
+        tables[table_name] = Table(
+            table_name,
+            table_info.get('description') or 'No description',
+            table_info.get('num_rows') or 0,
+            columns,
+        )
+    return MappingProxyType(tables)
+
+
+def schema_filename(dataset_id):
+    return os.path.join(SCHEMA_DIR, f'{dataset_id}_schema.json')
+
+
+def fetch_bigquery_schema(project_id, dataset_id):
+    """Read table and column metadata from BigQuery (blocking). Only used when there is no local schema file."""
+    schema_info = engine_for_dataset(f"{project_id}:{dataset_id}").fetch_schema(f"{project_id}:{dataset_id}")
+
+    # Save schema_info to a file, this will allow us to use the schema in the future without having to query BigQuery again
+    with open(schema_filename(dataset_id), 'w') as f:
+        json.dump(schema_info, f, indent=2)
+    log.info("Schema information saved to %s, will be used for future queries", schema_filename(dataset_id))
+
+    return schema_info
+
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class SchemaCatalog:
+    def __init__(self, datasets=DATASETS):
+        self.datasets = tuple(datasets)
+        self._entries = {}
+        self._combined = {}
+        self._last_checked = 0.0
+        self._lock = threading.Lock()
+        self.version = ""
+
+    def _load_dataset(self, full_name):
+        project_id, dataset_id = full_name.split(':')
+        path = schema_filename(dataset_id)
+        schema_info = None
+        source = "file"
+        engine = engine_for_dataset(full_name)
+
+        if not engine.caches_schema:
+            # Local engines read their schema straight from the data, which is quick and never out of date
+            schema_info = engine.fetch_schema(full_name)
+            source = engine.name
+            path = None
+
+        # First, check if a local schema file exists
+        elif os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    schema_info = json.load(f)
+            except Exception as e:
+                log.warning("Error reading local schema file %s, falling back to the BigQuery API: %s", path, e)
+
+        # If no local file exists or there was an error, query BigQuery
+        if schema_info is None:
+            schema_info = fetch_bigquery_schema(project_id, dataset_id)
+            source = "bigquery"
+
+        tables = _build_tables(schema_info)
+        # Keep each table's text too, so a pruned prompt can be stitched together without formatting anything
+        table_texts = MappingProxyType({name: format_table_for_prompt(table) for name, table in tables.items()})
+        return DatasetSchema(
+            full_name,
+            tables,
+            table_texts,
+            SCHEMA_HEADER + "".join(table_texts.values()),
+            source,
+            (_file_mtime(path) if path else None) or 0.0,
+        )
+
+    def load(self, datasets=None):
+        """(Re)load the given datasets, or all of them (blocking)"""
+        names = tuple(datasets or self.datasets)
+        loaded = {name: self._load_dataset(name) for name in names}
+        with self._lock:
+            self._entries.update(loaded)
+            self._combined = {}
+            self._last_checked = time.monotonic()
+            self.version = self._compute_version()
+        return self.version
+
+    def refresh(self):
+        return self.load()
+
+    def _compute_version(self):
+        # Anything cached against the schema can key on this, so it changes whenever a schema does
+        digest = hashlib.sha256()
+        for name in sorted(self._entries):
+            digest.update(name.encode())
+            digest.update(self._entries[name].prompt_text.encode())
+        return digest.hexdigest()[:16]
+
+    def stale_datasets(self, datasets=None):
+        """Datasets that are missing or whose schema file changed on disk"""
+        names = tuple(datasets or self.datasets)
+        missing = [name for name in names if name not in self._entries]
+
+        # Checking mtimes is cheap, but there is no reason to do it on every single question
+        now = time.monotonic()
+        if now - self._last_checked < SCHEMA_MTIME_CHECK_SECONDS:
+            return missing
+        self._last_checked = now
+
+        changed = []
+        for name in names:
+            entry = self._entries.get(name)
+            if entry is None or not engine_for_dataset(name).caches_schema:
+                continue
+            mtime = _file_mtime(schema_filename(name.split(':')[1]))
+            if mtime is not None and mtime != entry.mtime:
+                changed.append(name)
+        return missing + changed
+
+    def get(self, full_name):
+        return self._entries.get(full_name)
+
+    def tables(self, full_name):
+        entry = self._entries.get(full_name)
+        return entry.tables if entry else MappingProxyType({})
+
+    def prompt_text(self, datasets=None):
+        """The complete 'Database Schemas' block for the prompt, built once per schema version"""
+        names = tuple(datasets or self.datasets)
+        text = self._combined.get(names)
+        if text is None:
+            parts = ["Database Schemas:\n\n"]
+            for name in names:
+                parts.append(f"=== {name} ===\n")
+                parts.append(self._entries[name].prompt_text)
+                parts.append("\n")
+            text = "".join(parts)
+            self._combined[names] = text
+        return text
+
+    def summary(self):
+        return {
+            "version": self.version,
+            "datasets": {
+                name: {
+                    "source": entry.source,
+                    "tables": len(entry.tables),
+                    "columns": sum(len(table.columns) for table in entry.tables.values()),
+                    "prompt_chars": len(entry.prompt_text),
+                }
+                for name, entry in self._entries.items()
+            },
+        }
+
+
+# One catalog for the whole process, loaded in main.py's lifespan
+catalog = SchemaCatalog()
+
+
+async def ensure_loaded(datasets=None):
+    # Normally a no-op. Only touches disk (or BigQuery) if a dataset is missing or its file changed.
+    stale = catalog.stale_datasets(datasets)
+    if stale:
+        await run_blocking(catalog.load, stale)
+    return catalog
+
+
+async def schema_prompt_text(datasets=None):
+    await ensure_loaded(datasets)
+    return catalog.prompt_text(datasets)
+
+
+@router.get("/schema")
+async def schema_summary():
+    """What the schema catalog currently has loaded"""
+    return catalog.summary()
+
+
+@router.post("/schema/refresh")
+async def refresh_schema(admin: dict = Depends(require_admin)):
+    """Reload every schema file (or BigQuery metadata) right now"""
+    await run_blocking(catalog.refresh)
+    return catalog.summary()
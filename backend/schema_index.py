@@ -0,0 +1,312 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import NamedTuple
+from schema_catalog import catalog
+from settings import (
+    DATASETS,
+    SCHEMA_PRUNING_ENABLED,
+    SCHEMA_TOP_K,
+    SCHEMA_TOKEN_BUDGET,
+    SCHEMA_MIN_SCORE,
+)
+
+# Shipping all 342 columns with every question is thousands of tokens, even when the question only needs
+# admissions. This is a small BM25 index over table and column names (and descriptions, when BigQuery has them)
+# that picks the few tables a question needs, plus the lookup tables they join to. When it isn't confident,
+# the full schema goes out like before.
+
+# Table names count more than column names when scoring
+TABLE_NAME_WEIGHT = 3
+
+# BM25 tuning, the usual defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Columns that tie MIMIC tables together. They show up in nearly every table, so they are useless for
+# ranking, but we do point them out so the LLM knows how to join what we send.
+JOIN_KEYS = ('subject_id', 'hadm_id', 'stay_id', 'itemid', 'icd_code', 'icd_version', 'poe_id', 'pharmacy_id', 'emar_id')
+
+STOPWORDS = {
+    'a', 'an', 'the', 'of', 'for', 'and', 'or', 'by', 'to', 'in', 'on', 'at', 'with', 'as', 'is', 'are', 'was',
+    'me', 'show', 'give', 'list', 'find', 'what', 'which', 'how', 'many', 'much', 'number', 'count', 'top', 'most',
+    'common', 'create', 'generate', 'make', 'plot', 'chart', 'graph', 'visualization', 'visualize', 'bar', 'pie',
+    'line', 'scatter', 'histogram', 'heatmap', 'box', 'horizontal', 'using', 'use', 'matplotlib', 'plotly',
+    'seaborn', 'chartjs', 'over', 'between', 'per', 'each', 'vs', 'versus', 'compare', 'showing', 'distribution',
+    'relationship', 'last', 'past', 'type', 'value', 'id',
+}
+
+# MIMIC column names are terse, so questions rarely use the same words. This maps what people ask about
+# to the words that actually appear in the schema.
+SYNONYMS = {
+    'medication': ('prescription', 'drug', 'medication', 'pharmacy'),
+    'medicine': ('prescription', 'drug', 'medication'),
+    'drug': ('prescription', 'drug'),
+    'prescribed': ('prescription', 'drug'),
+    'prescription': ('prescription', 'drug'),
+    'dosage': ('dose',),
+    'dose': ('dose',),
+    'diagnosis': ('diagnos', 'icd'),
+    'diagnos': ('diagnos', 'icd'),
+    'condition': ('diagnos', 'icd'),
+    'disease': ('diagnos', 'icd'),
+    'procedure': ('procedure',),
+    'surgery': ('procedure',),
+    'sex': ('gender',),
+    'gender': ('gender',),
+    'age': ('age', 'anchor'),
+    'old': ('age', 'anchor'),
+    'death': ('death', 'dod', 'expire'),
+    'died': ('death', 'dod', 'expire'),
+    'mortality': ('death', 'dod', 'expire', 'mortality'),
+    'los': ('los', 'icustay'),
+    'length': ('los', 'intime', 'outtime'),
+    'icu': ('icustay', 'stay'),
+    'vital': ('chartevent', 'item'),
+    'heart': ('chartevent', 'item'),
+    'pressure': ('chartevent', 'item'),
+    'temperature': ('chartevent', 'item'),
+    'lab': ('labevent', 'labitem'),
+    'laboratory': ('labevent', 'labitem'),
+    'test': ('labevent', 'labitem'),
+    'admission': ('admission', 'admit'),
+    'admit': ('admission', 'admit'),
+    'admitted': ('admission', 'admit'),
+    'hospitalization': ('admission',),
+    'emergency': ('admission',),
+    'elective': ('admission',),
+    'patient': ('patient', 'subject'),
+    'transfer': ('transfer', 'careunit'),
+    'ward': ('transfer', 'careunit'),
+    'unit': ('careunit',),
+    'culture': ('microbiologyevent', 'org', 'spec'),
+    'organism': ('microbiologyevent', 'org'),
+    'antibiotic': ('microbiologyevent', 'ab'),
+    'weight': ('patientweight', 'omr'),
+    'fluid': ('inputevent', 'outputevent'),
+    'urine': ('outputevent',),
+    'ethnicity': ('race',),
+}
+
+
+class TableMatch(NamedTuple):
+    dataset: str
+    table: str
+    score: float
+
+
+class SchemaSelection(NamedTuple):
+    prompt_text: str
+    tables: tuple
+    pruned: bool
+    reason: str
+    estimated_tokens: int
+
+
+def stem(word):
+    # Just enough stemming to line up plurals with singulars ("admissions" vs "admission")
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and (word.endswith('ses') or word.endswith('xes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'is', 'us')):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    words = re.split(r'[^a-z0-9]+', text.lower())
+    return [stem(word) for word in words if word and not word.isdigit()]
+
+
+def question_terms(question):
+    terms = []
+    for token in tokenize(question):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        terms.extend(SYNONYMS.get(token, ()))
+    return terms
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token, plenty good enough for budgeting
+    return len(text) // 4
+
+
+class BM25Index(NamedTuple):
+    docs: dict
+    doc_lengths: dict
+    avg_length: float
+    idf: dict
+
+
+class SchemaIndex:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        # (catalog version, datasets) -> BM25Index. Different dataset lists get their own index, only the current
+        # catalog version is kept.
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _build(self, datasets):
+        docs = {}
+        for name in datasets:
+            entry = self.catalog.get(name)
+            if entry is None:
+                continue
+            for table in entry.tables.values():
+                terms = tokenize(table.name) * TABLE_NAME_WEIGHT
+                if table.description != 'No description':
+                    terms += tokenize(table.description)
+                for col in table.columns:
+                    if col.name.lower() in JOIN_KEYS:
+                        continue
+                    terms += tokenize(col.name)
+                    if col.description != 'No description':
+                        terms += tokenize(col.description)
+                docs[(name, table.name)] = Counter(terms)
+
+        document_frequency = Counter()
+        for terms in docs.values():
+            document_frequency.update(terms.keys())
+        total = len(docs) or 1
+
+        doc_lengths = {key: sum(terms.values()) for key, terms in docs.items()}
+        idf = {
+            term: math.log(1 + (total - freq + 0.5) / (freq + 0.5))
+            for term, freq in document_frequency.items()
+        }
+        return BM25Index(docs, doc_lengths, (sum(doc_lengths.values()) / total) or 1.0, idf)
+
+    def ensure_current(self, datasets):
+        """The index for these datasets, rebuilt whenever the catalog reloads a schema"""
+        version = self.catalog.version
+        key = (version, tuple(sorted(datasets)))
+        index = self._indexes.get(key)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is None:
+                    index = self._build(key[1])
+                    self._indexes = {
+                        other: built for other, built in self._indexes.items() if other[0] == version
+                    }
+                    self._indexes[key] = index
+        return index
+
+    def rank(self, question, datasets=DATASETS):
+        index = self.ensure_current(datasets)
+        terms = Counter(question_terms(question))
+        matches = []
+        for key, doc in index.docs.items():
+            score = 0.0
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * index.doc_lengths[key] / index.avg_length)
+            for term, query_count in terms.items():
+                freq = doc.get(term)
+                if not freq:
+                    continue
+                score += query_count * index.idf[term] * freq * (BM25_K1 + 1) / (freq + length_norm)
+            if score > 0:
+                matches.append(TableMatch(key[0], key[1], score))
+        matches.sort(key=lambda match: match.score, reverse=True)
+        return matches
+
+    def lookup_tables(self, dataset, table_name):
+        # Dictionary tables (d_items, d_labitems, d_icd_*) that turn codes in this table into readable labels
+        entry = self.catalog.get(dataset)
+        table = entry.tables[table_name]
+        column_names = {col.name.lower() for col in table.columns}
+        name_tokens = set(tokenize(table_name))
+
+        lookups = []
+        for key in ('itemid', 'icd_code'):
+            if key not in column_names:
+                continue
+            candidates = [
+                other for other in entry.tables.values()
+                if other.name.startswith('d_') and other.name != table_name
+                and key in {col.name.lower() for col in other.columns}
+            ]
+            # When there is more than one candidate (d_icd_diagnoses vs d_icd_procedures) take the one whose name matches
+            if len(candidates) > 1:
+                candidates = [other for other in candidates if name_tokens & set(tokenize(other.name))]
+            lookups.extend(other.name for other in candidates)
+        return lookups
+
+    def select(self, question, datasets=DATASETS, top_k=SCHEMA_TOP_K, token_budget=SCHEMA_TOKEN_BUDGET,
+               min_score=SCHEMA_MIN_SCORE):
+        """Pick the tables a question needs and build the prompt text for just those"""
+        datasets = tuple(datasets)
+        full_text = self.catalog.prompt_text(datasets)
+
+        def full_schema(reason):
+            return SchemaSelection(full_text, (), False, reason, estimate_tokens(full_text))
+
+        matches = self.rank(question, datasets)
+        if not matches or matches[0].score < min_score:
+            return full_schema("low confidence")
+
+        # Keep the strong matches only, a table that barely matched is usually noise
+        cutoff = matches[0].score * 0.25
+        chosen = [match for match in matches[:top_k] if match.score >= cutoff]
+
+        selected = []
+        for match in chosen:
+            for table_name in [match.table] + self.lookup_tables(match.dataset, match.table):
+                key = (match.dataset, table_name)
+                if key not in selected:
+                    selected.append(key)
+
+        # Fill in tables in rank order until we hit the token budget (the best match always goes in)
+        entries = {name: self.catalog.get(name) for name in datasets}
+        kept = []
+        used = 0
+        for dataset, table_name in selected:
+            cost = estimate_tokens(entries[dataset].table_texts[table_name])
+            if kept and used + cost > token_budget:
+                continue
+            kept.append((dataset, table_name))
+            used += cost
+
+        text = self._render(kept, entries, datasets)
+        if len(text) >= len(full_text) * 0.8:
+            return full_schema("pruning would not save much")
+        return SchemaSelection(text, tuple(kept), True, "ranked", estimate_tokens(text))
+
+    def _render(self, kept, entries, datasets):
+        parts = ["Database Schemas (only the tables relevant to this question are shown):\n\n"]
+        for dataset in datasets:
+            names = [table_name for name, table_name in kept if name == dataset]
+            if not names:
+                continue
+            parts.append(f"=== {dataset} ===\n")
+            parts.append("Available BigQuery tables and columns:\n\n")
+            parts.extend(entries[dataset].table_texts[table_name] for table_name in names)
+            parts.append("\n")
+
+        # Tell the LLM how the tables we picked connect to each other
+        key_tables = defaultdict(list)
+        for dataset, table_name in kept:
+            for col in entries[dataset].tables[table_name].columns:
+                if col.name.lower() in JOIN_KEYS:
+                    key_tables[col.name.lower()].append(table_name)
+        joins = [f"  - {key}: {', '.join(tables)}" for key, tables in key_tables.items() if len(tables) > 1]
+        if joins:
+            parts.append("Join keys shared by these tables:\n")
+            parts.append("\n".join(joins))
+            parts.append("\n\n")
+        return "".join(parts)
+
+
+# One index for the process, rebuilt automatically whenever the catalog's version changes
+index = SchemaIndex(catalog)
+
+
+def select_schema(question, datasets=DATASETS):
+    """Schema text for the answer_question prompt, pruned to the question when pruning is turned on"""
+    if not SCHEMA_PRUNING_ENABLED:
+        text = index.catalog.prompt_text(datasets)
+        return SchemaSelection(text, (), False, "disabled", estimate_tokens(text))
+    return index.select(question, datasets)
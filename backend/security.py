@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, status
 from pydantic import BaseModel
 
 # Create router for security endpoints
@@ -6,9 +6,9 @@ router = APIRouter()
 
 # Simple user database, any onne will work I just wanted to have some kind of security because I'm using MIMIC data. 
 users = {
-    "admin": {"id": 1, "username": "admin", "password": "password", "email": "admin@example.com"},
-    "user": {"id": 2, "username": "user", "password": "123456", "email": "user@example.com"},
-    "demo": {"id": 3, "username": "demo", "password": "demo", "email": "demo@example.com"}
+    "admin": {"id": 1, "username": "admin", "password": "password", "email": "admin@example.com", "role": "admin"},
+    "user": {"id": 2, "username": "user", "password": "123456", "email": "user@example.com", "role": "user"},
+    "demo": {"id": 3, "username": "demo", "password": "demo", "email": "demo@example.com", "role": "user"}
 }
 
 # This is the model that should be submitted with a login api call. 
@@ -43,4 +43,32 @@ async def login(login_data: LoginRequest):
             "username": user["username"],
             "email": user["email"]
         }
-    }
\ No newline at end of file
+    }
+
+
+def user_from_token(token):
+    # Tokens are just "token_<username>" (see login above), so the lookup is easy
+    if not token or not token.startswith("token_"):
+        return None
+    return users.get(token[len("token_"):])
+
+
+# Dependencies for routes that need to know who is calling
+def get_current_user(authorization: str = Header(None)):
+    token = authorization[len("Bearer "):] if authorization and authorization.startswith("Bearer ") else None
+    user = user_from_token(token)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+        )
+    return user
+
+
+def require_admin(user: dict = Depends(get_current_user)):
+    if user.get("role") != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return user
@@ -0,0 +1,342 @@
+import itertools
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+from fastapi import APIRouter, Header, HTTPException
+import logs
+from plan_cache import normalize_question
+from query_result import QueryResult
+from security import user_from_token
+from settings import (
+    SESSIONS_ENABLED, SESSION_MAX_TURNS, SESSION_MAX_BYTES_PER_USER, SESSION_MAX_USERS, SESSION_TTL_SECONDS,
+)
+
+# Every message used to stand alone, so "now show that as a pie chart" or "only for 2150-2160" paid for the
+# schema analysis, the SQL and a BigQuery scan all over again, when the answer was sitting in the last result.
+# A session (one per login token) keeps the last few answers: the SQL, the columnar result and the chart choice.
+# classify() looks at a new message next to the last answer and decides whether it's a new question, a different
+# chart of the same data ('visualize'), a narrowing we can do on the rows we already have ('filter'), or a change
+# only BigQuery can make ('refine', which goes through the full pipeline with the previous question as context).
+
+router = APIRouter()
+
+log = logs.get_logger('cache')
+
+# Words that point back at the last answer. Without one of them a message is a new question.
+REFERENCE_WORDS = {
+    'that', 'it', 'this', 'those', 'these', 'them', 'same', 'instead', 'now', 'again', 'previous', 'above',
+}
+CHART_WORDS = {
+    'chart', 'graph', 'plot', 'pie', 'bar', 'line', 'scatter', 'histogram', 'heatmap', 'donut', 'area',
+    'visualize', 'visualise', 'visualization', 'visualisation',
+}
+# "only 2150-2160" points back at the last answer as clearly as "that" does
+NARROWING_WORDS = {'only', 'just'}
+# What's left of "only the top 3 of them" once the top 3 is taken out, nothing to match values against
+FILLER_WORDS = REFERENCE_WORDS | {'the', 'a', 'of', 'me', 'show', 'rows', 'results', 'ones', 'please'}
+# Past this many words a message is a question of its own, whatever words it uses
+MAX_FOLLOWUP_WORDS = 15
+
+_YEAR_RANGE = re.compile(r"\b(\d{4})\s*(?:-|–|—|to|through|until|and)\s*(\d{4})\b")
+_SINGLE_YEAR = re.compile(r"\b(?:in|for|during|only)\s+(\d{4})\b")
+_TOP = re.compile(r"\b(?:top|first)\s+(\d+)\b")
+_ONLY = re.compile(r"\b(?:only|just)\s+(?:(?:for|show|include|keep|the)\s+)*(.+?)[\s.?!]*$")
+# Columns with more distinct values than this aren't worth matching words against
+MAX_DISTINCT_VALUES = 1000
+
+_turn_ids = itertools.count(1)
+
+
+class Turn(NamedTuple):
+    id: int
+    question: str
+    response_content: str
+    sql_query: str
+    # None when it was too big to keep, a follow-up then has to go back to BigQuery
+    result: Optional[QueryResult]
+    chart_analysis: dict
+    created: float
+    size: int
+
+
+def new_turn(question, response_content, sql_query, result, chart_analysis):
+    size = int(result.nbytes) if result is not None else 0
+    return Turn(next(_turn_ids), question, response_content, sql_query, result, dict(chart_analysis), time.time(),
+                size)
+
+
+class Narrowing(NamedTuple):
+    description: str
+    apply: Callable
+    # Whether it still works on a result that was capped (only the first rows were kept)
+    works_when_truncated: bool
+
+
+class Followup(NamedTuple):
+    kind: str
+    turn: Turn
+    narrowings: tuple
+    # Whether the message also asks for a particular chart
+    mentions_chart: bool
+
+    @property
+    def key(self):
+        # Coalescing key: a follow-up means something different in every session
+        return (self.kind, self.turn.id)
+
+    def narrow(self):
+        result = self.turn.result
+        for narrowing in self.narrowings:
+            result = narrowing.apply(result)
+        return result
+
+    def describe(self):
+        return ', '.join(narrowing.description for narrowing in self.narrowings)
+
+    def question(self, message):
+        """What the answer to this message answers, for the follow-ups after it"""
+        if self.kind == 'visualize':
+            return self.turn.question
+        if self.kind == 'filter':
+            return f'{self.turn.question} ({self.describe()})'
+        return f'{self.turn.question} ({message})'
+
+    def contextual_question(self, message):
+        """The message with the previous question and SQL, for the LLM to refine"""
+        return (f'{message}\n\n(This is a follow-up to the earlier question "{self.turn.question}", '
+                f'which was answered with this SQL:\n{self.turn.sql_query}\n)')
+
+
+def _filtered(result, mask):
+    table = result.table.filter(mask)
+    return QueryResult(table, False, table.num_rows)
+
+
+def _top(count):
+    def apply(result):
+        return QueryResult(result.table.slice(0, count), False, min(count, result.num_rows))
+    return Narrowing(f'first {count} rows', apply, True)
+
+
+def _years(table, start, end):
+    low, high = min(start, end), max(start, end)
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_timestamp(column.type) or pa.types.is_date(column.type):
+            years = pc.year(column)
+        elif pa.types.is_integer(column.type) and 'year' in name.lower():
+            years = column
+        else:
+            continue
+
+        def apply(result, name=name, is_year=years is column):
+            values = result.table[name] if is_year else pc.year(result.table[name])
+            return _filtered(result, pc.and_(pc.greater_equal(values, low), pc.less_equal(values, high)))
+        span = f'{low}' if low == high else f'{low}-{high}'
+        return Narrowing(f'{name} in {span}', apply, False)
+    return None
+
+
+def _values(table, phrase):
+    # "only insulin and heparin" keeps the rows where a text column has one of those values
+    wanted = [part.strip().lower() for part in re.split(r",|\band\b|\bor\b", phrase) if part.strip()]
+    if not wanted:
+        return None
+    for name, column in zip(table.column_names, table.columns):
+        if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+            continue
+        distinct = pc.unique(column)
+        if len(distinct) > MAX_DISTINCT_VALUES:
+            continue
+        by_lower = {value.lower(): value for value in distinct.to_pylist() if value is not None}
+        if all(part in by_lower for part in wanted):
+            values = pa.array([by_lower[part] for part in wanted], type=column.type)
+
+            def apply(result, name=name, values=values):
+                return _filtered(result, pc.is_in(result.table[name], value_set=values))
+            return Narrowing(f'{name} is {", ".join(by_lower[part] for part in wanted)}', apply, False)
+    return None
+
+
+def _narrowings(message, table):
+    """What the message asks to keep, and whether it asks for anything we couldn't work out"""
+    narrowings = []
+    text = message.lower()
+    years = _YEAR_RANGE.search(text) or _SINGLE_YEAR.search(text)
+    if years:
+        start = int(years.group(1))
+        end = int(years.group(2)) if years.re is _YEAR_RANGE else start
+        narrowing = _years(table, start, end)
+        if narrowing is None:
+            return (), True
+        narrowings.append(narrowing)
+        text = text[:years.start()] + text[years.end():]
+    top = _TOP.search(text)
+    if top:
+        count = int(top.group(1))
+        text = text[:top.start()] + text[top.end():]
+    only = _ONLY.search(text)
+    phrase = set(only.group(1).split()) if only else set()
+    # "just show it as a pie chart" isn't narrowing anything
+    if phrase - FILLER_WORDS and not years and not phrase & CHART_WORDS:
+        narrowing = _values(table, only.group(1))
+        if narrowing is None:
+            return (), True
+        narrowings.append(narrowing)
+    # Filters first, then the first N of what's left
+    if top:
+        narrowings.append(_top(count))
+    return tuple(narrowings), False
+
+
+def classify(message, turn):
+    """How a message relates to the last answer (see the top of this file), None for a new question"""
+    if turn is None:
+        return None
+    all_words = normalize_question(message).split()
+    words = set(all_words)
+    if len(all_words) > MAX_FOLLOWUP_WORDS or not words & (REFERENCE_WORDS | NARROWING_WORDS):
+        return None
+    mentions_chart = bool(words & CHART_WORDS)
+    if turn.result is None:
+        return Followup('refine', turn, (), mentions_chart)
+
+    narrowings, unresolved = _narrowings(message, turn.result.table)
+    if unresolved:
+        return Followup('refine', turn, (), mentions_chart)
+    if narrowings:
+        # A capped result only has the first rows, filtering those would quietly drop matches we never fetched
+        if turn.result.truncated and not all(n.works_when_truncated for n in narrowings):
+            return Followup('refine', turn, (), mentions_chart)
+        return Followup('filter', turn, narrowings, mentions_chart)
+    if not words & REFERENCE_WORDS:
+        # "only" with nothing we could apply, and nothing pointing back: just a question
+        return None
+    if mentions_chart:
+        return Followup('visualize', turn, (), True)
+    return Followup('refine', turn, (), mentions_chart)
+
+
+class Session:
+    def __init__(self):
+        # Turn id -> Turn, least recently used first
+        self.turns = OrderedDict()
+        self.used = time.time()
+
+    @property
+    def size(self):
+        return sum(turn.size for turn in self.turns.values())
+
+    def last(self):
+        return next(reversed(self.turns.values()), None)
+
+
+class SessionStore:
+    def __init__(self, max_turns=SESSION_MAX_TURNS, max_bytes=SESSION_MAX_BYTES_PER_USER,
+                 max_users=SESSION_MAX_USERS, ttl_seconds=SESSION_TTL_SECONDS):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"followups": 0, "visualize": 0, "filter": 0, "refine": 0, "evicted_turns": 0,
+                       "evicted_sessions": 0}
+
+    def _session(self, token, create=False):
+        session = self._sessions.get(token)
+        if session is not None and time.time() - session.used > self.ttl_seconds:
+            del self._sessions[token]
+            session = None
+        if session is None and create:
+            session = self._sessions[token] = Session()
+        if session is not None:
+            session.used = time.time()
+            self._sessions.move_to_end(token)
+        return session
+
+    def followup(self, token, message):
+        """The Followup for this message in the token's session, or None when it's a new question"""
+        if not SESSIONS_ENABLED or not token:
+            return None
+        with self._lock:
+            session = self._session(token)
+            turn = session.last() if session is not None else None
+        followup = classify(message, turn)
+        if followup is not None:
+            with self._lock:
+                self._stats["followups"] += 1
+                self._stats[followup.kind] += 1
+                if session is not None and turn.id in session.turns:
+                    session.turns.move_to_end(turn.id)
+        return followup
+
+    def remember(self, token, turn):
+        if not SESSIONS_ENABLED or not token or user_from_token(token) is None:
+            return
+        if turn.size > self.max_bytes:
+            # Keep what the question was, not the rows
+            turn = turn._replace(result=None, size=0)
+        with self._lock:
+            session = self._session(token, create=True)
+            session.turns[turn.id] = turn
+            # Per user: the oldest used turns go first, the one just answered stays
+            while len(session.turns) > self.max_turns or session.size > self.max_bytes:
+                session.turns.popitem(last=False)
+                self._stats["evicted_turns"] += 1
+            while len(self._sessions) > self.max_users:
+                self._sessions.popitem(last=False)
+                self._stats["evicted_sessions"] += 1
+
+    def forget(self, token):
+        with self._lock:
+            return self._sessions.pop(token, None) is not None
+
+    def describe(self, token):
+        with self._lock:
+            session = self._session(token)
+            turns = list(session.turns.values()) if session is not None else []
+        return [
+            {
+                "question": turn.question,
+                "sql_query": turn.sql_query,
+                "chart_analysis": turn.chart_analysis,
+                "rows": turn.result.num_rows if turn.result is not None else None,
+                "bytes": turn.size,
+                "age_seconds": round(time.time() - turn.created, 1),
+            }
+            for turn in reversed(turns)
+        ]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["sessions"] = len(self._sessions)
+            stats["turns"] = sum(len(session.turns) for session in self._sessions.values())
+            stats["bytes"] = sum(session.size for session in self._sessions.values())
+        return stats
+
+
+session_store = SessionStore()
+
+
+def _token(authorization):
+    token = authorization[len("Bearer "):] if authorization and authorization.startswith("Bearer ") else None
+    if user_from_token(token) is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return token
+
+
+@router.get("/session")
+async def get_session(authorization: Optional[str] = Header(None)):
+    """What follow-up questions can build on, most recent first"""
+    return {"turns": session_store.describe(_token(authorization)), "stats": session_store.stats()}
+
+
+@router.delete("/session")
+async def clear_session(authorization: Optional[str] = Header(None)):
+    """Start over, the next message is a new question whatever it says"""
+    return {"cleared": session_store.forget(_token(authorization))}
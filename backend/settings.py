@@ -0,0 +1,175 @@
+import os
+
+# Everything that used to be hardcoded at the top of chat.py lives here now, so every module reads the
+# same values. Anything can be overridden with an environment variable of the same name.
+
+# Since this is my personal anthropic api key, I don't want to share it... I may add some logic to test and see if the key is not null
+# before starting. This will ensure someone does not accidently run it without a key.
+ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "Add your own key here")
+os.environ["ANTHROPIC_API_KEY"] = ANTHROPIC_API_KEY
+
+AI_MODEL = os.environ.get("AI_MODEL", "claude-3-7-sonnet-20250219")
+
+# MIMIC-IV is versioned and never changes underneath us. Cached query results are keyed on this, so bump it
+# when the datasets move to a new release.
+DATASET_VERSION = os.environ.get("DATASET_VERSION", "mimiciv_3_1")
+
+# I can add any dataset names to this list and the tool will automatically analyze them to see if they can be used to answer questions
+DATASETS = 'physionet-data:mimiciv_3_1_icu','physionet-data:mimiciv_3_1_hosp'
+
+# BigQuery project that queries are billed to
+BIGQUERY_PROJECT = os.environ.get("BIGQUERY_PROJECT", "mimiciii-eric")
+
+# Result ingestion. Results are read a page at a time and cut off at whichever cap comes first, the client
+# is told when that happens.
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", "100000"))
+QUERY_MAX_BYTES = int(os.environ.get("QUERY_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_PAGE_SIZE = int(os.environ.get("QUERY_PAGE_SIZE", "10000"))
+QUERY_PROGRESS_INTERVAL_SECONDS = float(os.environ.get("QUERY_PROGRESS_INTERVAL_SECONDS", "0.5"))
+QUERY_USE_STORAGE_API = os.environ.get("QUERY_USE_STORAGE_API", "true").lower() == "true"
+
+# Result profile sent to the chart code LLM in place of the raw rows
+PROFILE_SAMPLE_ROWS = int(os.environ.get("PROFILE_SAMPLE_ROWS", "15"))
+PROFILE_MAX_COLUMNS = int(os.environ.get("PROFILE_MAX_COLUMNS", "40"))
+PROFILE_MAX_VALUE_CHARS = int(os.environ.get("PROFILE_MAX_VALUE_CHARS", "80"))
+PROFILE_TOP_VALUES = int(os.environ.get("PROFILE_TOP_VALUES", "5"))
+
+# Schema catalog. The <dataset>_schema.json files live next to the code, and the catalog re-checks their
+# mtimes at most this often.
+SCHEMA_DIR = os.environ.get("SCHEMA_DIR", os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_MTIME_CHECK_SECONDS = float(os.environ.get("SCHEMA_MTIME_CHECK_SECONDS", "5"))
+
+# Schema pruning. Only the top matching tables (plus their lookup tables) go into the SQL prompt, up to a
+# token budget. If the best match scores under SCHEMA_MIN_SCORE we send the full schema instead.
+SCHEMA_PRUNING_ENABLED = os.environ.get("SCHEMA_PRUNING_ENABLED", "true").lower() == "true"
+SCHEMA_TOP_K = int(os.environ.get("SCHEMA_TOP_K", "4"))
+SCHEMA_TOKEN_BUDGET = int(os.environ.get("SCHEMA_TOKEN_BUDGET", "1500"))
+SCHEMA_MIN_SCORE = float(os.environ.get("SCHEMA_MIN_SCORE", "2.0"))
+
+# LLM connection pool. One pool is shared by every Claude call in the process, so after the first
+# request the TLS handshake is already done and the connection just gets reused.
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "120"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "120"))
+
+# Query result cache. Memory is an LRU bounded by bytes. Setting RESULT_CACHE_DIR adds a Parquet tier on disk.
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESULT_CACHE_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Plan cache. Maps a normalized question to the SQL, answer text and chart choice the LLM produced for it.
+PLAN_CACHE_ENABLED = os.environ.get("PLAN_CACHE_ENABLED", "true").lower() == "true"
+PLAN_CACHE_MAX_ENTRIES = int(os.environ.get("PLAN_CACHE_MAX_ENTRIES", "500"))
+PLAN_CACHE_TTL_SECONDS = float(os.environ.get("PLAN_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Chart sandbox. Generated chart code runs in a pool of worker processes, each job with its own limits.
+# A job that runs out of time or memory (or crashes) costs us a worker, which gets replaced, and the user
+# gets the fallback chart.
+SANDBOX_ENABLED = os.environ.get("SANDBOX_ENABLED", "true").lower() == "true"
+SANDBOX_WORKERS = int(os.environ.get("SANDBOX_WORKERS", str(min(os.cpu_count() or 1, 4))))
+SANDBOX_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", "20"))
+SANDBOX_WALL_SECONDS = float(os.environ.get("SANDBOX_WALL_SECONDS", "30"))
+SANDBOX_MEMORY_BYTES = int(os.environ.get("SANDBOX_MEMORY_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Chart code. Common chart types over simple result shapes are drawn by built-in renderers without asking the
+# LLM, and code the LLM wrote is reused for any result with the same library, chart type and columns.
+CHART_BUILTINS_ENABLED = os.environ.get("CHART_BUILTINS_ENABLED", "true").lower() == "true"
+CHART_CACHE_ENABLED = os.environ.get("CHART_CACHE_ENABLED", "true").lower() == "true"
+CHART_CACHE_MAX_ENTRIES = int(os.environ.get("CHART_CACHE_MAX_ENTRIES", "500"))
+
+# Chart images. matplotlib/seaborn charts are rendered at the DPI that fills the width the browser will show them
+# at (times its pixel ratio), in CHART_IMAGE_FORMAT (png, webp or svg). The bytes are kept in a content addressed
+# store served from /api/charts/<hash>, so the chat stream only carries a reference.
+CHART_IMAGE_FORMAT = os.environ.get("CHART_IMAGE_FORMAT", "webp").lower()
+CHART_DISPLAY_WIDTH = int(os.environ.get("CHART_DISPLAY_WIDTH", "800"))
+CHART_PIXEL_RATIO = float(os.environ.get("CHART_PIXEL_RATIO", "2"))
+CHART_MIN_DPI = int(os.environ.get("CHART_MIN_DPI", "50"))
+CHART_MAX_DPI = int(os.environ.get("CHART_MAX_DPI", "200"))
+CHART_STORE_MAX_BYTES = int(os.environ.get("CHART_STORE_MAX_BYTES", str(128 * 1024 * 1024)))
+# The store above is memory in this process, so with more than one API worker /api/charts/<hash> would 404 whenever
+# the request lands on another worker than the one that rendered the chart. Setting CHART_STORE_DIR (a charts folder
+# next to the cached results when RESULT_CACHE_DIR is set) keeps the images on disk too, where every worker finds them.
+CHART_STORE_DIR = os.environ.get("CHART_STORE_DIR", os.path.join(RESULT_CACHE_DIR, "charts") if RESULT_CACHE_DIR else "")
+CHART_STORE_DISK_MAX_BYTES = int(os.environ.get("CHART_STORE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Plotly data reduction. Line and scatter traces are decimated to this many points in total (LTTB for lines, min/max
+# buckets for markers) and raw histograms are binned server side. Numeric arrays go out as base64 typed arrays.
+CHART_POINT_BUDGET = int(os.environ.get("CHART_POINT_BUDGET", "5000"))
+CHART_HISTOGRAM_MAX_BINS = int(os.environ.get("CHART_HISTOGRAM_MAX_BINS", "200"))
+CHART_TYPED_ARRAYS = os.environ.get("CHART_TYPED_ARRAYS", "true").lower() == "true"
+
+# Logging. Log calls only put the record on a queue (LOG_QUEUE_SIZE records, extra ones are dropped) and a background
+# thread writes them. LOG_LEVELS sets levels per stage (chat, llm, query, cache, chart, sandbox, schema), for example
+# "chart=DEBUG,query=WARNING". Debug dumps (LLM responses, generated code, chart payloads) are cut to LOG_MAX_CHARS
+# and only kept for LOG_DEBUG_SAMPLE_RATE of requests. LOG_FORMAT is text or json.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", "2000"))
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# Query governor. Every generated query gets a BigQuery dry run before it runs. A query may scan at most
+# QUERY_SCAN_MAX_BYTES, and no more than what's left of the user's and the global budget for the window. Over that
+# the LLM gets QUERY_REWRITE_ATTEMPTS tries to make it cheaper before the query is refused. QUERY_PRICE_PER_TB is
+# only used for the cost shown to the user.
+GOVERNOR_ENABLED = os.environ.get("GOVERNOR_ENABLED", "true").lower() == "true"
+QUERY_SCAN_MAX_BYTES = int(os.environ.get("QUERY_SCAN_MAX_BYTES", str(20 * 1024 ** 3)))
+QUERY_USER_SCAN_BUDGET_BYTES = int(os.environ.get("QUERY_USER_SCAN_BUDGET_BYTES", str(200 * 1024 ** 3)))
+QUERY_GLOBAL_SCAN_BUDGET_BYTES = int(os.environ.get("QUERY_GLOBAL_SCAN_BUDGET_BYTES", str(1024 ** 4)))
+QUERY_BUDGET_WINDOW_SECONDS = float(os.environ.get("QUERY_BUDGET_WINDOW_SECONDS", str(24 * 3600)))
+QUERY_REWRITE_ATTEMPTS = int(os.environ.get("QUERY_REWRITE_ATTEMPTS", "1"))
+QUERY_ADD_LIMIT = os.environ.get("QUERY_ADD_LIMIT", "true").lower() == "true"
+QUERY_PRICE_PER_TB = float(os.environ.get("QUERY_PRICE_PER_TB", "6.25"))
+
+# SQL validation. Generated SQL is parsed and checked against the schema catalog before anything goes to BigQuery.
+# Local problems and BigQuery errors are sent back to the LLM for a fix, at most SQL_REPAIR_ATTEMPTS times.
+SQL_VALIDATION_ENABLED = os.environ.get("SQL_VALIDATION_ENABLED", "true").lower() == "true"
+SQL_REPAIR_ATTEMPTS = int(os.environ.get("SQL_REPAIR_ATTEMPTS", "2"))
+
+# Query engines. Each dataset runs on QUERY_ENGINE (bigquery or duckdb) unless QUERY_ENGINE_ROUTES says otherwise,
+# for example "physionet-data:mimiciv_3_1_hosp=duckdb". The DuckDB engine reads Parquet extracts laid out as
+# DUCKDB_PARQUET_DIR/<dataset>/<table>.parquet (or a <table>/ folder of parquet files).
+QUERY_ENGINE = os.environ.get("QUERY_ENGINE", "bigquery").lower()
+QUERY_ENGINE_ROUTES = os.environ.get("QUERY_ENGINE_ROUTES", "")
+DUCKDB_PARQUET_DIR = os.environ.get("DUCKDB_PARQUET_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "extracts"))
+DUCKDB_THREADS = int(os.environ.get("DUCKDB_THREADS", str(os.cpu_count() or 1)))
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT", "4GB")
+
+# Chat streams. While a stage is working and there's nothing to send, a keep-alive comment goes out every
+# SSE_HEARTBEAT_SECONDS so proxies don't close the connection. A client that disconnects cancels the whole request.
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "15"))
+
+# Request coalescing. Chats asking the same question at the same time (and queries with the same SQL) run once, and
+# every request follows that one run, getting the events it missed first.
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "true").lower() == "true"
+
+# Admission control. LLM calls, query execution and chart rendering each have a number of slots (*_CONCURRENCY) and a
+# line of at most *_QUEUE_SIZE waiting for them, served round-robin across users. A chat is turned away with a 429
+# when CHAT_MAX_ACTIVE chats are running, a logged in user already has CHAT_MAX_ACTIVE_PER_USER, or a stage's line is
+# full. Upstream 429s are retried RATE_LIMIT_RETRIES times with jittered exponential backoff.
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").lower() == "true"
+CHAT_MAX_ACTIVE = int(os.environ.get("CHAT_MAX_ACTIVE", "64"))
+CHAT_MAX_ACTIVE_PER_USER = int(os.environ.get("CHAT_MAX_ACTIVE_PER_USER", "4"))
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", "64"))
+QUERY_CONCURRENCY = int(os.environ.get("QUERY_CONCURRENCY", "8"))
+QUERY_QUEUE_SIZE = int(os.environ.get("QUERY_QUEUE_SIZE", "64"))
+CHART_CONCURRENCY = int(os.environ.get("CHART_CONCURRENCY", str(SANDBOX_WORKERS)))
+CHART_QUEUE_SIZE = int(os.environ.get("CHART_QUEUE_SIZE", "64"))
+RATE_LIMIT_RETRIES = int(os.environ.get("RATE_LIMIT_RETRIES", "4"))
+RATE_LIMIT_BACKOFF_SECONDS = float(os.environ.get("RATE_LIMIT_BACKOFF_SECONDS", "1"))
+RATE_LIMIT_MAX_BACKOFF_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_BACKOFF_SECONDS", "30"))
+
+# Conversation sessions. Each logged in user's last SESSION_MAX_TURNS answers (SQL, result rows and chart choice) are
+# kept for follow-ups like "show that as a pie chart" or "only 2150-2160", at most SESSION_MAX_BYTES_PER_USER of
+# results per user with the least recently used answer going first. SESSION_MAX_USERS sessions at most, and a
+# session is dropped after SESSION_TTL_SECONDS without a message.
+SESSIONS_ENABLED = os.environ.get("SESSIONS_ENABLED", "true").lower() == "true"
+SESSION_MAX_TURNS = int(os.environ.get("SESSION_MAX_TURNS", "5"))
+SESSION_MAX_BYTES_PER_USER = int(os.environ.get("SESSION_MAX_BYTES_PER_USER", str(64 * 1024 * 1024)))
+SESSION_MAX_USERS = int(os.environ.get("SESSION_MAX_USERS", "500"))
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", str(4 * 3600)))
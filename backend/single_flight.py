@@ -0,0 +1,103 @@
+import asyncio
+import logs
+
+# When a dashboard link gets shared, a dozen people ask the same question within seconds and each of them paid for
+# the chart check, the plan, the BigQuery job and the chart. A SingleFlight runs an async generator once per key and
+# lets every concurrent caller with the same key follow that one run. Callers that join late get everything they
+# missed first, so each of them sees the whole stream. chat.py uses one for whole chats (keyed on the normalized
+# question) and one for query execution (keyed on the SQL), so different questions that end up with the same query
+# share the job too.
+
+log = logs.get_logger('cache')
+
+
+class Flight:
+    """One run of an async generator, with everything it has produced so far"""
+
+    def __init__(self, source):
+        self.items = []
+        self.error = None
+        self.done = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(source))
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _run(self, source):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except Exception as e:
+            # Every subscriber gets it, the task itself ends quietly
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def follow(self):
+        """Every item from the start, then the new ones as they come"""
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.items):
+                yield self.items[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+    def cancel(self):
+        self.task.cancel()
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self.started = 0
+        self.joined = 0
+        self.cancelled = 0
+
+    async def run(self, key, start):
+        """The items of start(), which is only called when nothing with this key is running already. The run is
+        cancelled once every caller following it has gone away."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = Flight(start())
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+            log.info("Joined a running %s (%d items in, %d following)", self.name, len(flight.items),
+                     flight.subscribers)
+        flight.subscribers += 1
+        try:
+            async for item in flight.follow():
+                yield item
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                # Nobody is listening any more, and nobody new should join something that's being cancelled
+                self._forget(key, flight)
+                self.cancelled += 1
+                flight.cancel()
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'subscribers': sum(flight.subscribers for flight in self._flights.values()),
+            'started': self.started,
+            'joined': self.joined,
+            'cancelled': self.cancelled,
+        }
@@ -0,0 +1,209 @@
+import difflib
+import re
+import threading
+from typing import NamedTuple
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError, OptimizeError
+from sqlglot.optimizer.qualify import qualify
+from sqlglot.schema import MappingSchema
+from llm import get_llm
+import logs
+import metrics
+from scheduler import scheduler, retry_rate_limited
+from schema_catalog import catalog
+from schema_index import select_schema
+from settings import DATASETS
+
+# Every so often the LLM writes SQL with a typo'd column or a table that doesn't exist. That used to show up only
+# after a BigQuery round trip, and then it killed the chat. Now the SQL is parsed with sqlglot's BigQuery dialect
+# and checked against the schema catalog first: it has to be one read-only query, every table has to be a fully
+# qualified table we know about, and every column has to resolve. Problems (local ones, or BigQuery's own errors
+# when a query gets that far) go back to the LLM for a fix, a bounded number of times (see chat.run_query).
+
+log = logs.get_logger('query')
+
+REPAIR_PROMPT_TEMPLATE = """
+    The following BigQuery SQL was written to answer a question, but it has problems.
+
+    Question: "{question}"
+
+    SQL:
+    ```sql
+    {sql}
+    ```
+
+    Problems:
+    {errors}
+
+    {schemas}
+
+    Fix the query so it runs on BigQuery and still answers the question. Use fully qualified table names
+    (`project.dataset.table`) and only columns that exist in the tables above.
+
+    Respond with the corrected query only, in a ```sql block.
+    """
+
+_SQL_BLOCK = re.compile(r"```(?:sql)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+
+# How many close matches to suggest for an unknown table or column
+MAX_SUGGESTIONS = 3
+
+
+class Validation(NamedTuple):
+    errors: tuple
+    # (dataset, table) pairs the query uses or probably meant, for the repair prompt
+    tables: tuple
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def _schema(datasets):
+    # sqlglot wants {project: {dataset: {table: {column: type}}}}, built once per catalog version
+    key = (catalog.version, datasets)
+    with _schemas_lock:
+        schema = _schemas.get(key)
+    if schema is None:
+        mapping = {}
+        for full_name in datasets:
+            project, dataset = full_name.split(':')
+            mapping.setdefault(project, {})[dataset] = {
+                table.name: {column.name: column.type for column in table.columns}
+                for table in catalog.tables(full_name).values()
+            }
+        schema = MappingSchema(mapping, dialect='bigquery')
+        with _schemas_lock:
+            _schemas.clear()
+            _schemas[key] = schema
+    return schema
+
+
+def _close(name, candidates):
+    lowered = {candidate.lower(): candidate for candidate in candidates}
+    return [lowered[match] for match in difflib.get_close_matches(name.lower(), list(lowered), n=MAX_SUGGESTIONS)]
+
+
+def _suggest(name, candidates):
+    matches = _close(name, candidates)
+    return f" Did you mean {', '.join(matches)}?" if matches else ""
+
+
+def _parse_errors(error):
+    messages = []
+    for detail in error.errors[:MAX_SUGGESTIONS] or [{}]:
+        description = detail.get('description') or 'Invalid SQL'
+        if detail.get('line'):
+            messages.append(f"Syntax error at line {detail['line']}, column {detail.get('col')}: {description}")
+        else:
+            messages.append(f"Syntax error: {description}")
+    return messages
+
+
+def _check_tables(tree, datasets):
+    errors = []
+    tables = []
+    ctes = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    known = {full_name: catalog.tables(full_name) for full_name in datasets}
+
+    for table in tree.find_all(exp.Table):
+        name = table.name
+        if not name or (not table.db and name.lower() in ctes):
+            continue
+        if not table.db or not table.catalog:
+            # Without the project and dataset BigQuery looks in the billing project, which has none of this
+            homes = [full_name for full_name, tables in known.items() if name in tables]
+            if homes:
+                project, dataset = homes[0].split(':')
+                errors.append(f"Table {table.sql('bigquery')} has to be written as `{project}.{dataset}.{name}`")
+                tables.append((homes[0], name))
+            else:
+                errors.append(f"Table {table.sql('bigquery')} is not in any of the available datasets")
+            continue
+        full_name = f"{table.catalog}:{table.db}"
+        if full_name not in known:
+            errors.append(f"Dataset {table.catalog}.{table.db} is not available, use one of: "
+                          f"{', '.join(n.replace(':', '.') for n in datasets)}")
+            continue
+        if name not in known[full_name]:
+            errors.append(f"Table {name} does not exist in {table.db}.{_suggest(name, known[full_name])}")
+            tables.extend((full_name, match) for match in _close(name, known[full_name]))
+            continue
+        tables.append((full_name, name))
+    return errors, list(dict.fromkeys(tables))
+
+
+def _check_columns(tree, datasets, tables):
+    try:
+        qualify(tree, schema=_schema(datasets), dialect='bigquery', validate_qualify_columns=True,
+                quote_identifiers=False, identify=False)
+    except OptimizeError as e:
+        message = str(e)
+        match = re.search(r"Column '([^']+)'|Unknown column: (\S+)", message)
+        column = match and (match.group(1) or match.group(2))
+        if not column:
+            return [message]
+        owners = [table for dataset, table in tables
+                  if any(c.name.lower() == column.lower() for c in catalog.tables(dataset)[table].columns)]
+        if len(owners) > 1:
+            return [f"Column {column} is ambiguous, it's in {', '.join(owners)}. Qualify it with a table alias."]
+        if owners:
+            return [f"Column {column} is in {owners[0]} but isn't reachable where it's used. {message}"]
+        columns = {c.name for dataset, table in tables for c in catalog.tables(dataset)[table].columns}
+        return [f"Column {column} does not exist in {', '.join(table for _, table in tables) or 'these tables'}."
+                f"{_suggest(column, columns)}"]
+    except Exception as e:
+        # sqlglot doesn't know every corner of BigQuery. If it trips over something, let BigQuery have the last word.
+        log.debug("Column check skipped: %r", e)
+    return []
+
+
+def validate_sql(sql, datasets=DATASETS):
+    """Check generated SQL locally against the schema catalog. Returns a Validation, no errors means it looks fine."""
+    datasets = tuple(datasets)
+    try:
+        statements = [statement for statement in sqlglot.parse(sql, read='bigquery') if statement is not None]
+    except ParseError as e:
+        return Validation(tuple(_parse_errors(e)), ())
+    if len(statements) != 1:
+        return Validation((f"Expected exactly one query, found {len(statements)} statements",), ())
+    tree = statements[0]
+    if not isinstance(tree, exp.Query):
+        return Validation((f"Only SELECT queries can be run, this is a {tree.key.upper()} statement",), ())
+
+    errors, tables = _check_tables(tree, datasets)
+    if not errors:
+        errors = _check_columns(tree, datasets, tables)
+    return Validation(tuple(errors), tuple(tables))
+
+
+def _repair_schemas(question, tables, datasets):
+    # The tables the query touched (or meant) plus whatever the index thinks the question needs
+    selection = select_schema(question, datasets)
+    wanted = list(dict.fromkeys(list(tables) + list(selection.tables)))
+    if not wanted:
+        return selection.prompt_text
+    parts = ["Relevant tables:\n\n"]
+    for dataset, table in wanted:
+        entry = catalog.get(dataset)
+        if entry and table in entry.table_texts:
+            project, name = dataset.split(':')
+            parts.append(f"Full name: `{project}.{name}.{table}`\n")
+            parts.append(entry.table_texts[table])
+    return "".join(parts)
+
+
+async def repair_sql(question, sql, errors, tables=(), datasets=DATASETS):
+    """Ask the LLM to fix the SQL given what went wrong with it. None if it didn't send back a query."""
+    prompt = REPAIR_PROMPT_TEMPLATE.format(
+        question=question,
+        sql=sql,
+        errors="\n    ".join(f"- {error}" for error in errors),
+        schemas=_repair_schemas(question, tables, tuple(datasets)),
+    )
+    async with scheduler.llm.hold():
+        response = await retry_rate_limited(get_llm().ainvoke, prompt)
+    metrics.record_llm('sql_repair', response)
+    match = _SQL_BLOCK.search(response.content)
+    return match.group(1).strip() if match else None
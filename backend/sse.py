@@ -0,0 +1,192 @@
+import asyncio
+import base64
+import datetime
+import json
+import re
+from decimal import Decimal
+
+# Every chat event used to be f"data: {json.dumps(...)}\n\n". json.dumps is slow on big chart payloads, writes NaN
+# (which isn't JSON, the browser's JSON.parse throws on it) and gives up on the datetime and Decimal values BigQuery
+# hands back. This is the one place events get encoded: orjson when it's installed, a default hook for the types
+# it doesn't know, and proper SSE framing (event name, id, long payloads split over several data: lines).
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Long payloads are split into data: lines of roughly this size. Lines only break right before a JSON string,
+# where whitespace is allowed, so the client can join them back with newlines and parse as usual.
+MAX_LINE_BYTES = 64 * 1024
+
+# A quote with an odd run of backslashes in front of it is part of a string, not the end of one
+_ESCAPED_QUOTE = re.compile(rb'(?<!\\)\\(?:\\\\)*"')
+# The rest of a string, from anywhere inside it up to and including its closing quote
+_STRING_TAIL = re.compile(rb'(?:[^"\\]|\\.)*"', re.DOTALL)
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _default(value):
+    # pandas' missing values first, NaT passes for a datetime
+    if type(value).__name__ in ('NaTType', 'NAType'):
+        return None
+    if isinstance(value, Decimal):
+        return float(value) if value.is_finite() else None
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    # pandas DataFrame -> rows, Series/Index/numpy -> lists, Arrow scalars -> Python values
+    if hasattr(value, 'columns') and hasattr(value, 'to_dict'):
+        return value.to_dict(orient='records')
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if hasattr(value, 'as_py'):
+        return value.as_py()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(payload):
+    """JSON bytes for a payload, with datetimes, Decimals, numpy and pandas values handled"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=_ORJSON_OPTIONS)
+    # Without orjson a NaN still goes out as NaN, orjson writes null
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _inside_string(data, start, position):
+    # start is never inside a string, so an odd number of real quotes between it and position means we are
+    segment = data[start:position]
+    quotes = segment.count(b'"')
+    if b'\\"' in segment:
+        quotes -= len(_ESCAPED_QUOTE.findall(segment))
+    return quotes % 2 == 1
+
+
+def _escaped(data, position):
+    backslashes = 0
+    while position - backslashes > 0 and data[position - backslashes - 1] == ord('\\'):
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def _data_lines(data):
+    if len(data) <= MAX_LINE_BYTES:
+        return [data]
+    lines = []
+    start = 0
+    while len(data) - start > MAX_LINE_BYTES:
+        split = data.find(b'"', start + MAX_LINE_BYTES)
+        if split != -1 and _inside_string(data, start, split):
+            # That quote belongs to a string (escaped, or the one closing it), the next string starts after it
+            if _escaped(data, split):
+                split = _STRING_TAIL.match(data, split + 1).end()
+            else:
+                split += 1
+            split = data.find(b'"', split)
+        if split == -1:
+            break
+        lines.append(data[start:split])
+        start = split
+    lines.append(data[start:])
+    return lines
+
+
+def encode_event(payload, event=None, event_id=None, retry=None):
+    """One SSE event as bytes: optional event:/id:/retry: fields, then the JSON payload on data: lines"""
+    parts = []
+    if event:
+        parts.append(b"event: " + event.encode('utf-8') + b"\n")
+    if event_id is not None:
+        parts.append(b"id: " + str(event_id).encode('utf-8') + b"\n")
+    if retry is not None:
+        parts.append(b"retry: " + str(int(retry)).encode('utf-8') + b"\n")
+    for line in _data_lines(dumps(payload)):
+        parts.append(b"data: " + line + b"\n")
+    parts.append(b"\n")
+    return b"".join(parts)
+
+
+def encode_comment(text=""):
+    """An SSE comment line, clients ignore it (keeps proxies from timing the connection out)"""
+    return b": " + text.encode('utf-8') + b"\n\n"
+
+
+def message(content):
+    return {'type': 'message', 'content': content}
+
+
+def queued(stage, position):
+    # Waiting for a turn at a busy stage (see scheduler.py), position 1 is next
+    return {'type': 'queue', 'stage': stage, 'position': position}
+
+
+def reasoning(delta):
+    # A piece of the LLM's reasoning while it's still writing, the client appends these together
+    return {'type': 'reasoning', 'delta': delta}
+
+
+class EventStream:
+    """Numbers the events of one response and names each one after its payload's type"""
+
+    def __init__(self):
+        self.next_id = 1
+
+    def encode(self, payload, event=None):
+        if event is None and isinstance(payload, dict):
+            event = payload.get('type')
+        data = encode_event(payload, event, self.next_id)
+        self.next_id += 1
+        return data
+
+
+# Tasks that cleanup was handed off to, so they aren't garbage collected halfway through
+_cleanup_tasks = set()
+
+
+def _in_background(coroutine_or_future):
+    task = asyncio.ensure_future(coroutine_or_future)
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+async def keep_alive(chunks, interval):
+    """Pass an SSE byte stream through, adding a comment whenever nothing went out for interval seconds
+
+    Proxies drop connections that stay quiet for too long, and a chat can sit in one LLM call or query for most
+    of a minute. Each step of the source runs in its own task so we can keep talking while it works. When this
+    generator is cancelled or closed (Starlette cancels the response when the client disconnects) the source is
+    cancelled wherever it's waiting, and its own cleanup runs: LLM requests are dropped, queries cancelled.
+    """
+    source = chunks.__aiter__()
+    pending = None
+    finished = False
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(source.__anext__())
+            done, _ = await asyncio.wait((pending,), timeout=interval)
+            if not done:
+                yield encode_comment("keep-alive")
+                continue
+            step, pending = pending, None
+            try:
+                chunk = step.result()
+            except StopAsyncIteration:
+                finished = True
+                return
+            yield chunk
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+        elif not finished:
+            # The source is parked at a yield, closing it runs its finally blocks
+            _in_background(source.aclose())
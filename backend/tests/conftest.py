@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Run from the backend folder: python -m pytest tests
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Settings are read at import, so these have to be in before anything from the app is imported. Everything else is
+# switched per test with monkeypatch on the module that imported it.
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ["RESULT_CACHE_DIR"] = ""
+
+from benchmarks import stubs
+from benchmarks.load_test import parse_events
+
+# Short enough to see a few during a slow fake query
+HEARTBEAT_SECONDS = 0.2
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    # One event loop for the whole run: the app, its sandbox workers and the scheduler's events all live on it
+    return "asyncio"
+
+
+@pytest.fixture
+def llm():
+    """The fake LLM and BigQuery, quick by default. Tests that care about timing install their own."""
+    return stubs.install(llm_latency=0.05, query_latency=0.1)
+
+
+@pytest.fixture(scope="session")
+async def app(anyio_backend):
+    """main:app with its lifespan (schema catalog, sandbox workers) started once for the session"""
+    stubs.install(llm_latency=0.05, query_latency=0.1)
+    from main import app
+    import chat
+
+    # Once the lifespan is up, nobody waits 15 seconds for a heartbeat
+    chat.SSE_HEARTBEAT_SECONDS = HEARTBEAT_SECONDS
+    async with app.router.lifespan_context(app):
+        yield app
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    """Caches, budgets and sessions start out empty, so one test's answers don't turn into another's cache hits"""
+    yield
+    from chart_cache import chart_cache
+    from governor import governor
+    from plan_cache import plan_cache
+    from result_cache import result_cache
+    from security import users
+    from sessions import session_store
+
+    result_cache.clear()
+    plan_cache.clear(include_pinned=True)
+    chart_cache.clear()
+    governor.budget.clear()
+    # Estimates are per SQL, and a test may route the same SQL to another engine
+    governor._estimates.clear()
+    for username in users:
+        session_store.forget(f"token_{username}")
+
+
+@pytest.fixture
+def no_caches(monkeypatch):
+    """Nothing cached, so whatever is shared or skipped is down to the code under test"""
+    import chart_cache
+    import plan_cache
+    import result_cache
+
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_ENABLED", False)
+    monkeypatch.setattr(plan_cache, "PLAN_CACHE_ENABLED", False)
+    monkeypatch.setattr(chart_cache, "CHART_CACHE_ENABLED", False)
+
+
+@pytest.fixture
+def client(app):
+    return AsgiClient(app)
+
+
+class AsgiClient:
+    """Requests straight to the ASGI app, no sockets, so a test sees exactly when each chunk was sent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def scope(method, path, user=None, content_type=None):
+        headers = [(b"host", b"test")]
+        if content_type:
+            headers.append((b"content-type", content_type.encode()))
+        if user:
+            headers.append((b"authorization", f"Bearer token_{user}".encode()))
+        return {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+            "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+            "headers": headers, "client": ("127.0.0.1", 50000), "server": ("test", 80),
+        }
+
+    async def chat(self, message, user=None, hang_up_on=None, hang_up_after=0.0):
+        """POST /api/chat. Hangs up hang_up_after seconds after a chunk contains hang_up_on.
+
+        Returns status, headers, body, events as (seconds since the request, name, data), the message texts, and
+        stopped, the seconds from hanging up to the app returning (None if it never hung up).
+        """
+        body = json.dumps({"message": message}).encode()
+        hang_up = asyncio.Event()
+        request_sent = False
+        response = SimpleNamespace(status=None, headers={}, body=b"", events=[], messages=[], stopped=None)
+        chunks = []
+        hung_up_at = None
+        start = time.perf_counter()
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await hang_up.wait()
+            return {"type": "http.disconnect"}
+
+        async def hang_up_later():
+            nonlocal hung_up_at
+            await asyncio.sleep(hang_up_after)
+            hung_up_at = time.perf_counter()
+            hang_up.set()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response.status = message["status"]
+                response.headers = {name.decode().lower(): value.decode() for name, value in message["headers"]}
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                chunks.append(chunk)
+                at = time.perf_counter() - start
+                response.events += [(at, name, json.loads(data)) for name, data in parse_events(chunk)]
+                if hang_up_on and hang_up_on.encode() in chunk and hung_up_at is None:
+                    asyncio.ensure_future(hang_up_later())
+                if not message.get("more_body"):
+                    hang_up.set()
+
+        await self.app(self.scope("POST", "/api/chat", user, "application/json"), receive, send)
+        response.body = b"".join(chunks)
+        response.messages = [data.get("content", "") for _, name, data in response.events if name == "message"]
+        if hung_up_at is not None:
+            response.stopped = time.perf_counter() - hung_up_at
+        return response
+
+    async def request(self, method, path, user=None):
+        """Any other request, returns (status, JSON body)"""
+        response = {"status": None, "body": []}
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+
+        await self.app(self.scope(method, path, user), receive, send)
+        body = b"".join(response["body"])
+        try:
+            return response["status"], json.loads(body or b"null")
+        except ValueError:
+            return response["status"], body.decode()
+
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+import scheduler as scheduler_module
+from benchmarks import stubs
+from scheduler import Stage, backoff_delay, retry_rate_limited
+
+pytestmark = pytest.mark.anyio
+
+QUESTIONS = [
+    "Show me the top 10 most prescribed medications",
+    "Which drugs are prescribed the most?",
+    "What are the most common prescriptions?",
+    "List the most frequently ordered drugs",
+]
+
+LLM_LATENCY = 0.3
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class Overloaded(Exception):
+    status_code = 529
+
+
+@pytest.fixture
+def one_llm_slot(app, monkeypatch, no_caches):
+    """One LLM call at a time with room for two in line, one chat per logged in user"""
+    import chat
+
+    monkeypatch.setattr(chat, "COALESCE_ENABLED", False)
+    monkeypatch.setattr(scheduler_module, "CHAT_MAX_ACTIVE_PER_USER", 1)
+    scheduler = scheduler_module.scheduler
+    llm = Stage("llm", 1, 2)
+    monkeypatch.setattr(scheduler, "llm", llm)
+    monkeypatch.setattr(scheduler, "stages", (llm, scheduler.query, scheduler.chart))
+    stubs.install(llm_latency=LLM_LATENCY, query_latency=0.05)
+    return scheduler
+
+
+async def take(stage, user, name, order):
+    slot = stage.slot(user)
+    async for _ in slot.wait():
+        pass
+    order.append(name)
+    await asyncio.sleep(0.01)
+    slot.release()
+
+
+async def hold(stage, user):
+    slot = stage.slot(user)
+    async for _ in slot.wait():
+        pass
+    return slot
+
+
+async def test_round_robin_across_users():
+    stage = Stage("test", 1, 100)
+    order = []
+    # alice queues five before bob queues two, bob still gets every other turn
+    blocker = await hold(stage, "carol")
+    tasks = [asyncio.create_task(take(stage, "alice", f"a{i}", order)) for i in range(5)]
+    await asyncio.sleep(0)
+    tasks += [asyncio.create_task(take(stage, "bob", f"b{i}", order)) for i in range(2)]
+    await asyncio.sleep(0)
+    # The place in line counts turns, not arrivals
+    assert stage.position(stage._lines["bob"][-1]) == 4
+    blocker.release()
+    await asyncio.gather(*tasks)
+    assert order == ["a0", "b0", "a1", "b1", "a2", "a3", "a4"]
+    assert stage.held == 0 and stage.waiting == 0
+
+
+async def test_cancelled_waiter_leaves_the_line():
+    stage = Stage("test", 1, 100)
+    order = []
+    blocker = await hold(stage, "carol")
+    leaving = asyncio.create_task(take(stage, "alice", "gone", order))
+    staying = asyncio.create_task(take(stage, "bob", "stayed", order))
+    await asyncio.sleep(0)
+    leaving.cancel()
+    await asyncio.sleep(0)
+    blocker.release()
+    await staying
+    assert order == ["stayed"]
+    assert stage.held == 0 and stage.waiting == 0
+
+
+async def test_rate_limits_retried(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "RATE_LIMIT_BACKOFF_SECONDS", 0.01)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RateLimited("rate_limit_error") if len(calls) == 1 else Overloaded("overloaded_error")
+        return "answer"
+
+    assert await retry_rate_limited(flaky) == "answer" and len(calls) == 3
+
+    async def broken():
+        calls.append(1)
+        raise ValueError("not a rate limit")
+
+    calls.clear()
+    with pytest.raises(ValueError):
+        await retry_rate_limited(broken)
+    assert len(calls) == 1
+
+
+def test_llm_clients_leave_retries_to_us(monkeypatch):
+    import llm
+    import settings
+
+    monkeypatch.setattr(settings, "ANTHROPIC_API_KEY", "test")
+    model = llm.get_llm(model="test-model")
+    assert model.max_retries == 0
+    assert model._client.max_retries == 0 and model._async_client.max_retries == 0
+
+
+def test_backoff_is_jittered():
+    assert len({round(backoff_delay(2), 6) for _ in range(20)}) > 10
+
+
+async def test_waiting_chats_told_their_place(client, one_llm_slot):
+    # Three chats for one LLM slot: the others wait their turn and are told where they are
+    responses = await asyncio.gather(*(client.chat(question) for question in QUESTIONS[:3]))
+    assert all(r.status == 200 and "Processing complete!" in r.messages for r in responses)
+    queued = [[data for _, name, data in r.events if name == "queue"] for r in responses]
+    assert sum(1 for events in queued if events) >= 2
+    assert all(event["stage"] == "llm" and event["position"] >= 1 for events in queued for event in events)
+
+
+async def test_full_line_turned_away(client, one_llm_slot):
+    first = [asyncio.create_task(client.chat(question)) for question in QUESTIONS[:3]]
+    await asyncio.sleep(LLM_LATENCY / 4)
+    response = await client.chat(QUESTIONS[3])
+    await asyncio.gather(*first)
+    assert response.status == 429 and int(response.headers.get("retry-after", 0)) >= 1
+
+
+async def test_one_chat_per_user(client, one_llm_slot):
+    # Other users aren't affected
+    first = asyncio.create_task(client.chat(QUESTIONS[0], "user"))
+    await asyncio.sleep(0.01)
+    second, other = await asyncio.gather(client.chat(QUESTIONS[1], "user"), client.chat(QUESTIONS[1], "demo"))
+    await first
+    assert second.status == 429 and other.status == 200
+
+    stats = one_llm_slot.stats()
+    assert stats["active_chats"] == 0
+    assert all(stage["held"] == 0 and stage["waiting"] == 0 for stage in stats["stages"].values())
@@ -0,0 +1,60 @@
+import io
+
+import matplotlib.figure
+import pytest
+
+import chart_runtime
+from chart_store import ChartStore, chart_output, chart_store
+
+
+def save(fig, **kwargs):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, **kwargs)
+    return buffer.getvalue()
+
+
+def test_rendering_only_changes_its_own_job():
+    savefig = matplotlib.figure.Figure.savefig
+    fig = matplotlib.figure.Figure(figsize=(4, 3))
+    fig.add_subplot().plot([0, 1], [1, 0])
+    with chart_runtime.rendering(chart_output(400, 1, "webp")) as job:
+        data = save(fig, format="png", dpi=300)
+    assert data[8:12] == b"WEBP" and job.mime == "image/webp"
+    # What the code asked for, outside a job
+    assert matplotlib.figure.Figure.savefig is savefig
+    assert save(fig, format="png").startswith(b"\x89PNG")
+
+
+def test_rendering_without_a_save():
+    with chart_runtime.rendering(chart_output()) as job:
+        pass
+    assert job.mime is None
+
+
+def test_disk_tier_shared_between_processes(tmp_path):
+    # Two stores on the same folder stand in for two API worker processes
+    rendered, other = ChartStore(disk_dir=str(tmp_path)), ChartStore(disk_dir=str(tmp_path))
+    digest = rendered.put(b"RIFF\x00\x00\x00\x00WEBPVP8L", "image/webp")
+    assert other.get(digest) is None
+    assert other.get_disk(digest) == (b"RIFF\x00\x00\x00\x00WEBPVP8L", "image/webp")
+    assert other.get(digest) is not None
+    assert other.get_disk("../" + digest[3:]) is None
+
+
+def test_disk_tier_bounded(tmp_path):
+    store = ChartStore(disk_dir=str(tmp_path), disk_max_bytes=1000)
+    for i in range(5):
+        store.put(bytes([i]) * 400, "image/png")
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 1000
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("image_format, magic", [("webp", b"WEBP"), ("png", b"PNG\r")])
+async def test_sandbox_images_labelled_as_saved(app, image_format, magic):
+    from sandbox import sandbox
+
+    # The fallback chart saves format='png' and says data:image/png, whatever the request wants
+    target = (await sandbox.fallback_chart(chart_output(image_format=image_format)))["graphData"]
+    data, mime = chart_store.get(target["chartId"])
+    assert target["mimeType"] == mime == f"image/{image_format}"
+    assert magic in data[:12]
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from benchmarks import stubs
+
+pytestmark = pytest.mark.anyio
+
+QUESTION = "Show me the top 10 most prescribed medications"
+# The same question as far as normalize_question is concerned
+VARIANTS = [QUESTION, QUESTION.lower(), f"  {QUESTION}?", QUESTION.upper()]
+
+LLM_LATENCY = 0.4
+QUERY_LATENCY = 0.6
+QUERY_MESSAGE = "Running dynamically generated query"
+
+
+@pytest.fixture
+def slow_llm(app, no_caches):
+    # Without caches, anything shared has to come from coalescing
+    return stubs.install(llm_latency=LLM_LATENCY, query_latency=QUERY_LATENCY)
+
+
+def without_comments(body):
+    # Heartbeats depend on timing, the events are what has to match
+    return b"".join(block + b"\n\n" for block in body.split(b"\n\n") if block and not block.startswith(b":"))
+
+
+async def later(delay, coroutine):
+    await asyncio.sleep(delay)
+    return await coroutine
+
+
+async def calls_per_chat(client, llm):
+    calls = llm.calls
+    await client.chat(QUESTION)
+    return llm.calls - calls
+
+
+async def test_identical_chats_run_once(client, slow_llm):
+    per_chat = await calls_per_chat(client, slow_llm)
+    calls, started = slow_llm.calls, stubs.FakeQueryJob.started
+    # A crowd asking the same thing, one of them a little late
+    requests = [client.chat(VARIANTS[i % len(VARIANTS)]) for i in range(10)]
+    requests.append(later(LLM_LATENCY + QUERY_LATENCY / 2, client.chat(QUESTION)))
+    responses = await asyncio.gather(*requests)
+    assert slow_llm.calls - calls == per_chat
+    assert stubs.FakeQueryJob.started - started == 1
+    assert all(b"Processing complete!" in r.body for r in responses)
+    # The late one got what it missed
+    assert len({without_comments(r.body) for r in responses}) == 1
+
+
+async def test_same_sql_shares_the_job(client, slow_llm):
+    # Different questions, same SQL (the fake LLM writes the same query for everything)
+    per_chat = await calls_per_chat(client, slow_llm)
+    calls, started = slow_llm.calls, stubs.FakeQueryJob.started
+    await asyncio.gather(client.chat(QUESTION), client.chat("Which drugs are prescribed the most?"))
+    assert slow_llm.calls - calls == 2 * per_chat
+    assert stubs.FakeQueryJob.started - started == 1
+
+
+async def test_leader_leaving_keeps_the_job(client, slow_llm):
+    cancelled = stubs.FakeQueryJob.cancelled
+    leader, follower = await asyncio.gather(
+        client.chat(QUESTION, hang_up_on=QUERY_MESSAGE, hang_up_after=0.1),
+        later(0.05, client.chat(QUESTION)))
+    assert leader.stopped is not None
+    assert b"Processing complete!" in follower.body and stubs.FakeQueryJob.cancelled == cancelled
+
+
+async def test_everyone_leaving_cancels_the_job(client, slow_llm):
+    import chat
+
+    cancelled = stubs.FakeQueryJob.cancelled
+    await asyncio.gather(*(client.chat(QUESTION, hang_up_on=QUERY_MESSAGE, hang_up_after=0.1) for _ in range(3)))
+    await asyncio.sleep(0.2)
+    assert stubs.FakeQueryJob.cancelled == cancelled + 1
+    assert chat.chat_flights.stats()["in_flight"] == 0 and chat.query_flights.stats()["in_flight"] == 0
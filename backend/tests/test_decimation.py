@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from decimation import decode_array, reduce_figure
+
+POINTS = 20000
+
+
+def line_with_error_bars():
+    x = np.arange(POINTS, dtype=np.float64)
+    return {"data": [{
+        "type": "scatter", "mode": "lines", "x": x.tolist(), "y": np.sin(x / 100).tolist(),
+        "text": [f"point {i}" for i in range(POINTS)],
+        "error_y": {"type": "data", "array": (x / 10).tolist(), "arrayminus": (x / 20).tolist(), "visible": True},
+        "error_x": {"type": "constant", "value": 0.5},
+    }], "layout": {}}
+
+
+@pytest.mark.parametrize("typed_arrays", [True, False])
+def test_error_bars_decimated_with_the_points(typed_arrays):
+    figure = reduce_figure(line_with_error_bars(), 500, typed_arrays=typed_arrays)
+    trace = figure["data"][0]
+    x = decode_array(trace["x"])
+    assert len(x) <= 500 and len(trace["text"]) == len(x)
+    # Each kept point still has its own error bar
+    for key, divisor in (("array", 10), ("arrayminus", 20)):
+        errors = decode_array(trace["error_y"][key])
+        assert len(errors) == len(x)
+        assert np.allclose(np.asarray(errors, dtype=np.float64), np.asarray(x, dtype=np.float64) / divisor)
+    assert trace["error_y"]["visible"] and trace["error_x"] == {"type": "constant", "value": 0.5}
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from benchmarks import stubs
+
+pytestmark = pytest.mark.anyio
+
+QUESTION = "Show me the top 10 most prescribed medications"
+LLM_LATENCY = 0.6
+QUERY_LATENCY = 1.5
+
+
+@pytest.fixture
+def slow_llm(app):
+    return stubs.install(llm_latency=LLM_LATENCY, query_latency=QUERY_LATENCY)
+
+
+def disconnects():
+    import metrics
+    return metrics.REGISTRY.get_sample_value("dataexplorer_request_seconds_count", {"outcome": "disconnected"}) or 0
+
+
+async def test_completes_with_heartbeats(client, slow_llm, no_caches):
+    response = await client.chat(QUESTION)
+    assert b"Processing complete!" in response.body and b"event: timing" in response.body
+    assert response.body.count(b": keep-alive") >= 2
+    # No padding at the end, the chat takes as long as the fakes do
+    assert response.events[-1][0] < LLM_LATENCY + QUERY_LATENCY + 0.5
+
+
+async def test_disconnect_during_query_cancels_the_job(client, slow_llm, no_caches):
+    cancelled, calls, before = stubs.FakeQueryJob.cancelled, slow_llm.calls, disconnects()
+    response = await client.chat(QUESTION, hang_up_on="Running dynamically generated query", hang_up_after=0.2)
+    await asyncio.sleep(0.2)
+    assert response.stopped is not None and response.stopped < 0.5
+    assert stubs.FakeQueryJob.cancelled == cancelled + 1
+    # The chart check and the SQL, and nothing for the chart
+    assert slow_llm.calls == calls + 2 and b"event: graph" not in response.body
+    assert disconnects() == before + 1
+
+
+async def test_disconnect_during_llm_call_aborts_it(client, slow_llm, no_caches):
+    from sandbox import sandbox
+
+    aborted = slow_llm.aborted
+    response = await client.chat(QUESTION, hang_up_on="Analyzing schemas", hang_up_after=0.1)
+    await asyncio.sleep(0.1)
+    assert response.stopped is not None and response.stopped < 0.5
+    assert slow_llm.aborted > aborted
+
+    # The sandbox is back to full strength afterwards
+    await asyncio.sleep(0.5)
+    stats = sandbox.stats()
+    assert stats["idle"] == stats["workers"]
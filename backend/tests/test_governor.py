@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+import governor as governor_module
+from benchmarks import stubs
+from governor import GovernedQuery, QueryGovernor, QueryRefused, ScanBudget
+
+pytestmark = pytest.mark.anyio
+
+GIB = 1024 ** 3
+
+CHEAP_SQL = """SELECT drug, COUNT(*) AS prescription_count
+FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`
+GROUP BY drug"""
+
+EXPENSIVE_SQL = "SELECT * FROM `physionet-data.mimiciv_3_1_icu.chartevents`"
+
+
+def fresh(user_bytes=200 * GIB, global_bytes=1024 * GIB):
+    return QueryGovernor(ScanBudget(user_bytes, global_bytes))
+
+
+async def govern(governor, sql, user="user"):
+    # Approved and then charged, the way a query that actually runs is
+    events = []
+    async for event in governor.govern(sql, "How many prescriptions per drug?", user):
+        if isinstance(event, GovernedQuery):
+            governor.charge(event, user)
+            return event, events
+        events.append(event)
+
+
+async def test_cheap_query_approved_and_charged(llm):
+    governor = fresh()
+    governed, events = await govern(governor, CHEAP_SQL)
+    assert governed.bytes_processed == stubs.SCAN_BYTES and not governed.rewritten
+    assert governed.limit_added and governed.sql.rstrip().split()[-2] == "LIMIT"
+    assert events[0]["type"] == "estimate"
+    assert governor.budget.spent("user") == stubs.SCAN_BYTES
+
+    # Asking again doesn't cost another dry run
+    await govern(governor, CHEAP_SQL)
+    assert governor.stats()["dry_runs"] == 1
+
+
+async def test_expensive_query_rewritten(llm):
+    calls = llm.calls
+    governed, _ = await govern(fresh(), EXPENSIVE_SQL)
+    assert governed.rewritten and "SELECT *" not in governed.sql
+    assert llm.calls == calls + 1
+
+
+async def test_refused_without_rewrites(llm, monkeypatch):
+    monkeypatch.setattr(governor_module, "QUERY_REWRITE_ATTEMPTS", 0)
+    with pytest.raises(QueryRefused, match="400.0 GB"):
+        await govern(fresh(), EXPENSIVE_SQL)
+
+
+async def test_per_user_budget(llm):
+    governor = fresh(user_bytes=3 * GIB)
+    await govern(governor, CHEAP_SQL, "user")
+    with pytest.raises(QueryRefused):
+        await govern(governor, CHEAP_SQL, "user")
+    governed, _ = await govern(governor, CHEAP_SQL, "demo")
+    assert governed.bytes_processed == stubs.SCAN_BYTES
+
+
+async def test_global_budget(llm):
+    governor = fresh(global_bytes=3 * GIB)
+    await govern(governor, CHEAP_SQL, "user")
+    with pytest.raises(QueryRefused):
+        await govern(governor, CHEAP_SQL, "demo")
+
+
+async def test_no_overspend_under_concurrency(llm):
+    # Requests can't both squeeze in between the check and the charge
+    governor = fresh(user_bytes=5 * GIB)
+    results = await asyncio.gather(*(govern(governor, CHEAP_SQL) for _ in range(5)), return_exceptions=True)
+    assert sum(1 for result in results if not isinstance(result, Exception)) == 2
+    assert governor.budget.spent("user") <= 5 * GIB
+
+
+async def test_dml_refused(llm):
+    with pytest.raises(QueryRefused, match="DELETE"):
+        await govern(fresh(), "DELETE FROM `physionet-data.mimiciv_3_1_hosp.patients` WHERE TRUE")
+
+
+async def test_result_cached_under_the_sql_that_ran(app, llm, monkeypatch):
+    # SQL the governor has to put a LIMIT on: a different question with the same SQL gets the result without a
+    # dry run, a job or a charge
+    import plan_cache
+    from chat import answer_question
+    from governor import governor
+    from result_cache import result_cache
+
+    monkeypatch.setattr(plan_cache, "PLAN_CACHE_ENABLED", False)
+    monkeypatch.setattr(stubs, "ANSWER_REPLY", stubs.ANSWER_REPLY.replace("LIMIT 10\n", ""))
+    dry_runs, hits = governor.stats()["dry_runs"], result_cache.stats()["hits"]
+    for question in ("Which drugs are prescribed the most?", "List the most frequently ordered drugs"):
+        async for _ in answer_question(question, None, user="user"):
+            pass
+    assert result_cache.stats()["hits"] - hits == 1
+    assert governor.stats()["dry_runs"] - dry_runs == 1
+    assert governor.budget.spent("user") == stubs.SCAN_BYTES
+
+
+@pytest.mark.parametrize("rewrite", [
+    "SELECT drugname FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`",
+    f"SELECT {stubs.REJECTED_SQL_MARKER}(drug) FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`",
+])
+async def test_broken_rewrite_dropped(app, llm, monkeypatch, rewrite):
+    # Caught locally or by the dry run, either way it's the rewrite that's wrong and not the query run_query has
+    monkeypatch.setattr(stubs, "REWRITE_REPLY", f"```sql\n{rewrite}\n```")
+    with pytest.raises(QueryRefused, match="400.0 GB"):
+        await govern(fresh(), EXPENSIVE_SQL)
@@ -0,0 +1,21 @@
+from plan_cache import PlanCache, normalize_question
+
+
+def test_same_question_same_key():
+    assert normalize_question("Show me the top 10 drugs, please!") == normalize_question("show me the top ten drugs")
+    assert normalize_question("Patients with over 1,000 admissions") == normalize_question(
+        "patients with over 1000.0 admissions")
+
+
+def test_number_lists_keep_their_commas():
+    assert normalize_question("patients aged 18,30 and 40") != normalize_question("patients aged 1830 and 40")
+    assert normalize_question("patients aged 18,30 and 40") == normalize_question("patients aged 18, 30 and 40")
+
+
+def test_plan_found_by_normalized_question():
+    cache = PlanCache()
+    cache.put("Patients aged 18,30 and 40", "reply", "SELECT 1", {}, "v1")
+    assert cache.get("patients aged 18, 30 and 40?", "v1").sql_query == "SELECT 1"
+    assert cache.get("patients aged 1830 and 40", "v1") is None
+    # A new schema or prompt version invalidates it
+    assert cache.get("Patients aged 18,30 and 40", "v2") is None
@@ -0,0 +1,71 @@
+import pytest
+
+from benchmarks import stubs
+from plan_stream import PlanParser, split_plan
+
+QUESTION = "Show me the top 10 most prescribed medications"
+REASONING = "The prescriptions table has a drug column we can count."
+
+NO_REPLY = """ANSWER: NO
+
+DATABASE: None
+
+REASONING: None of the datasets have billing data, so the cost of a stay can't be worked out.
+
+REQUIRED_DATA: Charges per admission, which MIMIC-IV doesn't include.
+"""
+
+
+def feed_in_pieces(text, size):
+    parser = PlanParser()
+    reasoning, verdicts, sqls = "", [], []
+    for i in range(0, len(text), size):
+        update = parser.feed(text[i:i + size])
+        reasoning += update.reasoning
+        verdicts += [update.verdict] if update.verdict else []
+        sqls += [(update.sql, i + size)] if update.sql else []
+    return parser, reasoning, verdicts, sqls
+
+
+# One character at a time is the worst case for markers split across pieces
+@pytest.mark.parametrize("size", [1, 3, 8, len(stubs.ANSWER_REPLY)])
+def test_parser_in_pieces(size):
+    reply = stubs.ANSWER_REPLY
+    expected_sql = reply.split("```sql")[1].split("```")[0].strip()
+    fence_closed = reply.index("```", reply.index("```sql") + 3) + 3
+    parser, reasoning, verdicts, sqls = feed_in_pieces(reply, size)
+    assert reasoning == REASONING
+    assert verdicts == ["YES"]
+    # The SQL comes out once, as soon as its block closes
+    assert len(sqls) == 1 and sqls[0][0] == expected_sql and sqls[0][1] < fence_closed + size
+    assert parser.finish() == split_plan(reply)
+
+
+def test_parser_no_answer():
+    parser, reasoning, verdicts, sqls = feed_in_pieces(NO_REPLY, 5)
+    assert reasoning.startswith("None of the datasets") and reasoning.endswith("worked out.")
+    assert verdicts == ["NO"] and not sqls and parser.finish() == (NO_REPLY, None)
+
+
+@pytest.mark.anyio
+async def test_query_starts_before_the_plan_ends(client, no_caches):
+    llm_latency = 2.0
+    stubs.install(llm_latency=llm_latency, query_latency=0.2)
+    response = await client.chat(QUESTION)
+
+    def first(predicate):
+        return next((at for at, name, data in response.events if predicate(name, data)), None)
+
+    # The chart check and the plan both take llm_latency, and they start together
+    reasoning_at = first(lambda name, data: name == "reasoning")
+    query_at = first(lambda name, data: name == "message" and data["content"].startswith("Running dynamically"))
+    assert reasoning_at is not None and reasoning_at < llm_latency / 2
+    assert query_at is not None and query_at < llm_latency
+    assert "".join(data["delta"] for _, name, data in response.events if name == "reasoning") == REASONING
+
+    assert any(m.startswith("The query counts prescriptions") for m in response.messages)
+    assert not any("```" in m for m in response.messages)
+    assert "Processing complete!" in response.messages
+    # Tokens are counted once for the streamed call
+    timing = next(data for _, name, data in response.events if name == "timing")
+    assert timing["tokens"]["sql_generation"]["calls"] == 1 and timing["tokens"]["sql_generation"]["output"] > 0
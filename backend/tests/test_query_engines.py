@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import engines
+from ingestion import stream_query
+
+HOSP = "physionet-data:mimiciv_3_1_hosp"
+PATIENTS = 2000
+
+DRUGS = ["Insulin", "Heparin", "Furosemide", "Metoprolol", "Vancomycin", "Acetaminophen"]
+
+TOP_DRUGS_SQL = """SELECT drug, COUNT(*) AS prescription_count
+FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`
+GROUP BY drug
+ORDER BY prescription_count DESC"""
+
+# BigQuery-only syntax, it has to be translated before DuckDB can run it
+BIGQUERY_DIALECT_SQL = """SELECT p.gender, DATE(a.admittime) AS day, SAFE_CAST(p.anchor_age AS INT64) AS age
+FROM `physionet-data.mimiciv_3_1_hosp.admissions` a
+JOIN `physionet-data.mimiciv_3_1_hosp.patients` p ON a.subject_id = p.subject_id
+QUALIFY ROW_NUMBER() OVER (PARTITION BY a.subject_id ORDER BY a.admittime) = 1"""
+
+SLOW_SQL = """SELECT COUNT(*) AS n
+FROM `physionet-data.mimiciv_3_1_hosp.prescriptions` a, `physionet-data.mimiciv_3_1_hosp.prescriptions` b,
+     `physionet-data.mimiciv_3_1_hosp.prescriptions` c
+WHERE a.hadm_id + b.hadm_id + c.hadm_id > 0"""
+
+MIXED_SQL = """SELECT a.hadm_id FROM `physionet-data.mimiciv_3_1_hosp.admissions` a
+JOIN `physionet-data.mimiciv_3_1_icu.icustays` i ON a.hadm_id = i.hadm_id"""
+
+
+def write_extract(folder, patients):
+    """A small fake MIMIC-IV hosp extract: patients, admissions and prescriptions (split over two files).
+    Returns the prescriptions per drug."""
+    hosp = os.path.join(folder, HOSP.split(':')[1])
+    os.makedirs(os.path.join(hosp, "prescriptions"))
+    start = datetime(2150, 1, 1)
+    pq.write_table(pa.table({
+        "subject_id": list(range(patients)),
+        "gender": ["F" if i % 2 else "M" for i in range(patients)],
+        "anchor_age": [18 + i % 70 for i in range(patients)],
+    }), os.path.join(hosp, "patients.parquet"))
+    pq.write_table(pa.table({
+        "subject_id": [i // 2 for i in range(patients * 2)],
+        "hadm_id": list(range(patients * 2)),
+        "admittime": [start + timedelta(hours=i) for i in range(patients * 2)],
+    }), os.path.join(hosp, "admissions.parquet"))
+    counts = {}
+    for part in range(2):
+        rows = range(part * patients * 5, (part + 1) * patients * 5)
+        drugs = [DRUGS[(i * i) % len(DRUGS)] for i in rows]
+        for drug in drugs:
+            counts[drug] = counts.get(drug, 0) + 1
+        pq.write_table(pa.table({
+            "hadm_id": [i % (patients * 2) for i in rows],
+            "drug": drugs,
+            "starttime": [start + timedelta(minutes=i) for i in rows],
+        }), os.path.join(hosp, "prescriptions", f"part-{part}.parquet"))
+    return counts
+
+
+@pytest.fixture
+def extract(app, llm, tmp_path, monkeypatch):
+    """hosp routed to DuckDB over a synthetic extract, for the length of the test"""
+    from schema_catalog import catalog
+
+    counts = write_extract(str(tmp_path), PATIENTS)
+    monkeypatch.setitem(engines.ROUTES, HOSP, "duckdb")
+    monkeypatch.setitem(engines._engines, "duckdb", engines.DuckDBEngine(str(tmp_path)))
+    catalog.load()
+    yield counts
+    monkeypatch.undo()
+    catalog.load()
+
+
+async def collect(generator):
+    return [event async for event in generator]
+
+
+def test_schema_from_parquet(extract):
+    from schema_catalog import catalog
+
+    entry = catalog.get(HOSP)
+    assert entry.source == "duckdb" and set(entry.tables) == {"patients", "admissions", "prescriptions"}
+    # In BigQuery's type names
+    columns = {c.name: c.type for c in entry.tables["prescriptions"].columns}
+    assert columns == {"hadm_id": "INTEGER", "drug": "STRING", "starttime": "DATETIME"}
+    assert entry.tables["prescriptions"].num_rows == PATIENTS * 10
+
+
+def test_routing(extract):
+    assert engines.engine_for_sql(TOP_DRUGS_SQL).name == "duckdb"
+    assert engines.engine_for_sql("SELECT stay_id FROM `physionet-data.mimiciv_3_1_icu.icustays`").name == "bigquery"
+    with pytest.raises(engines.QueryError):
+        engines.engine_for_sql(MIXED_SQL)
+
+
+def test_dry_run(extract):
+    # No bill, but the size of what the query can read
+    engine = engines.engine_for_sql(TOP_DRUGS_SQL)
+    estimate = engine.dry_run(TOP_DRUGS_SQL)
+    assert not estimate.billed and estimate.statement_type == "SELECT" and estimate.bytes_processed > 0
+    with pytest.raises(engines.QueryError):
+        engine.dry_run("SELECT drugname FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`")
+
+
+@pytest.mark.anyio
+async def test_execute(extract):
+    result = (await collect(stream_query(TOP_DRUGS_SQL)))[-1]
+    assert {row["drug"]: row["prescription_count"] for row in result.to_pylist()} == extract
+    result = (await collect(stream_query(BIGQUERY_DIALECT_SQL)))[-1]
+    assert result.num_rows == PATIENTS
+    result = (await collect(stream_query(TOP_DRUGS_SQL, max_rows=2)))[-1]
+    assert result.num_rows == 2 and result.truncated
+
+
+def test_cancel(extract):
+    # A query that would otherwise run for a long time
+    handle = engines.engine_for_sql(SLOW_SQL).submit(SLOW_SQL)
+    threading.Timer(0.2, handle.cancel).start()
+    start = time.perf_counter()
+    try:
+        with pytest.raises(engines.QueryError):
+            handle.wait()
+    finally:
+        handle.close()
+    assert time.perf_counter() - start < 5
+
+
+@pytest.mark.anyio
+async def test_chat_not_charged(extract):
+    import chat
+    from governor import governor
+
+    events = await collect(chat.answer_question("What are the most prescribed drugs?", "key", user="user"))
+    results = next((event[3] for event in events if isinstance(event, tuple) and event[0] == "FINAL_RESULT"), None)
+    estimates = [event for event in events if isinstance(event, dict) and event.get("type") == "estimate"]
+    assert results is not None and results.num_rows == len(extract)
+    assert estimates[0]["cost_usd"] == 0 and governor.budget.spent() == 0
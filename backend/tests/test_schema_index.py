@@ -0,0 +1,13 @@
+from schema_index import index
+from settings import DATASETS
+
+HOSP = "physionet-data:mimiciv_3_1_hosp"
+ICU = "physionet-data:mimiciv_3_1_icu"
+
+
+def test_index_per_dataset_list(app):
+    question = "average heart rate in the icu chartevents per admission"
+    assert ICU in {match.dataset for match in index.rank(question, DATASETS)}
+    # Asked about fewer datasets after that, only their tables are ranked
+    assert {match.dataset for match in index.rank(question, [HOSP])} == {HOSP}
+    assert ICU in {match.dataset for match in index.rank(question, list(reversed(DATASETS)))}
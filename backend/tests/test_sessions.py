@@ -0,0 +1,124 @@
+import pyarrow as pa
+import pytest
+
+from benchmarks import stubs
+from query_result import QueryResult
+from sessions import SessionStore, classify, new_turn
+
+QUESTION = "Show me the top 10 most prescribed medications"
+CHART = {"library": "plotly", "chart": "bar chart"}
+
+BY_YEAR = QueryResult(pa.table({
+    "admit_year": [2148, 2150, 2155, 2160, 2170],
+    "admissions": [5, 4, 3, 2, 1],
+}))
+
+
+def turn(question="Admissions per year", result=BY_YEAR):
+    return new_turn(question, "", "SELECT ...", result, CHART)
+
+
+def test_year_range_filtered_locally():
+    followup = classify("only 2150-2160", turn())
+    assert followup is not None and followup.kind == "filter"
+    assert followup.narrow().table["admit_year"].to_pylist() == [2150, 2155, 2160]
+
+
+def test_capped_results():
+    capped = turn(result=QueryResult(BY_YEAR.table, truncated=True, total_rows=50000))
+    # Filters on a capped result go back to BigQuery, the first N rows are still right
+    assert classify("only 2150-2160", capped).kind == "refine"
+    followup = classify("just the first 2", capped)
+    assert followup.kind == "filter" and followup.narrow().num_rows == 2
+
+
+def test_new_questions_arent_followups():
+    assert classify("How many patients were admitted in 2150?", turn()) is None
+    assert classify(QUESTION, turn()) is None
+
+
+def test_store_limits():
+    # Two turns per user, and no more than one of these results' worth of bytes
+    store = SessionStore(max_turns=2, max_bytes=BY_YEAR.nbytes, max_users=2, ttl_seconds=60)
+    for question in ("first", "second", "third"):
+        store.remember("token_user", turn(question))
+    assert [t["question"] for t in store.describe("token_user")] == ["third"]
+
+    # A result over the cap keeps its question, not its rows
+    store.remember("token_user", turn("big", QueryResult(pa.concat_tables([BY_YEAR.table] * 4))))
+    assert store.describe("token_user")[0]["rows"] is None
+
+    # The least recently used session goes first
+    store.remember("token_demo", turn("demo"))
+    store.followup("token_user", "now show that as a pie chart")
+    store.remember("token_admin", turn("admin"))
+    assert store.describe("token_demo") == [] and store.describe("token_user") != []
+
+    store.remember("not_a_token", turn("nobody"))
+    assert store.describe("not_a_token") == []
+
+
+@pytest.fixture
+def plans(app, no_caches, monkeypatch):
+    """The prompts the LLM was asked for a plan with"""
+    plans = []
+    prompt_kind = stubs.prompt_kind
+
+    def counting_prompt_kind(prompt):
+        kind = prompt_kind(prompt)
+        if kind == "answer":
+            plans.append(prompt)
+        return kind
+
+    monkeypatch.setattr(stubs, "prompt_kind", counting_prompt_kind)
+    stubs.install(llm_latency=0.05, query_latency=0.1)
+    return plans
+
+
+@pytest.mark.anyio
+async def test_followups_reuse_the_last_answer(client, plans):
+    jobs = stubs.FakeQueryJob
+    response = await client.chat(QUESTION, "user")
+    _, session = await client.request("GET", "/api/session", "user")
+    assert response.status == 200 and len(session["turns"]) == 1 and session["turns"][0]["rows"] == 10
+
+    # A different chart of the same rows: no plan, no query
+    before, started = len(plans), jobs.started
+    response = await client.chat("now show that as a pie chart", "user")
+    assert response.status == 200 and len(plans) == before and jobs.started == started
+    assert any(name == "chart" or data.get("graphType") for _, name, data in response.events)
+    assert "Processing complete!" in response.messages
+
+    # A narrowing the rows we have are enough for
+    response = await client.chat("only the top 3", "user")
+    _, session = await client.request("GET", "/api/session", "user")
+    assert len(plans) == before and jobs.started == started and session["turns"][0]["rows"] == 3
+    assert any("3 of 10 rows" in message for message in response.messages)
+    await client.chat("only Drug 1 and Drug 2", "user")
+    _, session = await client.request("GET", "/api/session", "user")
+    assert len(plans) == before and session["turns"][0]["rows"] == 2
+
+    # Something the rows can't answer goes back through the pipeline, with the earlier question as context
+    response = await client.chat("only for women", "user")
+    assert response.status == 200 and len(plans) == before + 1 and "follow-up" in plans[-1]
+    assert jobs.started == started + 1
+
+
+@pytest.mark.anyio
+async def test_sessions_need_a_login(client, plans):
+    await client.chat(QUESTION)
+    before = len(plans)
+    await client.chat("now show that as a pie chart")
+    assert len(plans) == before + 1
+    status, _ = await client.request("GET", "/api/session")
+    assert status == 401
+
+
+@pytest.mark.anyio
+async def test_cleared_session_starts_over(client, plans):
+    await client.chat(QUESTION, "user")
+    status, cleared = await client.request("DELETE", "/api/session", "user")
+    assert status == 200 and cleared["cleared"]
+    before = len(plans)
+    await client.chat("now show that as a pie chart", "user")
+    assert len(plans) == before + 1
@@ -0,0 +1,83 @@
+import pytest
+
+from benchmarks import stubs
+from sql_validator import validate_sql
+
+GOOD_QUERIES = [
+    """SELECT drug, COUNT(*) AS prescription_count FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`
+       GROUP BY drug ORDER BY prescription_count DESC LIMIT 10""",
+    """SELECT p.gender, COUNT(DISTINCT a.hadm_id) AS admissions
+       FROM `physionet-data.mimiciv_3_1_hosp.admissions` a
+       JOIN `physionet-data.mimiciv_3_1_hosp.patients` p ON a.subject_id = p.subject_id GROUP BY p.gender""",
+    """WITH daily AS (SELECT DATE(admittime) AS day, COUNT(*) AS n FROM `physionet-data.mimiciv_3_1_hosp.admissions`
+       GROUP BY day) SELECT day, n FROM daily ORDER BY day""",
+    """SELECT subject_id, ROW_NUMBER() OVER (PARTITION BY subject_id ORDER BY admittime) AS rn
+       FROM `physionet-data.mimiciv_3_1_hosp.admissions` QUALIFY rn = 1""",
+    """SELECT SAFE_CAST(valuenum AS INT64) AS value FROM `physionet-data.mimiciv_3_1_icu.chartevents`
+       WHERE itemid IN (SELECT itemid FROM `physionet-data.mimiciv_3_1_icu.d_items` WHERE LOWER(label) LIKE '%heart%')""",
+]
+
+# (SQL, a word the error should mention)
+BAD_QUERIES = [
+    ("SELEC drug FROM x", "Syntax"),
+    ("SELECT drugname FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`", "drug"),
+    ("SELECT drug FROM `physionet-data.mimiciv_3_1_hosp.prescription`", "prescriptions"),
+    ("SELECT drug FROM prescriptions", "physionet-data.mimiciv_3_1_hosp.prescriptions"),
+    ("SELECT gender FROM `physionet-data.mimiciv_hosp.patients`", "not available"),
+    ("""SELECT subject_id FROM `physionet-data.mimiciv_3_1_hosp.admissions` a
+        JOIN `physionet-data.mimiciv_3_1_hosp.patients` p ON a.subject_id = p.subject_id""", "ambiguous"),
+    ("DELETE FROM `physionet-data.mimiciv_3_1_hosp.patients` WHERE TRUE", "SELECT"),
+    ("SELECT 1; SELECT 2", "one query"),
+]
+
+REJECTED_SQL = f"SELECT {stubs.REJECTED_SQL_MARKER}(drug) AS d FROM `physionet-data.mimiciv_3_1_hosp.prescriptions`"
+
+
+async def run(question, sql):
+    import chat
+    events = []
+    async for event in chat.run_query(question, sql, "user"):
+        if isinstance(event, tuple):
+            return event, events
+        events.append(event)
+
+
+@pytest.mark.parametrize("sql", GOOD_QUERIES)
+def test_valid(app, sql):
+    errors, _ = validate_sql(sql)
+    assert not errors
+
+
+@pytest.mark.parametrize("sql, expected", BAD_QUERIES)
+def test_invalid(app, sql, expected):
+    errors, _ = validate_sql(sql)
+    assert errors and expected in errors[0]
+
+
+@pytest.mark.anyio
+async def test_local_error_repaired_before_bigquery(app, llm):
+    from governor import governor
+
+    calls, dry_runs = llm.calls, governor.stats()["dry_runs"]
+    (sql, results), _ = await run("Top drugs", BAD_QUERIES[1][0])
+    assert results is not None and llm.calls == calls + 1
+    # Only the repaired query got a dry run
+    assert governor.stats()["dry_runs"] == dry_runs + 1
+
+
+@pytest.mark.anyio
+async def test_bigquery_error_repaired(app, llm):
+    calls = llm.calls
+    (sql, results), _ = await run("Top drugs", REJECTED_SQL)
+    assert results is not None and llm.calls == calls + 1
+
+
+@pytest.mark.anyio
+async def test_gives_up_after_the_repair_limit(app, llm, monkeypatch):
+    import chat
+
+    monkeypatch.setattr(stubs, "REWRITE_REPLY", f"```sql\n{REJECTED_SQL}\n```")
+    calls = llm.calls
+    (sql, results), events = await run("Top drugs", REJECTED_SQL)
+    assert results is None and any("couldn't get a working query" in e.get("content", "") for e in events)
+    assert llm.calls == calls + chat.SQL_REPAIR_ATTEMPTS
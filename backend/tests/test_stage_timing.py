@@ -0,0 +1,47 @@
+import pytest
+
+import metrics
+
+pytestmark = pytest.mark.anyio
+
+# Stages every uncached chat with a chart goes through
+EXPECTED_STAGES = ('working_message', 'chart_check', 'schema', 'sql_generation', 'dry_run', 'query', 'materialize',
+                   'chart_execute', 'serialize')
+
+
+def sample(name, **labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def test_timing_event_and_metrics(client, llm, no_caches):
+    input_tokens = sample("dataexplorer_llm_tokens_count", call="sql_generation", direction="input")
+    ok = sample("dataexplorer_request_seconds_count", outcome="ok")
+
+    response = await client.chat("Show me the top 10 most prescribed medications")
+    _, name, timing = response.events[-1]
+    stages = timing["stages"]
+    assert name == "timing" and timing["type"] == "timing"
+    assert all(stage in stages for stage in EXPECTED_STAGES)
+    # The chart check runs alongside the SQL work, everything else is one after the other
+    assert sum(s["ms"] for name, s in stages.items() if name != "chart_check") <= timing["total_ms"]
+    assert timing["tokens"]["sql_generation"]["input"] > 0
+    assert timing["query"]["rows"] == 10
+    assert response.headers["server-timing"].startswith("app;dur=")
+
+    assert sample("dataexplorer_llm_tokens_count", call="sql_generation", direction="input") == input_tokens + 1
+    assert sample("dataexplorer_request_seconds_count", outcome="ok") == ok + 1
+    status, text = await client.request("GET", "/api/metrics")
+    assert status == 200 and 'dataexplorer_stage_seconds_bucket{le="0.005",stage="sql_generation"}' in text
+
+
+async def test_chart_profile_timed_apart_from_codegen(client, llm, no_caches, monkeypatch):
+    import visualization
+
+    # No built-in renderer, so the chart code comes from the LLM
+    monkeypatch.setattr(visualization, "CHART_BUILTINS_ENABLED", False)
+    response = await client.chat("Show me the top 10 most prescribed medications")
+    stages = response.events[-1][2]["stages"]
+    assert stages["chart_profile"]["count"] == 1
+    # Only the LLM call, which takes the fake's latency
+    assert stages["chart_codegen"]["count"] == 1 and stages["chart_codegen"]["ms"] >= 40
+    assert list(stages).index("chart_profile") < list(stages).index("chart_codegen")
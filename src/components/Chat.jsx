@@ -61,7 +61,7 @@ const Chat = () => {
               )}
               {message.graphType === 'image' && (
                 <img 
-                  src={message.graphData.src} 
+                  src={chatService.chartSrc(message.graphData)} 
                   alt={message.graphData.alt || "Generated graph"}
                   className="graph-image"
                   style={{ maxWidth: '100%', height: 'auto' }}
@@ -84,6 +84,12 @@ const Chat = () => {
             {message.text.split('\n').map((line, index) => (
               <div key={index}>{line || '\u00A0'}</div>
             ))}
+            {message.isStreaming && message.reasoning && (
+              <div className="message-reasoning">{message.reasoning}</div>
+            )}
+            {message.isStreaming && message.progress && (
+              <div className="message-progress">{message.progress}</div>
+            )}
           </div>
         );
     }
@@ -132,7 +138,42 @@ const Chat = () => {
           setStreamingMessage(prev => {
             if (prev) {
               const newText = prev.text ? prev.text + '\n' + chunk.content + '\n' : chunk.content + '\n';
-              const updated = { ...prev, text: newText };
+              // The full answer repeats the reasoning that was streamed in, so that goes away now (and so does
+              // a place in line, a new message means the wait is over)
+              const updated = { ...prev, text: newText, reasoning: '', progress: '' };
+              finalStreamingMessage = updated;
+              return updated;
+            }
+            return null;
+          });
+        } else if (chunk.type === 'reasoning') {
+          // The LLM's reasoning a few words at a time while it's still writing the SQL
+          setStreamingMessage(prev => {
+            if (prev) {
+              const updated = { ...prev, reasoning: (prev.reasoning || '') + chunk.delta };
+              finalStreamingMessage = updated;
+              return updated;
+            }
+            return null;
+          });
+        } else if (chunk.type === 'progress') {
+          // Progress replaces itself instead of adding a new line every page
+          const total = chunk.total_rows ? ` of ${chunk.total_rows.toLocaleString()}` : '';
+          const progressText = chunk.done ? '' : `Loaded ${chunk.rows.toLocaleString()}${total} rows...`;
+          setStreamingMessage(prev => {
+            if (prev) {
+              const updated = { ...prev, progress: progressText };
+              finalStreamingMessage = updated;
+              return updated;
+            }
+            return null;
+          });
+        } else if (chunk.type === 'queue') {
+          // The server is busy and this chat is waiting its turn, it shows like progress does
+          const queueText = `Waiting for a free ${chunk.stage} slot (${chunk.position === 1 ? 'next in line' : `#${chunk.position} in line`})...`;
+          setStreamingMessage(prev => {
+            if (prev) {
+              const updated = { ...prev, progress: queueText };
               finalStreamingMessage = updated;
               return updated;
             }
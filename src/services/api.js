@@ -70,6 +70,14 @@ export const authService = {
 
 // Chat functions
 export const chatService = {
+  // Image charts arrive as a reference to /api/charts/<hash>, older ones still carry the image inline
+  chartSrc: (graphData) => {
+    if (graphData?.chartId) {
+      return `${currentConfig.baseURL}/charts/${graphData.chartId}`;
+    }
+    return graphData?.src;
+  },
+
   sendMessage: async (message, onChunk) => {
     try {
       const token = localStorage.getItem('authToken');
@@ -84,12 +92,24 @@ export const chatService = {
           'Content-Type': 'application/json',
           ...(token && { 'Authorization': `Bearer ${token}` })
         },
-        body: JSON.stringify({ message })
+        // Tell the server how wide charts will be shown so images come back at the right resolution
+        body: JSON.stringify({
+          message,
+          chart_width: Math.round(Math.min(window.innerWidth * 0.9, 1600)),
+          pixel_ratio: window.devicePixelRatio || 1
+        })
       });
 
       console.log('Response status:', response.status); // Debug log
       console.log('Response headers:', Object.fromEntries(response.headers.entries())); // Debug log
 
+      if (response.status === 429) {
+        // Turned away because the server is saturated, it says when to come back
+        const retryAfter = response.headers.get('Retry-After');
+        const detail = await response.json().then(body => body.detail).catch(() => null);
+        throw new Error(`${detail || 'The server is busy'}${retryAfter ? ` (try again in ${retryAfter}s)` : ''}`);
+      }
+
       if (!response.ok) {
         const errorText = await response.text();
         console.error('HTTP Error Response:', errorText);
@@ -103,59 +123,95 @@ export const chatService = {
 
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
-      let buffer = '';
+      // Pieces of a line that hasn't ended yet. Only new chunks get searched for newlines, so a big event
+      // isn't copied and re-scanned every time another piece of it arrives.
+      let pending = [];
+      // The event being read: its data: lines (joined with newlines when it's done), name and id
+      let dataLines = [];
+      let eventName = '';
+      let lastEventId = null;
+
+      // A blank line ends an event
+      const dispatch = () => {
+        if (dataLines.length === 0) {
+          eventName = '';
+          return false;
+        }
+        const data = dataLines.join('\n');
+        dataLines = [];
+        const name = eventName;
+        eventName = '';
+
+        let parsedChunk;
+        try {
+          parsedChunk = JSON.parse(data);
+        } catch (parseError) {
+          console.error('Error parsing event data:', parseError, 'Event:', name);
+          return false;
+        }
+        if (parsedChunk && typeof parsedChunk === 'object' && !parsedChunk.type && name) {
+          parsedChunk.type = name;
+        }
+        if (onChunk && parsedChunk) {
+          onChunk(parsedChunk, { event: name, id: lastEventId });
+        }
+        // Check if this is the end chunk
+        return parsedChunk?.type === 'end';
+      };
+
+      const handleLine = (rawLine) => {
+        const line = rawLine.endsWith('\r') ? rawLine.slice(0, -1) : rawLine;
+        if (line === '') {
+          return dispatch();
+        }
+        // Comments (heartbeats)
+        if (line.startsWith(':')) {
+          return false;
+        }
+        const colon = line.indexOf(':');
+        const field = colon === -1 ? line : line.slice(0, colon);
+        let value = colon === -1 ? '' : line.slice(colon + 1);
+        if (value.startsWith(' ')) {
+          value = value.slice(1);
+        }
+        if (field === 'data') {
+          dataLines.push(value);
+        } else if (field === 'event') {
+          eventName = value;
+        } else if (field === 'id') {
+          lastEventId = value;
+        }
+        return false;
+      };
 
       try {
         while (true) {
           const { done, value } = await reader.read();
           
           if (done) {
-            console.log('Stream ended, final buffer:', buffer); // Debug log
+            // A stream that ends without the trailing blank line still delivers its last event
+            if (pending.length) {
+              handleLine(pending.join(''));
+            }
+            dispatch();
+            console.log('Stream ended'); // Debug log
             break;
           }
 
-          // Decode the chunk and add to buffer
+          // Decode the chunk and handle the complete lines
           const chunk = decoder.decode(value, { stream: true });
-          buffer += chunk;
-          console.log('Received chunk:', chunk); // Debug log
-
-          // Process complete JSON objects from buffer
-          let newlineIndex;
-          while ((newlineIndex = buffer.indexOf('\n')) !== -1) {
-            const line = buffer.slice(0, newlineIndex).trim();
-            buffer = buffer.slice(newlineIndex + 1);
-
-            if (line) {
-              try {
-                console.log('Parsing line:', line); // Debug log
-                
-                // Handle Server-Sent Events (SSE) format
-                let jsonString = line;
-                if (line.startsWith('data: ')) {
-                  jsonString = line.substring(6); // Remove 'data: ' prefix
-                }
-                
-                // Skip empty lines or SSE comments
-                if (!jsonString || jsonString.startsWith(':')) {
-                  continue;
-                }
-                
-                const parsedChunk = JSON.parse(jsonString);
-                
-                // Call the onChunk callback with the parsed chunk
-                if (onChunk) {
-                  onChunk(parsedChunk);
-                }
-
-                // Check if this is the end chunk
-                if (parsedChunk.type === 'end') {
-                  console.log('Received end chunk, finishing stream'); // Debug log
-                  return { success: true };
-                }
-              } catch (parseError) {
-                console.error('Error parsing JSON chunk:', parseError, 'Line:', line);
-                // Continue processing other lines even if one fails to parse
-              }
+          const lines = chunk.split('\n');
+          if (lines.length === 1) {
+            pending.push(chunk);
+            continue;
+          }
+          lines[0] = pending.join('') + lines[0];
+          pending = [lines.pop()];
+
+          for (const line of lines) {
+            if (handleLine(line)) {
+              console.log('Received end chunk, finishing stream'); // Debug log
+              return { success: true };
             }
           }
         }